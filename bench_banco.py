@@ -0,0 +1,127 @@
+# bench_banco.py - Mede consultas de projetos, componentes e conversas no schema do benchvis.db
+# Uso: python bench_banco.py [projetos] [componentes_por_projeto] [turnos_de_conversa]
+import datetime
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchvis import abrir_banco, consulta_fts, migrar, MemoriaConversas, MIGRACOES, PoolBanco
+
+
+def popular(conn, projetos, por_projeto):
+    inicio = datetime.datetime(2020, 1, 1)
+    with conn:
+        conn.executemany(
+            'INSERT INTO projetos (id, nome, descricao, data_criacao, status, linguagem) VALUES (?, ?, ?, ?, ?, ?)',
+            ((i, f"Projeto {i}", "bancada", inicio + datetime.timedelta(minutes=i), "em andamento", "arduino")
+             for i in range(1, projetos + 1)))
+        conn.executemany(
+            'INSERT INTO componentes_projeto (projeto_id, componente, quantidade, observacao) VALUES (?, ?, ?, ?)',
+            ((random.randint(1, projetos), f"R{j % 500}", 1 + j % 10, "")
+             for j in range(projetos * por_projeto)))
+        conn.executemany(
+            'INSERT INTO etapas (projeto_id, ordem, descricao) VALUES (?, ?, ?)',
+            ((i, k, f"Etapa {k}") for i in range(1, projetos + 1) for k in range(3)))
+
+
+def medir(nome, funcao, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    media = (time.perf_counter() - inicio) / repeticoes * 1000
+    print(f"  {nome:<34} {media:9.3f} ms")
+
+
+def rodar(rotulo, versao_final, projetos, por_projeto):
+    with tempfile.TemporaryDirectory() as pasta:
+        conn = abrir_banco(os.path.join(pasta, 'bench.db'))
+        migrar(conn, ate=2)  # só as tabelas
+        random.seed(42)
+        t = time.perf_counter()
+        popular(conn, projetos, por_projeto)
+        # Índices criados depois da carga, como numa migração sobre um banco existente
+        migrar(conn, ate=versao_final)
+        carga = time.perf_counter() - t
+        total = conn.execute('SELECT COUNT(*) FROM componentes_projeto').fetchone()[0]
+        print(f"\n{rotulo}: {projetos} projetos, {total} componentes (carga + migração {carga:.1f} s)")
+
+        ids = [random.randint(1, projetos) for _ in range(200)]
+        it = iter(ids * 1000)
+        medir("componentes de um projeto", lambda: conn.execute(
+            'SELECT componente, quantidade, observacao FROM componentes_projeto WHERE projeto_id = ?',
+            (next(it),)).fetchall(), 200)
+        medir("etapas de um projeto", lambda: conn.execute(
+            'SELECT descricao FROM etapas WHERE projeto_id = ? ORDER BY ordem', (next(it),)).fetchall(), 200)
+        medir("20 projetos mais recentes", lambda: conn.execute(
+            'SELECT id, nome, descricao, status FROM projetos ORDER BY data_criacao DESC LIMIT 20').fetchall(), 200)
+        cursor = conn.execute('SELECT data_criacao, id FROM projetos ORDER BY data_criacao DESC, id DESC '
+                              'LIMIT 1 OFFSET ?', (projetos // 2,)).fetchone()
+        medir("página do meio (keyset)", lambda: conn.execute(
+            'SELECT id, nome, descricao, status FROM projetos WHERE (data_criacao, id) < (?, ?) '
+            'ORDER BY data_criacao DESC, id DESC LIMIT 20', cursor).fetchall(), 200)
+        medir("página do meio (OFFSET)", lambda: conn.execute(
+            'SELECT id, nome, descricao, status FROM projetos ORDER BY data_criacao DESC LIMIT 20 OFFSET ?',
+            (projetos // 2,)).fetchall(), 200)
+        if versao_final >= 4:
+            medir("buscar 'R42' (FTS5, 10 melhores)", lambda: conn.execute(
+                "SELECT rowid FROM busca WHERE busca MATCH ? ORDER BY bm25(busca, 0, 0, 0, 10.0, 1.0) LIMIT 10",
+                (consulta_fts('R42'),)).fetchall(), 50)
+
+        apagar = iter(random.sample(range(1, projetos + 1), 50))
+
+        def deletar():
+            with conn:
+                conn.execute('DELETE FROM projetos WHERE id = ?', (next(apagar),))
+        medir("deletar projeto (com cascata)", deletar, 50)
+        conn.close()
+
+
+# Vocabulário com frequências de Zipf, como em texto real: poucos termos muito comuns,
+# muitos raros
+VOCABULARIO = ("resistor capacitor led arduino fonte regulador transistor mosfet solda osciloscópio "
+               "multímetro tensão corrente pwm motor sensor i2c spi uart bateria lm7805 esp32 relé "
+               "diodo indutor ponte filtro ruído aterramento placa trilha").split() + \
+              [f"termo{i}" for i in range(5000)]
+PESOS_ZIPF = list(itertools.accumulate(1 / (r + 1) for r in range(len(VOCABULARIO))))
+
+
+def frase(k):
+    return " ".join(random.choices(VOCABULARIO, cum_weights=PESOS_ZIPF, k=k))
+
+
+def rodar_conversas(turnos):
+    with tempfile.TemporaryDirectory() as pasta:
+        db = PoolBanco(os.path.join(pasta, 'bench.db'))
+        random.seed(7)
+        random.shuffle(VOCABULARIO)
+        memoria = MemoriaConversas(db)
+        t = time.perf_counter()
+        for i in range(turnos):
+            futuro = memoria.registrar(datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=i),
+                                       "bancada", frase(8), frase(60))
+        futuro.result()
+        print(f"\nConversas: {turnos} turnos (carga + índice {time.perf_counter() - t:.1f} s)")
+
+        perguntas = iter(["qual regulador para o esp32 com bateria?", "ruído no osciloscópio ao medir pwm",
+                          "o mosfet do motor esquenta", "filtro para o sensor i2c",
+                          " ".join(VOCABULARIO[:6])] * 100)
+        medir("3 conversas mais relevantes", lambda: memoria.relevantes(next(perguntas)), 100)
+        medir("gravar uma troca (índice incremental)", lambda: memoria.registrar(
+            datetime.datetime.now(), "bancada", "mais um teste de led", "Use um resistor.").result(), 100)
+        db.fechar()
+
+
+def main():
+    projetos = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    por_projeto = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    ultima = MIGRACOES[-1][0]
+    rodar("Sem índices (schema v2)", 2, projetos, por_projeto)
+    rodar(f"Schema atual (v{ultima})", ultima, projetos, por_projeto)
+    rodar_conversas(int(sys.argv[3]) if len(sys.argv) > 3 else 100000)
+
+
+if __name__ == "__main__":
+    main()
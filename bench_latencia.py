@@ -0,0 +1,305 @@
+# bench_latencia.py - Latência ponta a ponta do BENCH-VIS sem rede, microfone nem caixa de som
+# Uso: python bench_latencia.py [--rodadas N] [--mistura comandos.jsonl]
+#                               [--salvar base.json] [--comparar base.json [--tolerancia 0.2]]
+#
+# O LLM é um servidor local de chat completions (com streaming SSE), a voz vem de um
+# reconhecedor roteirizado, a síntese de dois motores falsos (um "de rede" e um offline
+# rápido) e o áudio vai para uma saída nula que só anota os tempos. Cada latência é configurável, então dá para comparar versões do código
+# com o mesmo "mundo" simulado e pegar regressões antes de liberar.
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchvis import AssistenteMultiperfil, BackendHTTP, MotorVoz, percentil, PipelineFala
+
+# Mistura gravada de uso na bancada: (origem, comando); {i} vira o número da rodada.
+# Comandos que pedem confirmação (deletar) ou encerram a sessão ficam de fora.
+MISTURA_PADRAO = [
+    ('texto', 'ajuda'),
+    ('voz', 'piada'),
+    ('texto', 'projeto novo fonte {i}'),
+    ('texto', 'listar projetos'),
+    ('voz', 'buscar fonte'),
+    ('texto', 'fato'),
+    ('voz', 'conselho'),
+    ('texto', 'qual resistor usar para um led vermelho em 5v?'),
+    ('voz', 'como funciona um mosfet como chave?'),
+    ('texto', 'gerar codigo piscar led no pino 13'),
+    ('texto', 'componentes do projeto 1'),
+    ('voz', 'por que meu regulador esquenta tanto?'),
+    ('texto', 'cache stats'),
+]
+
+RESPOSTA_FALSA = ("Boa pergunta! Para isso, comece medindo a tensão na entrada. "
+                  "Depois confira se a corrente fica dentro do limite do componente. "
+                  "Se esquentar, use um dissipador ou reduza a carga.")
+
+
+class _ServidorHTTP(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # cliente fechou a conexão ociosa
+            super().handle_error(request, client_address)
+
+
+class ServidorLLMFalso:
+    """Servidor chat completions local: espera primeiro_token, depois entrega a resposta
+    em pedaços (SSE) a cada por_token segundos; sem stream, espera o total e responde JSON"""
+
+    def __init__(self, primeiro_token=0.3, por_token=0.02, resposta=RESPOSTA_FALSA):
+        self.primeiro_token = primeiro_token
+        self.por_token = por_token
+        self.tokens = [p + " " for p in resposta.split()]
+        self.pedidos = 0
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                pedido = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                servidor.pedidos += 1
+                time.sleep(servidor.primeiro_token)
+                if pedido.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for i, token in enumerate(servidor.tokens):
+                        if i:
+                            time.sleep(servidor.por_token)
+                        self._pedaco({"choices": [{"delta": {"content": token}}]})
+                    self._pedaco("[DONE]")
+                    self.wfile.write(b"0\r\n\r\n")
+                else:
+                    time.sleep(servidor.por_token * (len(servidor.tokens) - 1))
+                    corpo = json.dumps({"choices": [{"message": {
+                        "content": "".join(servidor.tokens).strip()}}]}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(corpo)))
+                    self.end_headers()
+                    self.wfile.write(corpo)
+
+            def _pedaco(self, dados):
+                linha = f"data: {dados if isinstance(dados, str) else json.dumps(dados)}\n\n".encode()
+                self.wfile.write(f"{len(linha):x}\r\n".encode() + linha + b"\r\n")
+                self.wfile.flush()
+
+        self._http = _ServidorHTTP(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._http.server_address[1]}/openai"
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+
+    def fechar(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+
+class FalaGravada:
+    """O 'áudio' do reconhecedor roteirizado: só carrega o texto que ele deve devolver"""
+
+    def __init__(self, texto):
+        self.texto = texto
+
+
+class ReconhecedorRoteirizado:
+    """Substituto do reconhecedor de voz (mesma assinatura de reconhecer(audio)):
+    devolve o texto roteirizado depois da latência configurada"""
+
+    def __init__(self, latencia=0.4):
+        self.latencia = latencia
+
+    def __call__(self, audio):
+        time.sleep(self.latencia)
+        return audio.texto
+
+
+class MotorVozFalso(MotorVoz):
+    """Substituto de um motor de voz: bytes de áudio falsos (MP3 se for de rede, como o
+    gTTS; WAV se for local) depois de base + por_caractere * len(texto)"""
+
+    def __init__(self, nome, local, base=0.15, por_caractere=0.002):
+        self.nome = nome
+        self.local = local
+        self.latencia_inicial = base
+        self.base = base
+        self.por_caractere = por_caractere
+
+    def sintetizar(self, texto, lang='pt', slow=False):
+        time.sleep(self.base + self.por_caractere * len(texto))
+        return (b"RIFF" if self.local else b"\xff\xfb\x90\x00") + texto.encode('utf-8')
+
+
+class SaidaNula:
+    """No lugar do ServicoReproducao: não toca nada, só anota quando cada áudio chegou"""
+
+    disponivel = True
+
+    def __init__(self):
+        self.primeiro = None
+
+    def marcar(self):
+        self.primeiro = None
+
+    def tocar(self, dados):
+        if self.primeiro is None:
+            self.primeiro = time.perf_counter()
+
+    def pendentes(self):
+        return 0
+
+    def esperar(self, timeout=None):
+        return True
+
+    def interromper(self):
+        pass
+
+    def fechar(self):
+        pass
+
+
+def carregar_mistura(caminho):
+    """JSONL com {"origem": "texto"|"voz", "comando": "..."} por linha; repetir uma linha dá peso"""
+    with open(caminho, encoding='utf-8') as f:
+        return [(item.get('origem', 'texto'), item['comando'])
+                for item in (json.loads(linha) for linha in f if linha.strip())]
+
+
+def tipo_do_comando(assistente, comando):
+    rota, args = assistente.roteador.resolver(comando)
+    if rota is None:
+        return 'ia'
+    return rota.handler.replace('_cmd_', '') if args is not None else 'uso'
+
+
+def rodar(args, mistura):
+    servidor = ServidorLLMFalso(args.llm_primeiro, args.llm_por_token)
+    reconhecer = ReconhecedorRoteirizado(args.stt)
+    saida = SaidaNula()
+    amostras = {}  # 'tipo/medida' -> [segundos]
+    log = io.StringIO()
+    pasta_original = os.getcwd()
+    with tempfile.TemporaryDirectory() as pasta:
+        os.chdir(pasta)  # banco, memória e cache de áudio descartáveis
+        try:
+            with contextlib.redirect_stdout(log):
+                motores = [MotorVozFalso('rede', False, args.tts_base, args.tts_por_caractere)]
+                if not args.sem_tts_local:
+                    motores.append(MotorVozFalso('local', True, args.tts_local, args.tts_por_caractere / 4))
+                assistente = AssistenteMultiperfil(
+                    modo_entrada="texto", pre_aquecer_audio=False, voz=motores,
+                    llm=BackendHTTP(url=servidor.url, tentativas=1))
+                # Fala ligada (modo híbrido) sem microfone, com síntese e saída falsas
+                assistente.modo_entrada = "hibrido"
+                assistente.reprodutor = saida
+                assistente.pipeline_fala = PipelineFala(assistente._sintetizar_frase, saida)
+                assistente.pipeline_fala.esperar(timeout=30)
+                assistente.medidor.limpar()
+
+                for rodada in range(args.rodadas):
+                    for origem, comando in mistura:
+                        comando = comando.replace('{i}', str(rodada))
+                        tipo = tipo_do_comando(assistente, comando)
+                        saida.marcar()
+                        inicio = time.perf_counter()
+                        if origem == 'voz':
+                            with assistente.medidor.etapa('stt'):
+                                comando = reconhecer(FalaGravada(comando))
+                        assistente.processar_comando(comando)
+                        resposta = time.perf_counter() - inicio
+                        assistente.pipeline_fala.esperar(timeout=60)
+                        fala = time.perf_counter() - inicio
+                        medidas = {'resposta': resposta, 'fala_completa': fala}
+                        if saida.primeiro is not None:
+                            medidas['primeiro_audio'] = saida.primeiro - inicio
+                        for medida, valor in medidas.items():
+                            amostras.setdefault(f"{tipo}/{medida}", []).append(valor)
+                            amostras.setdefault(f"TOTAL/{medida}", []).append(valor)
+                etapas = assistente.medidor.percentis()
+                assistente.db.fechar()
+        except Exception:
+            sys.stderr.write(log.getvalue()[-3000:])
+            raise
+        finally:
+            os.chdir(pasta_original)
+            servidor.fechar()
+
+    resultado = {}
+    for chave, valores in amostras.items():
+        valores.sort()
+        resultado[chave] = {'n': len(valores), **{f'p{p}': percentil(valores, p) for p in (50, 95, 99)}}
+    for nome, st in etapas.items():
+        resultado[f"etapa/{nome}"] = st
+    return resultado
+
+
+def imprimir(resultado):
+    print(f"  {'comando / medida':<40} {'n':>5} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for chave in sorted(resultado, key=lambda c: (c.startswith('etapa/'), c.startswith('TOTAL/'), c)):
+        st = resultado[chave]
+        print(f"  {chave:<40} {st['n']:>5} " + " ".join(f"{st[p] * 1000:7.1f}ms" for p in ('p50', 'p95', 'p99')))
+
+
+def comparar(base, atual, tolerancia, folga=0.005):
+    """Medidas cujo p95 piorou mais que a tolerância (com folga absoluta para ruído)"""
+    regressoes = []
+    for chave, st in sorted(atual.items()):
+        if chave not in base:
+            continue
+        antes, agora = base[chave]['p95'], st['p95']
+        if agora > antes * (1 + tolerancia) + folga:
+            regressoes.append(f"{chave}: p95 {antes * 1000:.1f} ms -> {agora * 1000:.1f} ms")
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência ponta a ponta com LLM, voz e áudio simulados")
+    parser.add_argument("--rodadas", type=int, default=5, help="quantas vezes repetir a mistura")
+    parser.add_argument("--mistura", help="JSONL com a mistura de comandos gravada")
+    parser.add_argument("--llm-primeiro", type=float, default=0.3, help="s até o primeiro token")
+    parser.add_argument("--llm-por-token", type=float, default=0.02, help="s entre tokens")
+    parser.add_argument("--stt", type=float, default=0.4, help="s de reconhecimento por fala")
+    parser.add_argument("--tts-base", type=float, default=0.15, help="s fixos por frase sintetizada")
+    parser.add_argument("--tts-por-caractere", type=float, default=0.002)
+    parser.add_argument("--tts-local", type=float, default=0.03,
+                        help="s fixos por frase do motor offline (falas curtas e urgentes)")
+    parser.add_argument("--sem-tts-local", action="store_true", help="só o motor de rede")
+    parser.add_argument("--salvar", help="grava os percentis em JSON (linha de base)")
+    parser.add_argument("--comparar", help="linha de base JSON; sai com erro se o p95 piorar")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="piora relativa aceita no p95")
+    args = parser.parse_args()
+
+    mistura = carregar_mistura(args.mistura) if args.mistura else MISTURA_PADRAO
+    print(f"⏱️ {args.rodadas} rodadas de {len(mistura)} comandos "
+          f"(LLM {args.llm_primeiro * 1000:.0f} ms + {args.llm_por_token * 1000:.0f} ms/token, "
+          f"STT {args.stt * 1000:.0f} ms, TTS {args.tts_base * 1000:.0f} ms/frase)\n")
+    resultado = rodar(args, mistura)
+    imprimir(resultado)
+
+    if args.salvar:
+        with open(args.salvar, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, indent=1, sort_keys=True)
+        print(f"\n💾 Linha de base salva em {args.salvar}")
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            regressoes = comparar(json.load(f), resultado, args.tolerancia)
+        for r in regressoes:
+            print(f"❌ {r}")
+        if regressoes:
+            sys.exit(1)
+        print(f"\n✅ Nenhum p95 piorou mais de {args.tolerancia:.0%} em relação a {args.comparar}")
+
+
+if __name__ == "__main__":
+    main()
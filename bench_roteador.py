@@ -0,0 +1,70 @@
+# bench_roteador.py - Mede o roteamento de comandos do BENCH-VIS
+# (a verificação das rotas fica em test_roteador.py)
+# Uso: python bench_roteador.py [repeticoes]
+import re
+import sys
+import time
+
+from benchvis import AssistenteMultiperfil, RoteadorComandos
+
+# Valores de exemplo para os marcadores usados no texto de ajuda
+EXEMPLOS = {
+    '[nome]': 'madrugada',
+    'NOME': 'Fonte 5V',
+    'ID': '5',
+    '[descrição]': 'piscar led no pino 13',
+    '[arquivo.csv]': 'Bom_Final.csv',
+    'TERMO': 'regulador 5v',
+    '[versão]': '2',
+    '[de] [para]': '1 3',
+    '[número]': '3',
+}
+
+# Frases que devem cair na IA
+TEXTO_LIVRE = [
+    "qual resistor usar para um led vermelho em 5v?",
+    "me conta uma história sobre transistores",
+    "projeto de fonte chaveada, por onde começo?",
+    "o que é a vida?",
+]
+
+
+def comandos_da_ajuda():
+    texto = AssistenteMultiperfil.AJUDA.format(perfil_atual='bancada', perfis='')
+    return re.findall(r'"([^"]+)"', texto)
+
+
+def preencher(comando):
+    for marcador, valor in EXEMPLOS.items():
+        comando = comando.replace(marcador, valor)
+    return comando
+
+
+def medir(roteador, frases, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for frase in frases:
+            roteador.resolver(frase)
+    return (time.perf_counter() - inicio) / (repeticoes * len(frases)) * 1e6
+
+
+def main():
+    repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    roteador = AssistenteMultiperfil.roteador
+    comandos = [preencher(c) for c in comandos_da_ajuda()]
+    print(f"\nRotas: {len(roteador.rotas)}")
+    print(f"  comandos da ajuda: {medir(roteador, comandos, repeticoes):.2f} µs/despacho")
+    print(f"  texto livre (IA):  {medir(roteador, TEXTO_LIVRE, repeticoes):.2f} µs/despacho")
+
+    # Com mil comandos extras o caminho para a IA não deve ficar mais lento
+    grande = RoteadorComandos.da_classe(AssistenteMultiperfil)
+    for i in range(1000):
+        grande.registrar(f'comando{i} extra {{pid:id}}', '_cmd_extra')
+        grande.registrar(f'atalho{i}', '_cmd_extra')
+    print(f"\nRotas: {len(grande.rotas)}")
+    print(f"  comandos da ajuda: {medir(grande, comandos, repeticoes):.2f} µs/despacho")
+    print(f"  texto livre (IA):  {medir(grande, TEXTO_LIVRE, repeticoes):.2f} µs/despacho")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# bench_servidor.py - Carga no modo servidor do BENCH-VIS: centenas de sessões WebSocket ao mesmo tempo
+# Uso: python bench_servidor.py [--sessoes 200] [--turnos 6] [--trabalhadores 32] [--lentas 1]
+#                               [--max-saida 64]
+#
+# Sobe o servidor multissessão contra o LLM falso de bench_latencia.py (sem rede) e abre
+# todas as sessões de uma vez; cada uma manda a mistura de comandos, um turno por vez,
+# esperando o fim de cada resposta. Mostra turnos/s e a latência por turno. Sessões
+# "lentas" mandam comandos sem nunca ler a saída: o servidor deve segurá-las pela
+# backpressure, depois de cerca de max_saida mensagens não lidas, sem atrasar as outras.
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from bench_latencia import ServidorLLMFalso, tipo_do_comando
+from benchvis import (AssistenteMultiperfil, BackendHTTP, BackendImagemLocal, ler_quadro_ws, percentil,
+                      quadro_ws, ServidorSessoes)
+
+# Mensagens além de max_saida que ainda cabem nos buffers entre o servidor e a sessão
+# lenta: envio do kernel (16 KB, dobrados pelo Linux), recepção do cliente e o StreamReader
+# dele. Cerca de 40 com a mistura de quadros grandes e pequenos da ajuda.
+FOLGA_BUFFERS = 48
+
+# Mistura de cada sessão; {s} vira o número da sessão
+MISTURA = [
+    'qual resistor usar para um led vermelho em 5v?',
+    'piada',
+    'projeto novo fonte {s}',
+    'como funciona um mosfet como chave?',
+    'buscar fonte',
+    'listar projetos',
+]
+
+
+class ClienteWS:
+    """Cliente WebSocket mínimo (quadros mascarados, como manda a RFC)"""
+
+    async def conectar(self, host, porta, buffer_recepcao=None):
+        sock = socket.socket()
+        if buffer_recepcao:
+            # Buffer pequeno no cliente lento: o kernel não esconde que ele não lê
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_recepcao)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, (host, porta))
+        # O StreamReader também lê à frente (até 2 x limit) mesmo sem ninguém consumir
+        self.reader, self.writer = await asyncio.open_connection(
+            sock=sock, **({'limit': buffer_recepcao} if buffer_recepcao else {}))
+        chave = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write(f"GET /ws HTTP/1.1\r\nHost: {host}:{porta}\r\nUpgrade: websocket\r\n"
+                          f"Connection: Upgrade\r\nSec-WebSocket-Key: {chave}\r\n"
+                          f"Sec-WebSocket-Version: 13\r\n\r\n".encode())
+        status = await self.reader.readline()
+        if b" 101 " not in status:
+            raise ConnectionError(f"handshake recusado: {status!r}")
+        while (await self.reader.readline()) not in (b"\r\n", b""):
+            pass
+        await self.esperar_fim()  # saudação
+
+    async def esperar_fim(self):
+        """Lê até o fim do turno; retorna (segundos até a primeira saída, mensagens de saída)"""
+        inicio = time.perf_counter()
+        primeira, mensagens = None, 0
+        while True:
+            quadro = await ler_quadro_ws(self.reader)
+            if quadro is None or quadro[0] == 0x8:
+                raise ConnectionError("servidor fechou a sessão")
+            mensagem = json.loads(quadro[1])
+            if mensagem['tipo'] == 'fim':
+                return primeira, mensagens
+            if primeira is None:
+                primeira = time.perf_counter() - inicio
+            mensagens += 1
+
+    def enviar(self, texto):
+        self.writer.write(quadro_ws(texto, mascarar=True))
+
+    async def turno(self, texto):
+        inicio = time.perf_counter()
+        self.enviar(texto)
+        await self.writer.drain()
+        primeira, mensagens = await self.esperar_fim()
+        return time.perf_counter() - inicio, (inicio + primeira if primeira is not None else None), mensagens
+
+    async def fechar(self):
+        self.writer.write(quadro_ws(b"", 0x8, mascarar=True))
+        with contextlib.suppress(ConnectionError):
+            await self.writer.drain()
+        self.writer.close()
+
+
+async def sessao(numero, host, porta, turnos, tipos, amostras, erros):
+    cliente = ClienteWS()
+    try:
+        await cliente.conectar(host, porta)
+        for i in range(turnos):
+            comando = MISTURA[i % len(MISTURA)].replace('{s}', str(numero))
+            inicio = time.perf_counter()
+            total, primeira, mensagens = await cliente.turno(comando)
+            medidas = {'resposta': total}
+            if primeira is not None:
+                medidas['primeira_saida'] = primeira - inicio
+            for medida, valor in medidas.items():
+                amostras.setdefault(f"{tipos[comando]}/{medida}", []).append(valor)
+                amostras.setdefault(f"TOTAL/{medida}", []).append(valor)
+        await cliente.fechar()
+    except (ConnectionError, OSError, ValueError) as e:
+        erros.append(f"sessão {numero}: {e}")
+
+
+async def sessao_lenta(host, porta, parar):
+    """Manda comandos sem parar e nunca lê a saída"""
+    cliente = ClienteWS()
+    await cliente.conectar(host, porta, buffer_recepcao=4096)
+    enviados = 0
+    while not parar.is_set():
+        cliente.enviar('ajuda')
+        enviados += 1
+        try:
+            await asyncio.wait_for(cliente.writer.drain(), 0.2)
+        except asyncio.TimeoutError:
+            pass  # o servidor parou de ler: é a backpressure
+        await asyncio.sleep(0.01)
+    cliente.writer.close()
+    return enviados
+
+
+async def carga(args, servidor, tipos):
+    amostras, erros = {}, []
+    parar = asyncio.Event()
+    lentas = [asyncio.create_task(sessao_lenta('127.0.0.1', servidor.porta, parar)) for _ in range(args.lentas)]
+    inicio = time.perf_counter()
+    await asyncio.gather(*(sessao(n, '127.0.0.1', servidor.porta, args.turnos, tipos, amostras, erros)
+                           for n in range(args.sessoes)))
+    duracao = time.perf_counter() - inicio
+    # Só as lentas continuam abertas
+    atendidos = [(c.turnos, c.saidas_enviadas) for c in list(servidor._sessoes.values())]
+    parar.set()
+    enviados = await asyncio.gather(*lentas)
+    return amostras, erros, duracao, list(zip(enviados, atendidos))
+
+
+def http(porta, caminho, corpo=None):
+    pedido = urllib.request.Request(f"http://127.0.0.1:{porta}{caminho}",
+                                    data=json.dumps(corpo).encode() if corpo is not None else None)
+    with urllib.request.urlopen(pedido, timeout=30) as r:
+        return json.loads(r.read())
+
+
+def rodar(args):
+    servidor_llm = ServidorLLMFalso(args.llm_primeiro, args.llm_por_token)
+    log = io.StringIO()
+    pasta_original = os.getcwd()
+    with tempfile.TemporaryDirectory() as pasta:
+        os.chdir(pasta)  # banco e caches descartáveis
+        try:
+            with contextlib.redirect_stdout(log):
+                base = AssistenteMultiperfil(
+                    modo_entrada="texto", pre_aquecer_audio=False, prefetch=False, imagem=BackendImagemLocal(),
+                    llm=BackendHTTP(url=servidor_llm.url, tentativas=1, tamanho_pool=args.trabalhadores))
+                # Buffer de envio pequeno: o que segura a sessão lenta é o crédito (max_saida),
+                # não os buffers do kernel
+                servidor = ServidorSessoes(base, porta=0, trabalhadores=args.trabalhadores,
+                                           max_saida=args.max_saida, buffer_envio=16 * 1024)
+                thread = threading.Thread(target=servidor.rodar, daemon=True)
+                thread.start()
+                servidor.pronto.wait(10)
+                tipos = {c.replace('{s}', str(n)): 'comando' if tipo_do_comando(base, c) != 'ia' else 'ia'
+                         for c in MISTURA for n in range(args.sessoes)}
+                amostras, erros, duracao, lentas = asyncio.run(carga(args, servidor, tipos))
+                resposta = http(servidor.porta, '/comando', {'texto': 'deletar projeto 1', 'respostas': ['sim']})
+                saude = http(servidor.porta, '/saude')
+                servidor.parar()
+                thread.join(10)
+                base.db.fechar()
+        except Exception:
+            sys.stderr.write(log.getvalue()[-3000:])
+            raise
+        finally:
+            os.chdir(pasta_original)
+            servidor_llm.fechar()
+    return amostras, erros, duracao, lentas, resposta, saude
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga no servidor multissessão com LLM simulado")
+    parser.add_argument("--sessoes", type=int, default=200, help="sessões WebSocket simultâneas")
+    parser.add_argument("--turnos", type=int, default=6, help="comandos por sessão")
+    parser.add_argument("--trabalhadores", type=int, default=32, help="turnos atendidos ao mesmo tempo")
+    parser.add_argument("--lentas", type=int, default=1, help="sessões que mandam sem nunca ler")
+    parser.add_argument("--max-saida", type=int, default=64, help="mensagens não lidas por sessão")
+    parser.add_argument("--llm-primeiro", type=float, default=0.3, help="s até o primeiro token")
+    parser.add_argument("--llm-por-token", type=float, default=0.02, help="s entre tokens")
+    args = parser.parse_args()
+
+    print(f"🌐 {args.sessoes} sessões x {args.turnos} turnos, {args.trabalhadores} trabalhadores, "
+          f"{args.lentas} sessões lentas (LLM {args.llm_primeiro * 1000:.0f} ms + "
+          f"{args.llm_por_token * 1000:.0f} ms/token)\n")
+    amostras, erros, duracao, lentas, resposta, saude = rodar(args)
+
+    total = len(amostras.get('TOTAL/resposta', []))
+    print(f"  {total} turnos em {duracao:.1f} s: {total / duracao:.1f} turnos/s\n")
+    print(f"  {'comando / medida':<28} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for chave in sorted(amostras, key=lambda c: (c.startswith('TOTAL/'), c)):
+        valores = sorted(amostras[chave])
+        print(f"  {chave:<28} {len(valores):>6} "
+              + " ".join(f"{percentil(valores, p) * 1000:7.1f}ms" for p in (50, 95, 99)))
+    presas = []
+    for n, (mandou, (atendidos, saidas)) in enumerate(lentas):
+        print(f"\n  sessão lenta {n}: mandou {mandou} comandos, {atendidos} atendidos e {saidas} mensagens "
+              f"não lidas antes de segurar (max_saida {args.max_saida})")
+        # Além do crédito só cabe o que estiver nos buffers (FOLGA_BUFFERS)
+        if not args.max_saida <= saidas <= args.max_saida + FOLGA_BUFFERS:
+            presas.append(f"sessão lenta {n}: {saidas} mensagens não lidas, esperado ~{args.max_saida}")
+    print(f"\n  POST /comando: {resposta['ms']} ms, {resposta['saida'].strip()!r}")
+    print(f"  GET /saude: {saude}")
+
+    for erro in erros[:10]:
+        print(f"❌ {erro}")
+    for problema in presas:
+        print(f"❌ {problema}")
+    if erros or total != args.sessoes * args.turnos:
+        print(f"❌ {len(erros)} sessões falharam")
+        sys.exit(1)
+    if presas:
+        sys.exit(1)
+    print(f"\n✅ Todas as {args.sessoes} sessões completaram os {args.turnos} turnos")
+
+
+if __name__ == "__main__":
+    main()
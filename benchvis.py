@@ -1,33 +1,3127 @@
 # bench_vis_profiles.py - Assistente com múltiplos perfis de personalidade
-# Instale: pip install pollinations-client pyttsx3 speechrecognition request PyAudio
-import pyttsx3
-import speech_recognition as sr
+# Instale: pip install gTTS pyttsx3 speechrecognition requests PyAudio
 import datetime
 import json
 import random
 import os
+import sys
 import pickle
 import sqlite3
 import threading
+import queue
 import time
+import math
+import array
+import asyncio
+import base64
 import re
-import requests
 import urllib.parse
 import hashlib
+import heapq
+import struct
+import difflib
+import zlib
+import io
+import codecs
+import selectors
 import shutil
+import socket
 import tempfile
 import subprocess
-from collections import deque
-from pollinations import Pollinations
-from gtts import gTTS
+import argparse
+import csv
+import unicodedata
+import importlib
+import importlib.util
+import contextlib
+import concurrent.futures
+from collections import deque, OrderedDict
+
+
+# ---------- IMPORTAÇÃO TARDIA E PERFIL DE INICIALIZAÇÃO ----------
+class _ModuloTardio:
+    """Importa o módulo só no primeiro acesso a um atributo"""
+
+    def __init__(self, nome):
+        self._nome = nome
+        self._modulo = None
+
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nome)
+        return getattr(self._modulo, atributo)
+
+
+# Módulos pesados: carregados no primeiro uso, não na inicialização
+sr = _ModuloTardio('speech_recognition')
+requests = _ModuloTardio('requests')
+
+
+class PerfilInicializacao:
+    """Registra o tempo de cada fase da inicialização, em série ou em segundo plano"""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.fases = []  # [nome, inicio, fim ou None, segundo_plano]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def fase(self, nome, segundo_plano=False):
+        registro = [nome, time.perf_counter() - self.t0, None, segundo_plano]
+        with self._lock:
+            self.fases.append(registro)
+        try:
+            yield
+        finally:
+            registro[2] = time.perf_counter() - self.t0
+
+    def em_paralelo(self, nome, funcao, *args):
+        """Roda a função numa thread daemon e devolve um Future com o resultado"""
+        futuro = concurrent.futures.Future()
+
+        def tarefa():
+            with self.fase(nome, segundo_plano=True):
+                try:
+                    futuro.set_result(funcao(*args))
+                except BaseException as e:
+                    futuro.set_exception(e)
+
+        threading.Thread(target=tarefa, daemon=True).start()
+        return futuro
+
+    def marcar(self, nome):
+        agora = time.perf_counter() - self.t0
+        with self._lock:
+            self.fases.append([nome, agora, agora, False])
+
+    def relatorio(self):
+        linhas = ["⏱️ PERFIL DE INICIALIZAÇÃO:"]
+        with self._lock:
+            fases = sorted(self.fases, key=lambda f: f[1])
+        for nome, inicio, fim, segundo_plano in fases:
+            onde = " [segundo plano]" if segundo_plano else ""
+            if fim is None:
+                linhas.append(f"  {nome:<22} início {inicio * 1000:7.1f} ms   em andamento{onde}")
+            else:
+                linhas.append(f"  {nome:<22} início {inicio * 1000:7.1f} ms   duração {(fim - inicio) * 1000:7.1f} ms{onde}")
+        return "\n".join(linhas)
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) pelo método do posto mais próximo; valores já ordenados"""
+    if not valores:
+        return None
+    return valores[max(0, math.ceil(p / 100 * len(valores)) - 1)]
+
+
+class MedidorEtapas:
+    """Durações por etapa do atendimento (roteamento, llm, tts...), em uso real e nos
+    benchmarks. Guarda só as últimas max_amostras de cada etapa."""
+
+    def __init__(self, max_amostras=10000):
+        self.max_amostras = max_amostras
+        self.amostras = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def etapa(self, nome):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nome, time.perf_counter() - inicio)
+
+    def registrar(self, nome, segundos):
+        with self._lock:
+            if nome not in self.amostras:
+                self.amostras[nome] = deque(maxlen=self.max_amostras)
+            self.amostras[nome].append(segundos)
+
+    def limpar(self):
+        with self._lock:
+            self.amostras.clear()
+
+    def percentis(self, pontos=(50, 95, 99)):
+        """{etapa: {'n': amostras, 'p50': segundos, ...}}"""
+        with self._lock:
+            copia = {nome: sorted(valores) for nome, valores in self.amostras.items()}
+        return {nome: dict({'n': len(valores)}, **{f'p{p}': percentil(valores, p) for p in pontos})
+                for nome, valores in copia.items()}
+
+    def relatorio(self):
+        linhas = [f"  {'etapa':<20} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9}"]
+        for nome, st in sorted(self.percentis().items()):
+            linhas.append(f"  {nome:<20} {st['n']:>6} " +
+                          " ".join(f"{st[p] * 1000:7.1f}ms" for p in ('p50', 'p95', 'p99')))
+        return "\n".join(linhas)
+
+
+# ---------- CACHE EM DISCO ----------
+class CacheArquivos:
+    """Cache persistente em disco endereçado por conteúdo, com limite de tamanho e despejo LRU.
+
+    Cada arquivo é nomeado pela chave (um hash do que o gerou); a recência sobrevive
+    entre execuções pelo mtime dos arquivos.
+    """
+
+    def __init__(self, diretorio, limite_bytes, extensao):
+        self.diretorio = diretorio
+        self.limite_bytes = limite_bytes
+        self.extensao = extensao
+        self._lock = threading.Lock()
+        self._indice = OrderedDict()  # chave -> tamanho, do menos para o mais recente
+        self._tamanho_total = 0
+        os.makedirs(diretorio, exist_ok=True)
+        self._carregar_indice()
+
+    def caminho(self, chave):
+        return os.path.join(self.diretorio, chave + self.extensao)
+
+    def _carregar_indice(self):
+        """Reconstrói o índice LRU a partir do mtime dos arquivos já em disco"""
+        entradas = []
+        for nome in os.listdir(self.diretorio):
+            if not nome.endswith(self.extensao):
+                continue
+            try:
+                st = os.stat(os.path.join(self.diretorio, nome))
+            except OSError:
+                continue
+            entradas.append((st.st_mtime, nome[:-len(self.extensao)], st.st_size))
+        for _, chave, tamanho in sorted(entradas):
+            self._indice[chave] = tamanho
+            self._tamanho_total += tamanho
+
+    def obter_arquivo(self, chave):
+        """Retorna o caminho do arquivo em cache ou None"""
+        with self._lock:
+            if chave not in self._indice:
+                return None
+            caminho = self.caminho(chave)
+            if not os.path.exists(caminho):
+                self._tamanho_total -= self._indice.pop(chave)
+                return None
+            self._indice.move_to_end(chave)
+        try:
+            os.utime(caminho)  # mantém a recência entre execuções
+        except OSError:
+            pass
+        return caminho
+
+    def guardar_arquivo(self, chave, dados):
+        """Grava de forma atômica e despeja os itens mais antigos se passar do limite"""
+        caminho = self.caminho(chave)
+        fd, tmp = tempfile.mkstemp(dir=self.diretorio, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(dados)
+            os.replace(tmp, caminho)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        with self._lock:
+            self._tamanho_total -= self._indice.pop(chave, 0)
+            self._indice[chave] = len(dados)
+            self._tamanho_total += len(dados)
+            self._despejar()
+        return caminho
+
+    def _despejar(self):
+        while self._tamanho_total > self.limite_bytes and len(self._indice) > 1:
+            chave, tamanho = self._indice.popitem(last=False)
+            self._tamanho_total -= tamanho
+            try:
+                os.unlink(self.caminho(chave))
+            except OSError:
+                pass
+
+    def estatisticas(self):
+        with self._lock:
+            return {'itens': len(self._indice), 'bytes': self._tamanho_total}
+
+
+class CacheAudio(CacheArquivos):
+    """Cache do áudio sintetizado. Cada arquivo é nomeado pelo hash de (texto, idioma,
+    lento, motor), então a mesma frase falada com a mesma emoção é sintetizada uma única
+    vez por motor. O formato (MP3 ou WAV) vem no próprio conteúdo."""
+
+    def __init__(self, diretorio='cache_audio', limite_bytes=50 * 1024 * 1024, extensao='.mp3'):
+        super().__init__(diretorio, limite_bytes, extensao)
+
+    @staticmethod
+    def chave(texto, lang='pt', slow=False, motor='gtts'):
+        # O gTTS fica com a chave de antes, sem o motor: o cache já gravado continua valendo
+        bruto = [texto, lang, bool(slow)] + ([] if motor == 'gtts' else [motor])
+        return hashlib.sha256(json.dumps(bruto, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def obter(self, texto, lang='pt', slow=False, motor='gtts'):
+        """Retorna o caminho do áudio em cache ou None"""
+        return self.obter_arquivo(self.chave(texto, lang, slow, motor))
+
+    def guardar(self, texto, lang, slow, dados, motor='gtts'):
+        return self.guardar_arquivo(self.chave(texto, lang, slow, motor), dados)
+
+    def aquecer(self, frases, lang, slow, sintetizar):
+        """Sintetiza em segundo plano as frases que ainda não estão no cache"""
+        def tarefa():
+            for texto in frases:
+                if self.obter(texto, lang, slow):
+                    continue
+                try:
+                    self.guardar(texto, lang, slow, sintetizar(texto, lang, slow))
+                except Exception:
+                    return  # sem rede: desiste e tenta de novo na próxima execução
+        t = threading.Thread(target=tarefa, daemon=True)
+        t.start()
+        return t
+
+
+def sintetizar_gtts(texto, lang='pt', slow=False):
+    """Sintetiza a fala com gTTS e devolve os bytes do MP3"""
+    from gtts import gTTS
+    buffer = io.BytesIO()
+    gTTS(text=texto, lang=lang, slow=slow, timeout=10).write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+# ---------- MOTORES DE VOZ ----------
+class MotorVoz:
+    """Interface dos motores de síntese de fala.
+
+    sintetizar(texto, lang, slow) devolve os bytes do áudio, MP3 ou WAV (a reprodução
+    reconhece pelo conteúdo). local=False marca os que dependem de rede; reserva=True,
+    os que só entram quando nenhum outro respondeu.
+    """
+
+    nome = 'base'
+    local = True
+    reserva = False
+    latencia_inicial = 0.1  # estimativa em segundos até haver medições
+
+    def disponivel(self):
+        return True
+
+    def aquecer(self):
+        """Deixa o motor pronto antes da primeira fala"""
+
+    def sintetizar(self, texto, lang='pt', slow=False):
+        raise NotImplementedError
+
+
+class MotorGTTS(MotorVoz):
+    """gTTS: a voz mais natural, mas cada frase é uma ida e volta ao Google"""
+
+    nome = 'gtts'
+    local = False
+    latencia_inicial = 0.6
+
+    def disponivel(self):
+        return importlib.util.find_spec('gtts') is not None
+
+    def sintetizar(self, texto, lang='pt', slow=False):
+        return sintetizar_gtts(texto, lang, slow)
+
+
+class MotorPyttsx3(MotorVoz):
+    """pyttsx3 offline (espeak no Linux). Uma única instância do motor fica aberta
+    entre as falas; cada frase é gravada num WAV temporário."""
+
+    nome = 'pyttsx3'
+
+    def __init__(self, taxa=180):
+        self.taxa = taxa
+        self._motor = None
+        self._lock = threading.Lock()
+
+    def disponivel(self):
+        return importlib.util.find_spec('pyttsx3') is not None
+
+    def aquecer(self):
+        with self._lock:
+            if self._motor is not None:
+                return
+            import pyttsx3
+            motor = pyttsx3.init()
+            for voz in motor.getProperty('voices') or []:
+                descricao = f"{voz.id} {voz.name}".lower()
+                if any(t in descricao for t in ('pt-br', 'brazil', 'portug')):
+                    motor.setProperty('voice', voz.id)
+                    break
+            self._motor = motor
+
+    def sintetizar(self, texto, lang='pt', slow=False):
+        self.aquecer()
+        fd, caminho = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        try:
+            with self._lock:
+                self._motor.setProperty('rate', self.taxa - 40 if slow else self.taxa)
+                self._motor.save_to_file(texto, caminho)
+                self._motor.runAndWait()
+            with open(caminho, 'rb') as f:
+                dados = f.read()
+        finally:
+            os.unlink(caminho)
+        if not dados:
+            raise RuntimeError("pyttsx3 não gerou áudio")
+        return dados
+
+
+class MotorEspeak(MotorVoz):
+    """espeak-ng (ou espeak) pela linha de comando: offline, sem dependência Python"""
+
+    nome = 'espeak'
+
+    def __init__(self, voz='pt-br', taxa=175):
+        self.voz = voz
+        self.taxa = taxa
+        self.comando = shutil.which('espeak-ng') or shutil.which('espeak')
+
+    def disponivel(self):
+        return self.comando is not None
+
+    def sintetizar(self, texto, lang='pt', slow=False):
+        taxa = self.taxa - 40 if slow else self.taxa
+        resultado = subprocess.run([self.comando, '-v', self.voz, '-s', str(taxa), '--stdout', texto],
+                                   capture_output=True, timeout=30, check=True)
+        return resultado.stdout
+
+
+class MotorNulo(MotorVoz):
+    """Sem áudio: a fala fica só no terminal"""
+
+    nome = 'nulo'
+    reserva = True
+    latencia_inicial = 0.0
+
+    def sintetizar(self, texto, lang='pt', slow=False):
+        return b""
+
+
+# Motores conhecidos, pelo nome usado em BENCHVIS_VOZ
+MOTORES_VOZ = {'gtts': MotorGTTS, 'pyttsx3': MotorPyttsx3, 'espeak': MotorEspeak, 'nulo': MotorNulo}
+
+
+def motores_voz_padrao():
+    """Motores na ordem de preferência de BENCHVIS_VOZ (padrão: gtts,pyttsx3,espeak)"""
+    nomes = os.environ.get('BENCHVIS_VOZ', 'gtts,pyttsx3,espeak')
+    return [MOTORES_VOZ[n.strip()]() for n in nomes.split(',') if n.strip() in MOTORES_VOZ]
+
+
+class SeletorVoz:
+    """Escolhe o motor de cada frase e mede a latência de cada um em uso real.
+
+    Falas normais vão para o primeiro motor saudável na ordem de preferência (a melhor
+    voz); as curtas e as urgentes, para o mais rápido pela mediana recente. Um motor de
+    rede que passa do prazo é deixado de lado naquela frase e conta como falha no seu
+    disjuntor; o próximo assume. A síntese atrasada termina em segundo plano e fica no
+    cache para a próxima vez. Cada motor é criado uma vez e reaproveitado.
+    """
+
+    def __init__(self, motores, cache=None, medidor=None, limite_curta=40, prazo_rede=2.5, janela=20):
+        self.motores = [m for m in motores if m.disponivel()]
+        if not any(m.reserva for m in self.motores):
+            self.motores.append(MotorNulo())
+        self.cache = cache
+        self.medidor = medidor
+        self.limite_curta = limite_curta
+        self.prazo_rede = prazo_rede
+        self._latencias = {m.nome: deque(maxlen=janela) for m in self.motores}
+        self._disjuntores = {m.nome: Disjuntor(limite_falhas=2, tempo_aberto=60.0) for m in self.motores}
+        self._contagem = {m.nome: {'frases': 0, 'falhas': 0} for m in self.motores}
+        self._indisponiveis = set()
+        self._lock = threading.Lock()
+
+    def curta(self, texto):
+        return len(texto) <= self.limite_curta
+
+    def aquecer(self):
+        """Carrega os motores locais em segundo plano; os que falharem saem da escolha"""
+        def tarefa():
+            for motor in self.motores:
+                if not motor.local:
+                    continue
+                try:
+                    motor.aquecer()
+                except Exception:
+                    self._indisponiveis.add(motor.nome)
+        t = threading.Thread(target=tarefa, daemon=True)
+        t.start()
+        return t
+
+    def estimativa(self, motor):
+        """Mediana das últimas latências do motor (ou a estimativa inicial)"""
+        with self._lock:
+            valores = sorted(self._latencias[motor.nome])
+        return valores[len(valores) // 2] if valores else motor.latencia_inicial
+
+    def ordem(self, urgente=False):
+        """Motores na ordem em que serão tentados; a reserva sempre por último"""
+        candidatos = [m for m in self.motores if not m.reserva and m.nome not in self._indisponiveis]
+        if urgente:
+            candidatos.sort(key=self.estimativa)
+        return candidatos + [m for m in self.motores if m.reserva]
+
+    def sintetizar(self, texto, lang='pt', slow=False, urgente=False):
+        """Bytes do áudio da frase (b"" se só a reserva nula respondeu)"""
+        if self.cache is not None:
+            for motor in self.motores:
+                if not motor.local:
+                    caminho = self.cache.obter(texto, lang, slow, motor.nome)
+                    if caminho:
+                        with open(caminho, 'rb') as f:
+                            return f.read()
+        erro = None
+        for motor in self.ordem(urgente):
+            if not self._disjuntores[motor.nome].permitir():
+                continue
+            inicio = time.perf_counter()
+            try:
+                dados = self._chamar(motor, texto, lang, slow)
+            except Exception as e:
+                erro = e
+                demora = time.perf_counter() - inicio
+                if isinstance(e, concurrent.futures.TimeoutError):
+                    self._registrar(motor, demora)  # travou: a mediana precisa refletir isso
+                self._disjuntores[motor.nome].falha()
+                with self._lock:
+                    self._contagem[motor.nome]['falhas'] += 1
+                continue
+            self._disjuntores[motor.nome].sucesso()
+            self._registrar(motor, time.perf_counter() - inicio)
+            with self._lock:
+                self._contagem[motor.nome]['frases'] += 1
+            return dados
+        raise RuntimeError(f"nenhum motor de voz respondeu: {erro}")
+
+    def _chamar(self, motor, texto, lang, slow):
+        if motor.local:
+            return motor.sintetizar(texto, lang, slow)
+        # Motor de rede numa thread própria, com prazo; se travar, o resultado ainda
+        # vai para o cache quando chegar
+        futuro = concurrent.futures.Future()
+
+        def tarefa():
+            try:
+                dados = motor.sintetizar(texto, lang, slow)
+            except BaseException as e:
+                futuro.set_exception(e)
+                return
+            if self.cache is not None:
+                self.cache.guardar(texto, lang, slow, dados, motor.nome)
+            futuro.set_result(dados)
+
+        threading.Thread(target=tarefa, daemon=True).start()
+        return futuro.result(timeout=max(self.prazo_rede, 3 * self.estimativa(motor)))
+
+    def _registrar(self, motor, segundos):
+        with self._lock:
+            self._latencias[motor.nome].append(segundos)
+        if self.medidor is not None:
+            self.medidor.registrar(f"tts/{motor.nome}", segundos)
+
+    def relatorio(self):
+        linhas = [f"  {'motor':<10} {'estado':<14} {'frases':>7} {'falhas':>7} {'mediana':>9}"]
+        for motor in self.motores:
+            if motor.nome in self._indisponiveis:
+                estado = 'indisponível'
+            else:
+                estado = {'fechado': 'ok', 'aberto': 'em pausa', 'meio_aberto': 'em teste'}[
+                    self._disjuntores[motor.nome].estado]
+            contagem = self._contagem[motor.nome]
+            linhas.append(f"  {motor.nome:<10} {estado:<14} {contagem['frases']:>7} {contagem['falhas']:>7} "
+                          f"{self.estimativa(motor) * 1000:7.0f}ms")
+        return "\n".join(linhas)
+
+
+# ---------- FALA EM PIPELINE ----------
+def dividir_frases(texto, min_chars=20, max_chars=220):
+    """Divide o texto em frases pela pontuação final, juntando pedaços muito curtos
+    e quebrando os muito longos em vírgulas ou espaços"""
+    pedacos = [p.strip() for p in re.split(r'(?<=[.!?…;:])\s+|\n+', texto) if p.strip()]
+    frases = []
+    for pedaco in pedacos:
+        # Um pedaço curto entra no começo do próximo antes da quebra, e não fica sozinho
+        if frases and len(frases[-1]) < min_chars:
+            pedaco = f"{frases.pop()} {pedaco}"
+        while len(pedaco) > max_chars:
+            corte = pedaco.rfind(', ', 0, max_chars)
+            if corte < min_chars:
+                corte = pedaco.rfind(' ', 0, max_chars)
+            if corte < min_chars:
+                corte = max_chars - 1  # sem vírgula nem espaço: corta seco em max_chars
+            frases.append(pedaco[:corte + 1].strip())
+            pedaco = pedaco[corte + 1:].strip()
+        if pedaco:
+            frases.append(pedaco)
+    return frases
+
+
+# ---------- REPRODUÇÃO DE ÁUDIO ----------
+_BITRATES_MP3 = {
+    'mpeg1': [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    'mpeg2': [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+
+def duracao_audio(dados):
+    """Estima a duração em segundos de um MP3 (CBR, como o do gTTS) ou WAV; 0 se não souber"""
+    if dados[:4] == b'RIFF' and dados[8:12] == b'WAVE':
+        bytes_por_segundo = int.from_bytes(dados[28:32], 'little')
+        return (len(dados) - 44) / bytes_por_segundo if bytes_por_segundo else 0.0
+    inicio = 0
+    if dados[:3] == b'ID3' and len(dados) >= 10:
+        tamanho = 0
+        for b in dados[6:10]:
+            tamanho = (tamanho << 7) | (b & 0x7f)
+        inicio = 10 + tamanho
+    for i in range(inicio, min(len(dados) - 4, inicio + 4096)):
+        if dados[i] != 0xff or (dados[i + 1] & 0xe0) != 0xe0:
+            continue
+        versao = (dados[i + 1] >> 3) & 0x03
+        indice = dados[i + 2] >> 4
+        if versao == 1 or indice in (0, 15):
+            continue
+        kbps = _BITRATES_MP3['mpeg1' if versao == 3 else 'mpeg2'][indice]
+        return (len(dados) - i) * 8 / (kbps * 1000)
+    return 0.0
+
+
+class ServicoReproducao:
+    """Serviço de reprodução de longa duração.
+
+    Detecta o player uma vez, mantém um único processo aberto recebendo o áudio em
+    memória pelo stdin e toca uma fila não bloqueante: tocar() retorna na hora.
+    """
+
+    # (nome, comando, persistente) em ordem de preferência. Os persistentes aceitam
+    # um fluxo contínuo de MP3 no stdin; o aplay só entende WAV e roda por item.
+    # O WAV dos motores offline sempre toca num processo por item (PLAYERS_WAV).
+    PLAYERS = [
+        ('mpg123', ['mpg123', '-q', '-'], True),
+        ('mpv', ['mpv', '--no-video', '--really-quiet', '--cache=no', '-'], True),
+        ('ffplay', ['ffplay', '-nodisp', '-loglevel', 'quiet', '-i', 'pipe:0'], True),
+        ('aplay', ['aplay', '-q', '-'], False),
+    ]
+    PLAYERS_WAV = ['aplay', 'mpv', 'ffplay']
+
+    def __init__(self, antecedencia=0.3):
+        self.antecedencia = antecedencia  # quanto antes do fim do item atual o próximo é enviado
+        self.player = None
+        for nome, cmd, persistente in self.PLAYERS:
+            if shutil.which(nome):
+                self.player = (nome, cmd, persistente)
+                break
+        self.player_wav = next(((nome, cmd, False) for nome, cmd, _ in self.PLAYERS
+                                if nome in self.PLAYERS_WAV and shutil.which(nome)), None)
+        self._fila = queue.Queue()
+        self._processo = None
+        self._fim_previsto = 0.0
+        self._lock = threading.Lock()
+        self._interrompido = threading.Event()
+        self._thread = None
+
+    @property
+    def disponivel(self):
+        return self.player is not None
+
+    def tocar(self, dados):
+        """Enfileira os bytes de áudio e retorna imediatamente"""
+        if not self.disponivel:
+            return False
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._trabalhar, daemon=True)
+            self._thread.start()
+        self._fila.put(dados)
+        return True
+
+    def pendentes(self):
+        """Itens na fila mais o item que ainda está tocando"""
+        return self._fila.qsize() + (1 if time.time() < self._fim_previsto else 0)
+
+    def esperar(self, timeout=None):
+        """Bloqueia até a fila esvaziar e o último áudio terminar de tocar"""
+        limite = None if timeout is None else time.time() + timeout
+        while self._fila.unfinished_tasks or time.time() < self._fim_previsto:
+            if limite is not None and time.time() >= limite:
+                return False
+            time.sleep(0.02)
+        return True
+
+    def interromper(self):
+        """Descarta a fila e corta o áudio que está tocando"""
+        self._interrompido.set()
+        while True:
+            try:
+                self._fila.get_nowait()
+                self._fila.task_done()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._matar_processo()
+            self._fim_previsto = 0.0
+
+    def fechar(self):
+        self.interromper()
+        if self._thread is not None:
+            self._fila.put(None)
+
+    def _matar_processo(self):
+        if self._processo is not None and self._processo.poll() is None:
+            try:
+                self._processo.kill()
+                self._processo.wait(timeout=1)
+            except Exception:
+                pass
+        self._processo = None
+
+    def _abrir_processo(self, player=None):
+        _, cmd, _ = player or self.player
+        self._processo = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                          stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL)
+
+    def _trabalhar(self):
+        while True:
+            dados = self._fila.get()
+            try:
+                if dados is None:
+                    with self._lock:
+                        self._matar_processo()
+                    return
+                self._interrompido.clear()
+                # Só envia o próximo item perto do fim do atual, para que interromper()
+                # não tenha muito áudio já entregue ao player. O WAV vai para outro
+                # processo, então espera o atual acabar de vez.
+                wav = dados[:4] == b'RIFF'
+                espera = self._fim_previsto - (0 if wav else self.antecedencia) - time.time()
+                if espera > 0 and self._interrompido.wait(espera):
+                    continue
+                self._enviar(dados)
+            except Exception as e:
+                print(f"⚠️ Erro no áudio: {e}")
+            finally:
+                self._fila.task_done()
+
+    def _enviar(self, dados):
+        player = self.player
+        if dados[:4] == b'RIFF' and player[2]:
+            player = self.player_wav
+            if player is None:
+                return  # só há player de MP3
+        _, _, persistente = player
+        duracao = duracao_audio(dados)
+        if not persistente:
+            with self._lock:
+                self._abrir_processo(player)
+                processo = self._processo
+                self._fim_previsto = time.time() + duracao
+            try:
+                processo.communicate(dados, timeout=max(30, duracao * 2))
+            except Exception:
+                with self._lock:
+                    self._matar_processo()
+            return
+        for tentativa in range(2):
+            with self._lock:
+                if self._processo is None or self._processo.poll() is not None:
+                    self._abrir_processo()
+                processo = self._processo
+            try:
+                processo.stdin.write(dados)
+                processo.stdin.flush()
+                break
+            except (BrokenPipeError, OSError, ValueError):
+                with self._lock:
+                    self._matar_processo()  # player morreu: reabre e tenta de novo
+        with self._lock:
+            self._fim_previsto = max(time.time(), self._fim_previsto) + duracao
+
+
+# ---------- FALA EM PIPELINE ----------
+class PipelineFala:
+    """Produtor de fala: um worker sintetiza as frases em ordem e as entrega ao serviço de
+    reprodução, então a frase N+1 é sintetizada enquanto a frase N toca.
+
+    sintetizar(frase, urgente) devolve os bytes do áudio (vazios: nada a tocar). falar()
+    retorna na hora; o tempo até o primeiro áudio depende só da primeira frase.
+    """
+
+    def __init__(self, sintetizar, servico, profundidade=2):
+        self.sintetizar = sintetizar
+        self.servico = servico
+        self.profundidade = profundidade
+        self._frases = queue.Queue()
+        self._geracao = 0
+        self._thread = None
+
+    def falar(self, frases, bloquear=False, urgente=False):
+        if not self.servico.disponivel:
+            return False
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._trabalhar, daemon=True)
+            self._thread.start()
+        for frase in frases:
+            self._frases.put((self._geracao, frase, urgente))
+        if bloquear:
+            self.esperar()
+        return True
+
+    def esperar(self, timeout=None):
+        """Bloqueia até todas as frases enfileiradas terem sido tocadas"""
+        limite = None if timeout is None else time.time() + timeout
+        while self._frases.unfinished_tasks:
+            if limite is not None and time.time() >= limite:
+                return False
+            time.sleep(0.02)
+        return self.servico.esperar(None if limite is None else max(0.0, limite - time.time()))
+
+    def ocupado(self):
+        """True enquanto há frase por sintetizar ou áudio tocando"""
+        return bool(self._frases.unfinished_tasks) or self.servico.pendentes() > 0
+
+    def interromper(self):
+        """Descarta as frases pendentes e corta o áudio em andamento"""
+        self._geracao += 1
+        while True:
+            try:
+                self._frases.get_nowait()
+                self._frases.task_done()
+            except queue.Empty:
+                break
+        self.servico.interromper()
+
+    def _trabalhar(self):
+        while True:
+            geracao, frase, urgente = self._frases.get()
+            try:
+                # Não sintetiza muito à frente do que está tocando
+                while geracao == self._geracao and self.servico.pendentes() >= self.profundidade:
+                    time.sleep(0.02)
+                if geracao != self._geracao:
+                    continue
+                dados = self.sintetizar(frase, urgente)
+                if dados and geracao == self._geracao:
+                    self.servico.tocar(dados)
+            except Exception as e:
+                print(f"⚠️ Erro no áudio: {e}")
+            finally:
+                self._frases.task_done()
+
+
+class FalaDesligada:
+    """No lugar do PipelineFala quando o assistente roda sem áudio (modo lote): nada é
+    sintetizado nem tocado, a fala fica só no texto"""
+
+    def falar(self, frases, bloquear=False, urgente=False):
+        return False
+
+    def esperar(self, timeout=None):
+        return True
+
+    def ocupado(self):
+        return False
+
+    def interromper(self):
+        pass
+
+
+class FalaIncremental:
+    """Acumula tokens de uma resposta em streaming e entrega cada frase completa
+    ao callback assim que ela termina"""
+
+    _FIM_FRASE = re.compile(r'[.!?…;:](?=\s)|\n')
+
+    def __init__(self, falar_frases):
+        self.falar_frases = falar_frases
+        self._buffer = ""
+
+    def alimentar(self, token):
+        self._buffer += token
+        ultimo = None
+        for ultimo in self._FIM_FRASE.finditer(self._buffer):
+            pass
+        if ultimo is None:
+            return
+        pronto, self._buffer = self._buffer[:ultimo.end()], self._buffer[ultimo.end():]
+        frases = dividir_frases(pronto)
+        if frases:
+            self.falar_frases(frases)
+
+    def finalizar(self):
+        frases = dividir_frases(self._buffer)
+        self._buffer = ""
+        if frases:
+            self.falar_frases(frases)
+
+
+def _conteudo_delta(chunk):
+    """Extrai o texto de um chunk de streaming (objeto estilo OpenAI ou dict)"""
+    if isinstance(chunk, str):
+        return chunk
+    if isinstance(chunk, dict):
+        escolhas = chunk.get('choices') or [{}]
+        return (escolhas[0].get('delta') or escolhas[0].get('message') or {}).get('content') or ""
+    escolha = chunk.choices[0]
+    delta = getattr(escolha, 'delta', None) or getattr(escolha, 'message', None)
+    return getattr(delta, 'content', None) or ""
+
+
+# ---------- ESCUTA CONTÍNUA ----------
+def energia_rms(dados, largura=2):
+    """Energia RMS de um bloco de áudio PCM com sinal"""
+    amostras = array.array({1: 'b', 2: 'h', 4: 'i'}[largura], dados)
+    if not amostras:
+        return 0.0
+    return math.sqrt(sum(a * a for a in amostras) / len(amostras))
+
+
+def escolher_reconhecedor(recognizer, idioma='pt-BR'):
+    """(nome, reconhecer(audio) -> texto): um motor offline se estiver instalado, senão o Google"""
+    if hasattr(recognizer, 'recognize_vosk') and importlib.util.find_spec('vosk') and os.path.isdir('model'):
+        def vosk(audio):
+            return json.loads(recognizer.recognize_vosk(audio)).get('text', '')
+        return 'vosk (offline)', vosk
+    if hasattr(recognizer, 'recognize_whisper') and importlib.util.find_spec('whisper'):
+        return 'whisper (offline)', lambda audio: recognizer.recognize_whisper(
+            audio, model='base', language='portuguese')
+    return 'google', lambda audio: recognizer.recognize_google(audio, language=idioma)
+
+
+class OuvinteContinuo:
+    """Escuta o microfone o tempo todo numa thread própria, sem reabrir nem recalibrar.
+
+    Cada bloco passa por uma detecção de voz por energia: o piso de ruído acompanha o
+    ambiente (média móvel, bem mais lenta durante a fala) e fala é o que passa de
+    piso * fator + margem. Um buffer circular guarda o áudio logo antes do início, para a primeira
+    sílaba não se perder. Cada fala terminada vai para uma fila e é reconhecida por
+    outra thread enquanto a captura continua; os textos saem em self.textos.
+    """
+
+    def __init__(self, microfone, reconhecer, piso_inicial=300, fator=2.5, margem=50,
+                 antes_fala=0.3, silencio_fim=0.8, fala_minima=0.25, fala_maxima=10,
+                 adaptacao=0.05, silenciar=None):
+        self.microfone = microfone
+        self.reconhecer = reconhecer
+        self.piso = piso_inicial
+        self.fator = fator
+        self.margem = margem
+        self.antes_fala = antes_fala
+        self.silencio_fim = silencio_fim
+        self.fala_minima = fala_minima
+        self.fala_maxima = fala_maxima
+        self.adaptacao = adaptacao
+        self.silenciar = silenciar  # enquanto retornar True, o áudio é descartado (ex.: o assistente falando)
+        self.textos = queue.Queue()
+        self._falas = queue.Queue()
+        self._parar = threading.Event()
+        self._pausado = threading.Event()
+
+    @property
+    def limiar(self):
+        return self.piso * self.fator + self.margem
+
+    def iniciar(self):
+        for alvo in (self._capturar, self._reconhecer):
+            threading.Thread(target=alvo, daemon=True).start()
+
+    def pausar(self):
+        self._pausado.set()
+
+    def retomar(self):
+        self._pausado.clear()
+
+    def parar(self):
+        self._parar.set()
+        self._falas.put(None)
+
+    def obter(self, timeout=None):
+        """Próximo texto reconhecido, ou None se nada chegar no prazo"""
+        try:
+            return self.textos.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _capturar(self):
+        try:
+            with self.microfone as fonte:
+                self._laco_captura(fonte)
+        except Exception as e:
+            print(f"⚠️ Escuta contínua interrompida: {e}")
+
+    def _laco_captura(self, fonte):
+        taxa, largura, bloco = fonte.SAMPLE_RATE, fonte.SAMPLE_WIDTH, fonte.CHUNK
+        duracao_bloco = bloco / taxa
+        antes = deque(maxlen=max(1, round(self.antes_fala / duracao_bloco)))
+        fala, blocos_voz, silencio = [], 0, 0.0
+        while not self._parar.is_set():
+            dados = fonte.stream.read(bloco)
+            if self._pausado.is_set() or (self.silenciar and self.silenciar()):
+                # Descarta sem mexer no piso de ruído: a voz do assistente não é ambiente
+                antes.clear()
+                fala, blocos_voz, silencio = [], 0, 0.0
+                continue
+            energia = energia_rms(dados, largura)
+            if not fala:
+                if energia > self.limiar:
+                    fala, blocos_voz, silencio = list(antes) + [dados], 1, 0.0
+                else:
+                    self.piso += (energia - self.piso) * self.adaptacao
+                    antes.append(dados)
+                continue
+            fala.append(dados)
+            # Durante a fala o piso sobe devagar: uma fala de verdade quase não o mexe,
+            # mas um ruído alto e constante (ventilador, estação de solda) vira piso em segundos
+            self.piso += (energia - self.piso) * self.adaptacao / 10
+            if energia > self.limiar:
+                blocos_voz += 1
+                silencio = 0.0
+            else:
+                silencio += duracao_bloco
+            if silencio >= self.silencio_fim or len(fala) * duracao_bloco >= self.fala_maxima:
+                if blocos_voz * duracao_bloco >= self.fala_minima:
+                    self._falas.put(sr.AudioData(b"".join(fala), taxa, largura))
+                antes.clear()
+                fala, blocos_voz, silencio = [], 0, 0.0
+
+    def _reconhecer(self):
+        while True:
+            audio = self._falas.get()
+            if audio is None:
+                return
+            try:
+                texto = self.reconhecer(audio)
+            except sr.UnknownValueError:
+                continue  # ruído ou fala ininteligível
+            except Exception as e:
+                print(f"⚠️ Falha no reconhecimento de voz: {e}")
+                continue
+            if texto and texto.strip():
+                self.textos.put(texto.strip())
+
+
+# ---------- ENTRADA MULTIPLEXADA ----------
+class EntradaMultiplexada:
+    """Junta teclado e voz numa fila só: obter() devolve o que chegar primeiro.
+
+    O teclado é lido por uma thread com selectors sobre o descritor da entrada padrão
+    (os.read + decodificação incremental, para não ficar linha presa no buffer do
+    TextIOWrapper), o que permite parar a leitura. Onde o select não funciona com a
+    entrada (Windows, arquivo redirecionado), cai para readline bloqueante.
+    """
+
+    FIM = 'fim'  # origem do item emitido quando a entrada padrão fecha
+
+    def __init__(self, entrada=None):
+        self.entrada = entrada or sys.stdin
+        self.fila = queue.Queue()
+        self._parar = threading.Event()
+        self._teclado = None
+        self.fechada = False  # a entrada padrão chegou ao fim (EOF)
+
+    def iniciar(self):
+        if self._teclado is None:
+            self._teclado = threading.Thread(target=self._ler_teclado, daemon=True)
+            self._teclado.start()
+
+    def adicionar_fonte(self, origem, fila):
+        """Repassa para a fila comum tudo o que chegar em fila (ex.: textos do ouvinte)"""
+        def repassar():
+            while not self._parar.is_set():
+                try:
+                    texto = fila.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self.fila.put((origem, texto))
+        threading.Thread(target=repassar, daemon=True).start()
+
+    def obter(self, timeout=None):
+        """(origem, texto) do primeiro que chegar, ou (None, None) se o prazo acabar"""
+        self.iniciar()
+        try:
+            return self.fila.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+
+    def fechar(self):
+        self._parar.set()
+
+    def _ler_teclado(self):
+        try:
+            fd = self.entrada.fileno()
+            seletor = selectors.DefaultSelector()
+            seletor.register(fd, selectors.EVENT_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            self._ler_teclado_bloqueante()
+            return
+        decodificador = codecs.getincrementaldecoder(getattr(self.entrada, 'encoding', None) or 'utf-8')('replace')
+        pendente = ""
+        with seletor:
+            while not self._parar.is_set():
+                if not seletor.select(timeout=0.5):
+                    continue
+                bloco = os.read(fd, 4096)
+                if not bloco:
+                    break
+                pendente += decodificador.decode(bloco)
+                *linhas, pendente = pendente.split("\n")
+                for linha in linhas:
+                    self.fila.put(('teclado', linha.strip()))
+        if pendente.strip():
+            self.fila.put(('teclado', pendente.strip()))
+        self._fim()
+
+    def _ler_teclado_bloqueante(self):
+        for linha in self.entrada:
+            if self._parar.is_set():
+                return
+            self.fila.put(('teclado', linha.strip()))
+        self._fim()
+
+    def _fim(self):
+        if not self._parar.is_set():
+            self.fechada = True
+            self.fila.put((self.FIM, None))
+
+
+# ---------- BACKENDS DE LLM ----------
+class LLMIndisponivel(Exception):
+    """O serviço de LLM falhou depois das tentativas ou o disjuntor está aberto"""
+
+
+class _ErroTransitorio(Exception):
+    """Resposta HTTP que vale a pena tentar de novo (429/5xx)"""
+
+
+class Disjuntor:
+    """Circuit breaker: abre depois de N falhas seguidas e falha rápido até o tempo
+    de espera passar; então deixa uma chamada de teste decidir se fecha de novo"""
+
+    def __init__(self, limite_falhas=3, tempo_aberto=30.0):
+        self.limite_falhas = limite_falhas
+        self.tempo_aberto = tempo_aberto
+        self.falhas = 0
+        self.aberto_desde = None
+        self._testando = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self.aberto_desde is None:
+                return 'fechado'
+            if time.time() - self.aberto_desde >= self.tempo_aberto:
+                return 'meio_aberto'
+            return 'aberto'
+
+    def permitir(self):
+        with self._lock:
+            if self.aberto_desde is None:
+                return True
+            if time.time() - self.aberto_desde < self.tempo_aberto or self._testando:
+                return False
+            self._testando = True  # só uma chamada de teste por vez
+            return True
+
+    def sucesso(self):
+        with self._lock:
+            self.falhas = 0
+            self.aberto_desde = None
+            self._testando = False
+
+    def falha(self):
+        with self._lock:
+            self.falhas += 1
+            if self._testando or self.falhas >= self.limite_falhas:
+                self.aberto_desde = time.time()
+            self._testando = False
+
+
+class BackendLLM:
+    """Interface dos backends de LLM usados pelo assistente"""
+
+    def completar(self, messages, temperature=0.7, max_tokens=None, prazo=None):
+        """Retorna o texto completo da resposta"""
+        raise NotImplementedError
+
+    def stream(self, messages, temperature=0.7, max_tokens=None, prazo=None):
+        """Gera os tokens da resposta; por padrão entrega tudo de uma vez"""
+        yield self.completar(messages, temperature, max_tokens, prazo)
+
+
+class BackendHTTP(BackendLLM):
+    """Backend para APIs compatíveis com chat completions do OpenAI (Pollinations ou um
+    servidor local de teste), com sessão HTTP reaproveitada, prazo por chamada,
+    tentativas com backoff exponencial e jitter, e disjuntor"""
+
+    URL_PADRAO = "https://text.pollinations.ai/openai"
+
+    def __init__(self, url=None, modelo="openai", timeout_conexao=3.05, prazo_padrao=45.0,
+                 tentativas=3, backoff_base=0.5, backoff_max=4.0, disjuntor=None, tamanho_pool=8):
+        self.url = url or os.environ.get("BENCHVIS_LLM_URL") or self.URL_PADRAO
+        self.modelo = modelo
+        self.timeout_conexao = timeout_conexao
+        self.prazo_padrao = prazo_padrao
+        self.tentativas = tentativas
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.disjuntor = disjuntor or Disjuntor()
+        self.tamanho_pool = tamanho_pool
+        self._sessao = None
+        self._lock_sessao = threading.Lock()
+
+    @property
+    def sessao(self):
+        """Sessão HTTP com pool de conexões, criada no primeiro uso"""
+        with self._lock_sessao:
+            if self._sessao is None:
+                sessao = requests.Session()
+                adaptador = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.tamanho_pool)
+                sessao.mount("http://", adaptador)
+                sessao.mount("https://", adaptador)
+                self._sessao = sessao
+            return self._sessao
+
+    def _post(self, payload, limite):
+        """Resposta com o corpo ainda por ler (stream=True), para que _ate_o_prazo o limite;
+        com 2xx é a leitura do corpo que dá o veredito ao disjuntor"""
+        if not self.disjuntor.permitir():
+            raise LLMIndisponivel("serviço instável, usando respostas locais por enquanto")
+        # O disjuntor conta chamadas, não tentativas: uma chamada ruim sozinha não o abre.
+        # O finally garante que a chamada de teste (meio aberto) sempre devolve a vez
+        entregue = False
+        ultimo_erro = None
+        try:
+            for tentativa in range(self.tentativas):
+                restante = limite - time.time()
+                if restante <= 0:
+                    break
+                try:
+                    r = self.sessao.post(self.url, json=payload, stream=True,
+                                         timeout=(min(self.timeout_conexao, restante), restante))
+                    if r.status_code == 429 or r.status_code >= 500:
+                        r.close()
+                        raise _ErroTransitorio(f"HTTP {r.status_code}")
+                    entregue = True
+                    if r.status_code >= 400:
+                        self.disjuntor.sucesso()  # 4xx: o serviço está de pé, o pedido é que é ruim
+                        r.close()
+                        r.raise_for_status()
+                    return r
+                except requests.HTTPError:
+                    raise
+                except (requests.RequestException, _ErroTransitorio) as e:
+                    ultimo_erro = e
+                # Full jitter: espera aleatória até o teto exponencial, sem passar do prazo
+                espera = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** tentativa))
+                if time.time() + espera >= limite:
+                    break
+                time.sleep(espera)
+            raise LLMIndisponivel(f"sem resposta do LLM: {ultimo_erro or 'prazo esgotado'}")
+        finally:
+            if not entregue:
+                self.disjuntor.falha()
+
+    @contextlib.contextmanager
+    def _ate_o_prazo(self, r, limite):
+        """Fecha a resposta quando o prazo total acaba: o timeout de leitura vale para
+        cada leitura e não limita uma resposta que chega devagar. Conexão caída ou
+        prazo esgotado no meio do corpo contam como falha no disjuntor."""
+        expirou = threading.Event()
+
+        def cortar():
+            expirou.set()
+            r.close()
+        relogio = threading.Timer(max(0.0, limite - time.time()), cortar)
+        relogio.daemon = True
+        relogio.start()
+        servico_ok = True  # quem consome pode largar o stream no meio: o serviço não tem culpa
+        try:
+            yield
+        except Exception as e:
+            servico_ok = not isinstance(e, requests.RequestException)
+            if expirou.is_set():
+                raise LLMIndisponivel("prazo esgotado no meio da resposta") from e
+            raise
+        finally:
+            relogio.cancel()
+            if servico_ok and not expirou.is_set():
+                self.disjuntor.sucesso()
+            else:
+                self.disjuntor.falha()
+        if expirou.is_set():
+            raise LLMIndisponivel("prazo esgotado no meio da resposta")
+
+    def _payload(self, messages, temperature, max_tokens, stream):
+        payload = {"model": self.modelo, "messages": messages, "temperature": temperature}
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def completar(self, messages, temperature=0.7, max_tokens=None, prazo=None):
+        limite = time.time() + (prazo or self.prazo_padrao)
+        r = self._post(self._payload(messages, temperature, max_tokens, False), limite)
+        with r, self._ate_o_prazo(r, limite):
+            dados = r.json()
+        return dados["choices"][0]["message"]["content"]
+
+    def stream(self, messages, temperature=0.7, max_tokens=None, prazo=None):
+        limite = time.time() + (prazo or self.prazo_padrao)
+        r = self._post(self._payload(messages, temperature, max_tokens, True), limite)
+        with r, self._ate_o_prazo(r, limite):
+            if "text/event-stream" not in r.headers.get("Content-Type", ""):
+                yield _conteudo_delta(r.json())  # servidor ignorou o stream
+                return
+            for linha in r.iter_lines(decode_unicode=True):
+                if not linha or not linha.startswith("data:"):
+                    continue
+                dados = linha[5:].strip()
+                if dados == "[DONE]":
+                    break
+                token = _conteudo_delta(json.loads(dados))
+                if token:
+                    yield token
+
+
+# ---------- BANCO DE DADOS ----------
+# Migrações do schema em ordem; a versão aplicada fica em PRAGMA user_version.
+# Nunca edite uma migração já publicada: acrescente uma nova no fim.
+MIGRACOES = [
+    (1, '''
+        CREATE TABLE IF NOT EXISTS projetos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            descricao TEXT,
+            data_criacao TIMESTAMP,
+            status TEXT,
+            linguagem TEXT DEFAULT 'arduino'
+        );
+
+        CREATE TABLE IF NOT EXISTS componentes_projeto (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            projeto_id INTEGER,
+            componente TEXT,
+            quantidade INTEGER,
+            observacao TEXT,
+            FOREIGN KEY (projeto_id) REFERENCES projetos(id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS codigo_fonte (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            projeto_id INTEGER,
+            versao INTEGER,
+            codigo TEXT,
+            data_criacao TIMESTAMP,
+            linguagem TEXT,
+            FOREIGN KEY (projeto_id) REFERENCES projetos(id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS etapas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            projeto_id INTEGER,
+            ordem INTEGER,
+            descricao TEXT,
+            concluida BOOLEAN DEFAULT 0,
+            FOREIGN KEY (projeto_id) REFERENCES projetos(id) ON DELETE CASCADE
+        );
+    '''),
+    (2, '''
+        CREATE TABLE IF NOT EXISTS cache_llm (
+            chave TEXT PRIMARY KEY,
+            resposta TEXT NOT NULL,
+            tamanho INTEGER,
+            criado_em REAL,
+            acessado_em REAL,
+            hits INTEGER DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_cache_llm_acesso ON cache_llm (acessado_em);
+    '''),
+    (3, '''
+        -- Órfãos deixados enquanto foreign_keys estava desligado
+        DELETE FROM componentes_projeto WHERE projeto_id NOT IN (SELECT id FROM projetos);
+        DELETE FROM codigo_fonte WHERE projeto_id NOT IN (SELECT id FROM projetos);
+        DELETE FROM etapas WHERE projeto_id NOT IN (SELECT id FROM projetos);
+
+        CREATE INDEX IF NOT EXISTS idx_componentes_projeto ON componentes_projeto (projeto_id);
+        CREATE INDEX IF NOT EXISTS idx_codigo_fonte_projeto ON codigo_fonte (projeto_id, versao);
+        CREATE INDEX IF NOT EXISTS idx_etapas_projeto ON etapas (projeto_id, ordem);
+        CREATE INDEX IF NOT EXISTS idx_projetos_data ON projetos (data_criacao);
+    '''),
+    (4, '''
+        -- Índice de texto completo sobre projetos, componentes, código e etapas.
+        -- rowid = id de origem * 4 + tipo, para os triggers acharem a linha sem varrer o índice.
+        CREATE VIRTUAL TABLE IF NOT EXISTS busca USING fts5(
+            tipo UNINDEXED, projeto_id UNINDEXED, ref_id UNINDEXED, titulo, texto,
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+
+        INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            SELECT id * 4, 'projeto', id, id, nome, COALESCE(descricao, '') FROM projetos;
+        INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            SELECT id * 4 + 1, 'componente', projeto_id, id, COALESCE(componente, ''), COALESCE(observacao, '')
+            FROM componentes_projeto;
+        INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            SELECT id * 4 + 2, 'codigo', projeto_id, id, '', COALESCE(codigo, '') FROM codigo_fonte;
+        INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            SELECT id * 4 + 3, 'etapa', projeto_id, id, '', COALESCE(descricao, '') FROM etapas;
+
+        CREATE TRIGGER IF NOT EXISTS busca_projetos_ai AFTER INSERT ON projetos BEGIN
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4, 'projeto', new.id, new.id, new.nome, COALESCE(new.descricao, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_projetos_au AFTER UPDATE OF nome, descricao ON projetos BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4;
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4, 'projeto', new.id, new.id, new.nome, COALESCE(new.descricao, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_projetos_ad AFTER DELETE ON projetos BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS busca_componentes_ai AFTER INSERT ON componentes_projeto BEGIN
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 1, 'componente', new.projeto_id, new.id,
+                    COALESCE(new.componente, ''), COALESCE(new.observacao, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_componentes_au
+        AFTER UPDATE OF componente, observacao, projeto_id ON componentes_projeto BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 1;
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 1, 'componente', new.projeto_id, new.id,
+                    COALESCE(new.componente, ''), COALESCE(new.observacao, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_componentes_ad AFTER DELETE ON componentes_projeto BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS busca_codigo_ai AFTER INSERT ON codigo_fonte BEGIN
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 2, 'codigo', new.projeto_id, new.id, '', COALESCE(new.codigo, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_codigo_au AFTER UPDATE OF codigo, projeto_id ON codigo_fonte BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 2;
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 2, 'codigo', new.projeto_id, new.id, '', COALESCE(new.codigo, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_codigo_ad AFTER DELETE ON codigo_fonte BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 2;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS busca_etapas_ai AFTER INSERT ON etapas BEGIN
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 3, 'etapa', new.projeto_id, new.id, '', COALESCE(new.descricao, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_etapas_au AFTER UPDATE OF descricao, projeto_id ON etapas BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 3;
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 3, 'etapa', new.projeto_id, new.id, '', COALESCE(new.descricao, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_etapas_ad AFTER DELETE ON etapas BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 3;
+        END;
+    '''),
+    (5, '''
+        -- Conteúdo do código versionado, endereçado por hash: cada texto distinto é
+        -- gravado uma vez, comprimido inteiro ou como delta contra a versão base.
+        CREATE TABLE IF NOT EXISTS blobs_codigo (
+            hash TEXT PRIMARY KEY,
+            base TEXT,
+            profundidade INTEGER NOT NULL DEFAULT 0,
+            tamanho INTEGER NOT NULL,
+            dados BLOB NOT NULL
+        );
+        ALTER TABLE codigo_fonte ADD COLUMN hash TEXT;
+        CREATE INDEX IF NOT EXISTS idx_codigo_fonte_hash ON codigo_fonte (hash);
+
+        -- codigo_fonte.codigo passa a guardar só o texto da versão mais recente;
+        -- versões antigas ficam com NULL e saem do índice de busca.
+        DROP TRIGGER IF EXISTS busca_codigo_ai;
+        DROP TRIGGER IF EXISTS busca_codigo_au;
+        CREATE TRIGGER busca_codigo_ai AFTER INSERT ON codigo_fonte WHEN new.codigo IS NOT NULL BEGIN
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            VALUES (new.id * 4 + 2, 'codigo', new.projeto_id, new.id, '', new.codigo);
+        END;
+        CREATE TRIGGER busca_codigo_au AFTER UPDATE OF codigo, projeto_id ON codigo_fonte BEGIN
+            DELETE FROM busca WHERE rowid = old.id * 4 + 2;
+            INSERT INTO busca (rowid, tipo, projeto_id, ref_id, titulo, texto)
+            SELECT new.id * 4 + 2, 'codigo', new.projeto_id, new.id, '', new.codigo
+            WHERE new.codigo IS NOT NULL;
+        END;
+    '''),
+    (6, '''
+        -- Todas as trocas com a IA, para recuperar conversas antigas relevantes
+        CREATE TABLE IF NOT EXISTS conversas (
+            id INTEGER PRIMARY KEY,
+            data TIMESTAMP,
+            perfil TEXT,
+            usuario TEXT,
+            resposta TEXT
+        );
+        -- Índice externo: o texto fica só em conversas, o FTS5 guarda os termos
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversas_busca USING fts5(
+            usuario, resposta, content = 'conversas', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        -- Em quantas conversas cada termo aparece, para descartar os que não distinguem nada
+        CREATE TABLE IF NOT EXISTS conversas_termos (
+            termo TEXT PRIMARY KEY,
+            conversas INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS conversas_busca_ai AFTER INSERT ON conversas BEGIN
+            INSERT INTO conversas_busca (rowid, usuario, resposta) VALUES (new.id, new.usuario, new.resposta);
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversas_busca_ad AFTER DELETE ON conversas BEGIN
+            INSERT INTO conversas_busca (conversas_busca, rowid, usuario, resposta)
+            VALUES ('delete', old.id, old.usuario, old.resposta);
+        END;
+    '''),
+    (7, '''
+        -- De quem é cada troca: NULL no terminal, um identificador por sessão do servidor
+        ALTER TABLE conversas ADD COLUMN sessao TEXT;
+        CREATE INDEX IF NOT EXISTS conversas_sessao ON conversas (sessao, id);
+    '''),
+]
+
+# Ajustes aplicados a toda conexão aberta
+PRAGMAS_CONEXAO = [
+    "PRAGMA foreign_keys = ON",     # faz valer os ON DELETE CASCADE
+    "PRAGMA synchronous = NORMAL",  # seguro com WAL e bem mais barato por commit
+    "PRAGMA cache_size = -16000",   # ~16 MB de cache de páginas
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+]
+
+
+def consulta_fts(termo):
+    """Transforma o texto digitado numa consulta FTS5 segura: cada palavra vira um
+    prefixo entre aspas e todas precisam aparecer"""
+    palavras = re.findall(r'\w+', termo, re.UNICODE)
+    return " ".join(f'"{p}"*' for p in palavras)
+
+
+def abrir_banco(caminho='benchvis.db'):
+    """Abre uma conexão com WAL e os pragmas de desempenho/integridade"""
+    conn = sqlite3.connect(caminho, check_same_thread=False)
+    if caminho != ':memory:':
+        conn.execute("PRAGMA journal_mode = WAL")
+    for pragma in PRAGMAS_CONEXAO:
+        conn.execute(pragma)
+    return conn
+
+
+def migrar(conn, ate=None):
+    """Aplica, cada uma numa transação, as migrações ainda não aplicadas; retorna a versão final"""
+    versao = conn.execute("PRAGMA user_version").fetchone()[0]
+    for numero, script in MIGRACOES:
+        if numero <= versao or (ate is not None and numero > ate):
+            continue
+        try:
+            conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {numero};\nCOMMIT;")
+        except Exception:
+            conn.rollback()
+            raise
+        versao = numero
+    return versao
+
+
+class PoolBanco:
+    """Acesso concorrente ao banco: uma conexão de leitura por thread e uma thread
+    escritora dedicada que agrupa as escritas enfileiradas em uma só transação.
+
+    Cada escrita devolve um Future, resolvido só depois do COMMIT do lote; uma escrita
+    que falha é desfeita sozinha (SAVEPOINT) sem derrubar as outras do lote.
+    """
+
+    _FIM = object()
+    _MANUTENCAO = object()
+
+    def __init__(self, caminho='benchvis.db', max_lote=128):
+        self.caminho = caminho
+        self.max_lote = max_lote
+        self._local = threading.local()
+        self._leitores = []
+        self._lock = threading.Lock()
+        self._fila = queue.Queue()
+        self._fechado = False
+        self._escritor = abrir_banco(caminho)
+        self._escritor.isolation_level = None  # transações controladas à mão
+        migrar(self._escritor)
+        self._thread = threading.Thread(target=self._escrever, daemon=True)
+        self._thread.start()
+
+    # ----- leitura -----
+    def _conexao_leitura(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = abrir_banco(self.caminho)
+            self._local.conn = conn
+            with self._lock:
+                self._leitores.append(conn)
+        return conn
+
+    def ler(self, sql, params=()):
+        return self._conexao_leitura().execute(sql, params).fetchall()
+
+    def ler_um(self, sql, params=()):
+        return self._conexao_leitura().execute(sql, params).fetchone()
+
+    def iterar(self, sql, params=(), tamanho_lote=500):
+        """Gera as linhas em lotes, sem carregar o resultado inteiro na memória"""
+        cur = self._conexao_leitura().execute(sql, params)
+        while True:
+            linhas = cur.fetchmany(tamanho_lote)
+            if not linhas:
+                return
+            yield from linhas
+
+    # ----- escrita -----
+    def executar(self, sql, params=()):
+        """Enfileira um comando; o Future resolve para (lastrowid, rowcount)"""
+        def comando(conn):
+            cur = conn.execute(sql, params)
+            return cur.lastrowid, cur.rowcount
+        return self.escrever(comando)
+
+    def escrever(self, funcao):
+        """Enfileira funcao(conn), executada na thread escritora dentro de uma transação"""
+        futuro = concurrent.futures.Future()
+        self._enfileirar((funcao, futuro))
+        return futuro
+
+    def manutencao(self, fracao_livre=0.25):
+        """Enfileira PRAGMA optimize, VACUUM (se mais de fracao_livre das páginas estiverem
+        livres) e checkpoint do WAL; roda na thread escritora, fora de transação.
+        O Future resolve para {'vacuum': bool, 'paginas': n, 'livres': n}"""
+        futuro = concurrent.futures.Future()
+        self._enfileirar((self._MANUTENCAO, futuro, fracao_livre))
+        return futuro
+
+    def _enfileirar(self, item):
+        """Depois de fechar() o Future já nasce com erro, em vez de nunca resolver"""
+        with self._lock:
+            if not self._fechado:
+                self._fila.put(item)
+                return
+        item[1].set_exception(RuntimeError("banco fechado"))
+
+    def fechar(self):
+        with self._lock:
+            if self._fechado:
+                return
+            self._fechado = True
+            self._fila.put(self._FIM)
+        self._thread.join(timeout=5)
+        with self._lock:
+            for conn in self._leitores:
+                conn.close()
+            self._leitores.clear()
+
+    def _escrever(self):
+        conn = self._escritor
+        while True:
+            lote = [self._fila.get()]
+            while len(lote) < self.max_lote:
+                try:
+                    lote.append(self._fila.get_nowait())
+                except queue.Empty:
+                    break
+            fim = any(item is self._FIM for item in lote)
+            lote = [item for item in lote if item is not self._FIM]
+            manutencoes = [item for item in lote if item[0] is self._MANUTENCAO]
+            lote = [item for item in lote if item[0] is not self._MANUTENCAO]
+            resultados = []
+            if lote:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for funcao, futuro in lote:
+                        conn.execute("SAVEPOINT escrita")
+                        try:
+                            resultados.append((futuro, funcao(conn), None))
+                            conn.execute("RELEASE escrita")
+                        except Exception as e:
+                            conn.execute("ROLLBACK TO escrita")
+                            conn.execute("RELEASE escrita")
+                            resultados.append((futuro, None, e))
+                    conn.execute("COMMIT")
+                except Exception as e:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    resultados = [(futuro, None, e) for _, futuro in lote]
+                for futuro, valor, erro in resultados:
+                    if erro is not None:
+                        futuro.set_exception(erro)
+                    else:
+                        futuro.set_result(valor)
+            for _, futuro, fracao_livre in manutencoes:
+                try:
+                    futuro.set_result(self._manter(conn, fracao_livre))
+                except Exception as e:
+                    futuro.set_exception(e)
+            if fim:
+                conn.close()
+                self._descartar_pendentes()
+                return
+
+    def _descartar_pendentes(self):
+        """Falha o que sobrou na fila depois do último lote"""
+        while True:
+            try:
+                item = self._fila.get_nowait()
+            except queue.Empty:
+                return
+            if item is not self._FIM:
+                item[1].set_exception(RuntimeError("banco fechado"))
+
+    @staticmethod
+    def _manter(conn, fracao_livre):
+        conn.execute("PRAGMA optimize")
+        paginas = conn.execute("PRAGMA page_count").fetchone()[0]
+        livres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        vacuum = paginas > 0 and livres / paginas > fracao_livre
+        if vacuum:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {'vacuum': vacuum, 'paginas': paginas, 'livres': livres}
+
+
+# ---------- CACHE DE RESPOSTAS ----------
+class CacheRespostas:
+    """Cache de respostas do LLM na tabela cache_llm do benchvis.db.
+
+    A chave é o hash de (modelo, temperatura, mensagens); entradas vencem depois do TTL
+    e as menos usadas recentemente saem quando o total passa do limite de bytes.
+    """
+
+    def __init__(self, db, ttl=7 * 24 * 3600, limite_bytes=5 * 1024 * 1024):
+        self.db = db
+        self.ttl = ttl
+        self.limite_bytes = limite_bytes
+        self.acertos = 0
+        self.falhas = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chave(modelo, temperature, messages):
+        bruto = json.dumps([modelo, temperature, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(bruto.encode('utf-8')).hexdigest()
+
+    def obter(self, chave):
+        agora = time.time()
+        linha = self.db.ler_um('SELECT resposta, criado_em FROM cache_llm WHERE chave = ?', (chave,))
+        if linha is None or agora - linha[1] > self.ttl:
+            if linha is not None:
+                self.db.executar('DELETE FROM cache_llm WHERE chave = ?', (chave,))
+            with self._lock:
+                self.falhas += 1
+            return None
+        # A contagem de uso vai pela fila de escrita, sem segurar quem pediu
+        self.db.executar('UPDATE cache_llm SET acessado_em = ?, hits = hits + 1 WHERE chave = ?',
+                         (agora, chave))
+        with self._lock:
+            self.acertos += 1
+        return linha[0]
+
+    def guardar(self, chave, resposta):
+        agora = time.time()
+        tamanho = len(resposta.encode('utf-8'))
+
+        def gravar(conn):
+            conn.execute('''
+                INSERT OR REPLACE INTO cache_llm (chave, resposta, tamanho, criado_em, acessado_em, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            ''', (chave, resposta, tamanho, agora, agora))
+            self._despejar(conn, agora)
+        return self.db.escrever(gravar)
+
+    def despejar(self):
+        """Remove as entradas vencidas e as que passam do limite; retorna um Future"""
+        return self.db.escrever(lambda conn: self._despejar(conn, time.time()))
+
+    def _despejar(self, conn, agora):
+        conn.execute('DELETE FROM cache_llm WHERE criado_em < ?', (agora - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(tamanho), 0) FROM cache_llm').fetchone()[0]
+        if total <= self.limite_bytes:
+            return
+        for chave, tamanho in conn.execute(
+                'SELECT chave, tamanho FROM cache_llm ORDER BY acessado_em').fetchall():
+            conn.execute('DELETE FROM cache_llm WHERE chave = ?', (chave,))
+            total -= tamanho
+            if total <= self.limite_bytes:
+                break
+
+    def estatisticas(self):
+        itens, total, hits = self.db.ler_um(
+            'SELECT COUNT(*), COALESCE(SUM(tamanho), 0), COALESCE(SUM(hits), 0) FROM cache_llm')
+        consultas = self.acertos + self.falhas
+        return {
+            'itens': itens,
+            'bytes': total,
+            'acertos': self.acertos,
+            'falhas': self.falhas,
+            'taxa_acerto': self.acertos / consultas if consultas else 0.0,
+            'acertos_total': hits,
+        }
+
+
+# ---------- VERSÕES DE CÓDIGO ----------
+def delta_linhas(base, novo):
+    """Delta de linhas de base para novo: [i, j] copia base[i:j], uma string é linha nova"""
+    a = base.splitlines(keepends=True)
+    b = novo.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        else:
+            ops.extend(b[j1:j2])
+    return ops
+
+
+def aplicar_delta(base, ops):
+    linhas = base.splitlines(keepends=True)
+    return ''.join(''.join(linhas[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+class RepositorioCodigo:
+    """Histórico de versões do código de cada projeto (tabelas codigo_fonte e blobs_codigo).
+
+    Textos iguais são gravados uma vez só (hash sha256). Uma versão nova é guardada
+    como delta comprimido contra a anterior do mesmo projeto; a cada snapshot_cada
+    deltas seguidos vai o texto inteiro, para a reconstrução não ficar longa demais.
+    """
+
+    def __init__(self, db, snapshot_cada=16):
+        self.db = db
+        self.snapshot_cada = snapshot_cada
+
+    @staticmethod
+    def hash(codigo):
+        return hashlib.sha256(codigo.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _reconstruir(ler, hash_codigo):
+        """Remonta o texto seguindo a cadeia de bases até o snapshot completo"""
+        cadeia = ler('''
+            WITH RECURSIVE cadeia (hash, base, dados, nivel) AS (
+                SELECT hash, base, dados, 0 FROM blobs_codigo WHERE hash = ?
+                UNION ALL
+                SELECT b.hash, b.base, b.dados, c.nivel + 1
+                FROM blobs_codigo b JOIN cadeia c ON b.hash = c.base
+            )
+            SELECT base, dados FROM cadeia ORDER BY nivel DESC
+        ''', (hash_codigo,))
+        if not cadeia:
+            raise KeyError(hash_codigo)
+        texto = None
+        for base, dados in cadeia:
+            bruto = zlib.decompress(dados).decode('utf-8')
+            texto = bruto if base is None else aplicar_delta(texto, json.loads(bruto))
+        return texto
+
+    def salvar(self, projeto_id, codigo, linguagem=None):
+        """Grava uma versão nova. O Future resolve para (versao, nova); se o código for
+        igual ao da última versão, nada é gravado e nova é False."""
+        hash_codigo = self.hash(codigo)
+
+        def gravar(conn):
+            def ler(sql, params=()):
+                return conn.execute(sql, params).fetchall()
+            ultima = conn.execute('''
+                SELECT id, versao, hash, codigo FROM codigo_fonte
+                WHERE projeto_id = ? ORDER BY versao DESC LIMIT 1
+            ''', (projeto_id,)).fetchone()
+            if ultima is not None and ultima[2] == hash_codigo:
+                return ultima[1], False
+
+            existe = conn.execute('SELECT 1 FROM blobs_codigo WHERE hash = ?', (hash_codigo,)).fetchone()
+            if existe is None:
+                self._gravar_blob(conn, ler, hash_codigo, codigo, ultima)
+
+            versao = (ultima[1] or 0) + 1 if ultima is not None else 1
+            if ultima is not None and ultima[2] is not None and ultima[3] is not None:
+                conn.execute('UPDATE codigo_fonte SET codigo = NULL WHERE id = ?', (ultima[0],))
+            conn.execute('''
+                INSERT INTO codigo_fonte (projeto_id, versao, codigo, data_criacao, linguagem, hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (projeto_id, versao, codigo, datetime.datetime.now(), linguagem, hash_codigo))
+            return versao, True
+        return self.db.escrever(gravar)
+
+    def _gravar_blob(self, conn, ler, hash_codigo, codigo, ultima):
+        completo = zlib.compress(codigo.encode('utf-8'), 9)
+        base, profundidade, dados = None, 0, completo
+        if ultima is not None and ultima[2] is not None:
+            linha = conn.execute('SELECT profundidade FROM blobs_codigo WHERE hash = ?', (ultima[2],)).fetchone()
+            if linha is not None and linha[0] + 1 < self.snapshot_cada:
+                anterior = ultima[3] if ultima[3] is not None else self._reconstruir(ler, ultima[2])
+                ops = delta_linhas(anterior, codigo)
+                delta = zlib.compress(json.dumps(ops, ensure_ascii=False).encode('utf-8'), 9)
+                if len(delta) < len(completo):
+                    base, profundidade, dados = ultima[2], linha[0] + 1, delta
+        conn.execute('''
+            INSERT INTO blobs_codigo (hash, base, profundidade, tamanho, dados) VALUES (?, ?, ?, ?, ?)
+        ''', (hash_codigo, base, profundidade, len(codigo.encode('utf-8')), dados))
+
+    def obter(self, projeto_id, versao=None):
+        """Texto de uma versão (a mais recente se versao for None), ou None"""
+        if versao is None:
+            linha = self.db.ler_um('''
+                SELECT codigo, hash, versao FROM codigo_fonte WHERE projeto_id = ?
+                ORDER BY versao DESC LIMIT 1
+            ''', (projeto_id,))
+        else:
+            linha = self.db.ler_um('''
+                SELECT codigo, hash, versao FROM codigo_fonte WHERE projeto_id = ? AND versao = ?
+            ''', (projeto_id, versao))
+        if linha is None:
+            return None
+        codigo, hash_codigo, _ = linha
+        if codigo is not None or hash_codigo is None:
+            return codigo
+        return self._reconstruir(self.db.ler, hash_codigo)
+
+    def historico(self, projeto_id):
+        """(versao, data_criacao, linguagem, tamanho, bytes_gravados, tipo) por versão;
+        bytes_gravados é 0 quando o conteúdo reaproveita um blob de versão anterior"""
+        linhas = self.db.ler('''
+            SELECT c.versao, c.data_criacao, c.linguagem, c.hash, b.tamanho, length(b.dados), b.base,
+                   (SELECT MIN(c2.id) FROM codigo_fonte c2 WHERE c2.hash = c.hash) = c.id
+            FROM codigo_fonte c LEFT JOIN blobs_codigo b ON b.hash = c.hash
+            WHERE c.projeto_id = ? ORDER BY c.versao
+        ''', (projeto_id,))
+        historico = []
+        for versao, data, linguagem, hash_codigo, tamanho, gravados, base, primeiro in linhas:
+            if hash_codigo is None:
+                historico.append((versao, data, linguagem, None, None, 'legado'))
+            elif not primeiro:
+                historico.append((versao, data, linguagem, tamanho, 0, 'repetida'))
+            else:
+                historico.append((versao, data, linguagem, tamanho, gravados,
+                                  'completa' if base is None else 'delta'))
+        return historico
+
+    def diff(self, projeto_id, de, para):
+        """Diff unificado entre duas versões, ou None se alguma não existir"""
+        antes, depois = self.obter(projeto_id, de), self.obter(projeto_id, para)
+        if antes is None or depois is None:
+            return None
+        return ''.join(difflib.unified_diff(
+            antes.splitlines(keepends=True), depois.splitlines(keepends=True),
+            fromfile=f'projeto {projeto_id} v{de}', tofile=f'projeto {projeto_id} v{para}'))
+
+    def coletar_lixo(self):
+        """Remove blobs que nenhuma versão usa, direta ou indiretamente (como base de delta)"""
+        return self.db.executar('''
+            WITH RECURSIVE vivos (hash) AS (
+                SELECT hash FROM codigo_fonte WHERE hash IS NOT NULL
+                UNION
+                SELECT b.base FROM blobs_codigo b JOIN vivos v ON b.hash = v.hash
+                WHERE b.base IS NOT NULL
+            )
+            DELETE FROM blobs_codigo WHERE hash NOT IN (SELECT hash FROM vivos)
+        ''')
+
+
+# ---------- MEMÓRIA DE CONVERSAS ----------
+# Palavras comuns demais para dizer algo sobre o assunto da conversa
+PALAVRAS_VAZIAS = set("""
+a o as os um uma uns umas de do da dos das em no na nos nas por pelo pela para pra com sem
+e ou mas que se como qual quais quando onde porque porquê quem cujo ao aos à às é ser são
+foi era tem ter há eu tu ele ela nós vós eles elas você vocês me te lhe nos meu minha seu sua
+isso isto esse essa este esta aquilo aquele aquela não sim já mais muito pouco também só
+então ainda bem vai vou estou está estão faz fazer pode posso quero sobre até the and of to
+""".split())
+
+
+def termos_relevantes(texto):
+    """Termos significativos do texto, já na forma do índice (minúsculas, sem acento)"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    termos = []
+    # Letras e dígitos, como o tokenizador unicode61 (o '_' separa palavras lá também)
+    for palavra in re.findall(r'[^\W_]+', texto, re.UNICODE):
+        if len(palavra) > 1 and palavra not in PALAVRAS_VAZIAS and palavra not in termos:
+            termos.append(palavra)
+    return termos
+
+
+def consulta_relevancia(termos):
+    """Consulta FTS5 que aceita conversas com qualquer um dos termos"""
+    return " OR ".join(f'"{t}"' for t in termos)
+
+
+class MemoriaConversas:
+    """Arquivo de todas as trocas com a IA (tabela conversas), com índice FTS5.
+
+    Em vez de mandar o histórico bruto, processar_comando_ia pede os k trechos
+    mais parecidos com a pergunta atual (bm25, a fala do usuário pesando mais).
+    O índice é atualizado por trigger a cada troca gravada. Cada troca pertence a
+    uma sessão (None é o terminal) e só é recuperada na mesma sessão.
+    """
+
+    def __init__(self, db, k=3, max_chars_trecho=300, max_termos=6, fracao_comum=0.05, minimo_comum=200):
+        self.db = db
+        self.k = k
+        self.max_chars_trecho = max_chars_trecho
+        # Só os termos mais raros entram na consulta; um termo presente em mais de
+        # max(minimo_comum, fracao_comum * total) conversas quase não pesa no bm25 e
+        # obrigaria a pontuar boa parte do arquivo
+        self.max_termos = max_termos
+        self.fracao_comum = fracao_comum
+        self.minimo_comum = minimo_comum
+
+    def registrar(self, data, perfil, usuario, resposta, sessao=None):
+        """Grava a troca e conta seus termos; o Future resolve para o id da conversa"""
+        termos = termos_relevantes(f"{usuario}\n{resposta}")
+
+        def gravar(conn):
+            cur = conn.execute('INSERT INTO conversas (data, perfil, usuario, resposta, sessao) '
+                               'VALUES (?, ?, ?, ?, ?)', (data, perfil, usuario, resposta, sessao))
+            conn.executemany('''
+                INSERT INTO conversas_termos (termo, conversas) VALUES (?, 1)
+                ON CONFLICT (termo) DO UPDATE SET conversas = conversas + 1
+            ''', ((t,) for t in termos))
+            return cur.lastrowid
+        return self.db.escrever(gravar)
+
+    def total(self):
+        # ids só crescem e conversas não são apagadas: MAX(id) é o total sem varrer a tabela
+        return self.db.ler_um('SELECT COALESCE(MAX(id), 0) FROM conversas')[0]
+
+    def relevantes(self, texto, k=None, ignorar_ultimas=0, sessao=None):
+        """As k trocas da sessão mais relevantes para o texto, da mais para a menos
+        relevante. ignorar_ultimas pula as trocas mais recentes da sessão (que ainda
+        estão no contexto)."""
+        termos = termos_relevantes(texto)
+        if not termos:
+            return []
+        marcas = ", ".join("?" * len(termos))
+        frequencia = dict(self.db.ler(
+            f'SELECT termo, conversas FROM conversas_termos WHERE termo IN ({marcas})', termos))
+        limite = max(self.minimo_comum, self.fracao_comum * self.total())
+        termos = sorted((t for t in termos if 0 < frequencia.get(t, 0) <= limite), key=frequencia.get)
+        if not termos:
+            return []
+        # Maior id elegível: o anterior às ignorar_ultimas trocas mais recentes da sessão
+        ultimo = self.db.ler_um('''
+            SELECT id FROM conversas WHERE sessao IS ? ORDER BY id DESC LIMIT 1 OFFSET ?
+        ''', (sessao, ignorar_ultimas))
+        if ultimo is None:
+            return []
+        consulta = consulta_relevancia(termos[:self.max_termos])
+        return self.db.ler('''
+            SELECT c.id, c.data, c.perfil, c.usuario, c.resposta
+            FROM conversas_busca
+            JOIN conversas c ON c.id = conversas_busca.rowid
+            WHERE conversas_busca MATCH ? AND c.sessao IS ? AND c.id <= ?
+            ORDER BY bm25(conversas_busca, 2.0, 1.0) LIMIT ?
+        ''', (consulta, sessao, ultimo[0], k or self.k))
+
+    def trechos(self, texto, k=None, ignorar_ultimas=0, sessao=None):
+        """Texto pronto para o prompt de sistema, ou "" se nada relevante foi achado"""
+        linhas = []
+        for _, data, perfil, usuario, resposta in self.relevantes(texto, k, ignorar_ultimas, sessao):
+            linhas.append(f"- [{str(data)[:10]}, perfil {perfil}] Usuário: {self._cortar(usuario)} "
+                          f"| Assistente: {self._cortar(resposta)}")
+        if not linhas:
+            return ""
+        return "Trechos de conversas anteriores que podem ser relevantes:\n" + "\n".join(linhas) + "\n"
+
+    def _cortar(self, texto):
+        texto = " ".join(texto.split())
+        if len(texto) > self.max_chars_trecho:
+            texto = texto[:self.max_chars_trecho - 3].rstrip() + "..."
+        return texto
+
+
+# ---------- GERAÇÃO DE IMAGENS ----------
+class FilaImagensCheia(Exception):
+    """Já há pedidos demais esperando na fila de imagens"""
+
+
+class BackendImagem:
+    """Interface dos geradores de imagem: gerar(...) -> bytes do arquivo (PNG/JPEG).
+
+    progresso, se dado, recebe a fração concluída (0 a 1) durante a geração.
+    """
+
+    nome = 'base'
+    extensao = '.png'
+
+    def gerar(self, prompt, largura, altura, semente, progresso=None):
+        raise NotImplementedError
+
+
+class BackendImagemHTTP(BackendImagem):
+    """Gerador remoto por GET (API de imagens do Pollinations por padrão), baixado em pedaços"""
+
+    nome = 'pollinations'
+    extensao = '.jpg'
+
+    def __init__(self, url=None, modelo='flux', timeout=120):
+        self.url = url or os.environ.get('BENCHVIS_IMAGEM_URL', 'https://image.pollinations.ai/prompt/')
+        self.modelo = modelo
+        self.timeout = timeout
+
+    def gerar(self, prompt, largura, altura, semente, progresso=None):
+        url = self.url + urllib.parse.quote(prompt, safe='')
+        params = {'width': largura, 'height': altura, 'seed': semente, 'model': self.modelo, 'nologo': 'true'}
+        with requests.get(url, params=params, stream=True, timeout=(3.05, self.timeout)) as r:
+            r.raise_for_status()
+            total = int(r.headers.get('Content-Length') or 0)
+            partes = []
+            recebidos = 0
+            for pedaco in r.iter_content(64 * 1024):
+                partes.append(pedaco)
+                recebidos += len(pedaco)
+                if progresso and total:
+                    progresso(min(recebidos / total, 1.0))
+        return b"".join(partes)
+
+
+class BackendImagemLocal(BackendImagem):
+    """Gerador local sem rede: um PNG em faixas de cor derivadas do prompt e da semente.
+
+    Determinístico, serve para testar a fila e o cache; atraso simula o tempo de geração.
+    """
+
+    nome = 'local'
+
+    def __init__(self, atraso=0.0, etapas=10):
+        self.atraso = atraso
+        self.etapas = etapas
+        self.geradas = 0
+
+    def gerar(self, prompt, largura, altura, semente, progresso=None):
+        semente_cor = hashlib.sha256(f"{prompt}|{semente}".encode('utf-8')).digest()
+        inicio, fim = semente_cor[:3], semente_cor[3:6]
+        linhas = []
+        for y in range(altura):
+            t = y / max(altura - 1, 1)
+            cor = bytes(int(a + (b - a) * t) for a, b in zip(inicio, fim))
+            linhas.append(b"\x00" + cor * largura)
+        for etapa in range(1, self.etapas + 1):
+            time.sleep(self.atraso / self.etapas)
+            if progresso:
+                progresso(etapa / self.etapas)
+        self.geradas += 1
+
+        def bloco(tipo, dados):
+            corpo = tipo + dados
+            return struct.pack('>I', len(dados)) + corpo + struct.pack('>I', zlib.crc32(corpo))
+        cabecalho = struct.pack('>IIBBBBB', largura, altura, 8, 2, 0, 0, 0)  # RGB de 8 bits
+        return (b"\x89PNG\r\n\x1a\n" + bloco(b'IHDR', cabecalho)
+                + bloco(b'IDAT', zlib.compress(b"".join(linhas))) + bloco(b'IEND', b""))
+
+
+class CacheImagens(CacheArquivos):
+    """Imagens geradas, nomeadas pelo hash de (gerador, prompt normalizado, tamanho, semente)"""
+
+    def __init__(self, diretorio='cache_imagens', limite_bytes=200 * 1024 * 1024, extensao='.png'):
+        super().__init__(diretorio, limite_bytes, extensao)
+
+    @staticmethod
+    def chave(backend, prompt, largura, altura, semente):
+        bruto = json.dumps([backend, prompt, largura, altura, semente], ensure_ascii=False)
+        return hashlib.sha256(bruto.encode('utf-8')).hexdigest()
+
+
+class TrabalhoImagem:
+    """Um pedido de imagem na fila e o seu andamento"""
+
+    def __init__(self, id, prompt, largura, altura, semente, chave):
+        self.id = id
+        self.prompt = prompt
+        self.largura = largura
+        self.altura = altura
+        self.semente = semente
+        self.chave = chave
+        self.estado = 'na fila'  # na fila -> gerando -> pronta | erro
+        self.progresso = 0.0
+        self.pedidos = 1  # pedidos idênticos atendidos por este trabalho
+        self.avisos = []  # ao_concluir de cada pedido, para avisar quem pediu
+        self.caminho = None
+        self.erro = None
+        self.criado = time.monotonic()
+        self.inicio = None
+        self.fim = None
+        self.pronto = threading.Event()
+
+    def concluido(self):
+        return self.pronto.is_set()
+
+    def duracao(self):
+        """Segundos desde o início da geração (ou na fila, se ainda não começou)"""
+        return (self.fim or time.monotonic()) - (self.inicio or self.criado)
+
+
+class FilaImagens:
+    """Fila assíncrona de geração de imagens com um número fixo de trabalhadores.
+
+    submeter() devolve o trabalho na hora: pronto se a imagem já está no cache,
+    o mesmo trabalho se um pedido idêntico ainda estiver em andamento, ou um novo
+    trabalho na fila. O ao_concluir(trabalho) de cada pedido é chamado na thread do
+    trabalhador, então cada sessão recebe o aviso na sua própria saída.
+    """
+
+    def __init__(self, backend, cache, trabalhadores=2, max_pendentes=32, historico=200):
+        self.backend = backend
+        self.cache = cache
+        self.max_pendentes = max_pendentes
+        self.historico = historico
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=trabalhadores, thread_name_prefix='imagem')
+        self._lock = threading.Lock()
+        self._trabalhos = OrderedDict()  # id -> trabalho, do mais antigo para o mais novo
+        self._em_andamento = {}  # chave -> trabalho ainda não concluído
+        self._proximo_id = 1
+
+    @staticmethod
+    def normalizar(prompt):
+        return " ".join(prompt.split())
+
+    def submeter(self, prompt, largura=1024, altura=1024, semente=None, ao_concluir=None):
+        """Retorna (trabalho, situacao) com situacao 'cache', 'agrupado' ou 'na fila';
+        ao_concluir só é chamado se a imagem ainda tiver de ser gerada"""
+        prompt = self.normalizar(prompt)
+        if semente is None:
+            # Mesmo prompt, mesma imagem: é o que deixa o cache e o agrupamento valerem
+            semente = int(hashlib.sha256(prompt.lower().encode('utf-8')).hexdigest()[:8], 16)
+        chave = self.cache.chave(self.backend.nome, prompt, largura, altura, semente)
+        caminho = self.cache.obter_arquivo(chave)
+        with self._lock:
+            existente = self._em_andamento.get(chave)
+            if existente is not None:
+                existente.pedidos += 1
+                if ao_concluir:
+                    existente.avisos.append(ao_concluir)
+                return existente, 'agrupado'
+            if caminho is None and len(self._em_andamento) >= self.max_pendentes:
+                raise FilaImagensCheia(f"{len(self._em_andamento)} imagens já estão na fila")
+            trabalho = TrabalhoImagem(self._proximo_id, prompt, largura, altura, semente, chave)
+            self._proximo_id += 1
+            self._trabalhos[trabalho.id] = trabalho
+            self._podar()
+            if caminho is None:
+                self._em_andamento[chave] = trabalho
+                if ao_concluir:
+                    trabalho.avisos.append(ao_concluir)
+        if caminho is not None:
+            trabalho.caminho = caminho
+            trabalho.estado = 'pronta'
+            trabalho.progresso = 1.0
+            trabalho.inicio = trabalho.fim = trabalho.criado
+            trabalho.pronto.set()
+            return trabalho, 'cache'
+        self._executor.submit(self._executar, trabalho)
+        return trabalho, 'na fila'
+
+    def _podar(self):
+        """Esquece os trabalhos concluídos mais antigos além do histórico"""
+        excesso = len(self._trabalhos) - self.historico
+        for tid in [t for t, trab in self._trabalhos.items() if trab.concluido()][:max(excesso, 0)]:
+            del self._trabalhos[tid]
+
+    def _executar(self, trabalho):
+        trabalho.inicio = time.monotonic()
+        trabalho.estado = 'gerando'
+
+        def progresso(fracao):
+            trabalho.progresso = fracao
+        try:
+            dados = self.backend.gerar(trabalho.prompt, trabalho.largura, trabalho.altura,
+                                       trabalho.semente, progresso)
+            trabalho.caminho = self.cache.guardar_arquivo(trabalho.chave, dados)
+            trabalho.progresso = 1.0
+            trabalho.estado = 'pronta'
+        except Exception as e:
+            trabalho.erro = str(e) or e.__class__.__name__
+            trabalho.estado = 'erro'
+        finally:
+            trabalho.fim = time.monotonic()
+            with self._lock:
+                # Fora de _em_andamento ninguém mais se agrupa: a lista de avisos está fechada
+                self._em_andamento.pop(trabalho.chave, None)
+                avisos = list(trabalho.avisos)
+            trabalho.pronto.set()
+        for avisar in avisos:
+            try:
+                avisar(trabalho)
+            except Exception:
+                pass
+
+    def obter(self, tid):
+        with self._lock:
+            return self._trabalhos.get(tid)
+
+    def recentes(self, n=5):
+        with self._lock:
+            return list(self._trabalhos.values())[-n:]
+
+    def posicao(self, trabalho):
+        """Quantos trabalhos ainda esperam na frente deste (0 se já começou)"""
+        if trabalho.estado != 'na fila':
+            return 0
+        with self._lock:
+            return sum(1 for t in self._em_andamento.values()
+                       if t.estado == 'na fila' and t.id < trabalho.id)
+
+    def pendentes(self):
+        with self._lock:
+            return len(self._em_andamento)
+
+    def fechar(self):
+        """Descarta o que ainda está na fila; gerações em andamento terminam sozinhas"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ---------- PRÉ-GERAÇÃO EM SEGUNDO PLANO ----------
+class PoolPrefetch:
+    """Mantém uma fila pequena de itens pré-gerados por chave (ex.: ('fato', perfil)).
+
+    Um worker em segundo plano reabastece a fila quando ela cai abaixo da marca
+    mínima, e itens já servidos (ou repetidos) são descartados.
+    """
+
+    def __init__(self, gerar, capacidade=4, minimo=2, memoria_servidos=500):
+        self.gerar = gerar  # gerar(chave) -> str
+        self.capacidade = capacidade
+        self.minimo = minimo
+        self._filas = {}
+        self._servidos = OrderedDict()  # hashes dos itens já entregues, limitado
+        self.memoria_servidos = memoria_servidos
+        self._agendados = set()
+        self._pedidos = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def _hash(texto):
+        normalizado = " ".join(texto.lower().split())
+        return hashlib.sha1(normalizado.encode('utf-8')).hexdigest()
+
+    def obter(self, chave):
+        """Entrega um item pronto (ou None se a fila estiver vazia) e agenda o reabastecimento"""
+        with self._lock:
+            fila = self._filas.setdefault(chave, deque())
+            item = fila.popleft() if fila else None
+            precisa = len(fila) < self.minimo
+        if item is not None:
+            self.marcar_servido(item)
+        if precisa:
+            self.aquecer(chave)
+        return item
+
+    def ja_servido(self, texto):
+        with self._lock:
+            return self._hash(texto) in self._servidos
+
+    def marcar_servido(self, texto):
+        with self._lock:
+            self._servidos[self._hash(texto)] = True
+            while len(self._servidos) > self.memoria_servidos:
+                self._servidos.popitem(last=False)
+
+    def aquecer(self, chave):
+        """Agenda o reabastecimento da fila da chave, se ainda não estiver agendado"""
+        with self._lock:
+            if chave in self._agendados:
+                return
+            self._agendados.add(chave)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._trabalhar, daemon=True)
+                self._thread.start()
+        self._pedidos.put(chave)
+
+    def tamanho(self, chave):
+        with self._lock:
+            return len(self._filas.get(chave, ()))
+
+    def _trabalhar(self):
+        while True:
+            chave = self._pedidos.get()
+            repetidos = 0
+            try:
+                while self.tamanho(chave) < self.capacidade and repetidos < self.capacidade:
+                    item = self.gerar(chave)
+                    h = self._hash(item) if item else None
+                    with self._lock:
+                        fila = self._filas.setdefault(chave, deque())
+                        if not item or h in self._servidos or any(self._hash(i) == h for i in fila):
+                            repetidos += 1
+                            continue
+                        fila.append(item)
+            except Exception:
+                pass  # serviço fora do ar: tenta de novo no próximo pedido
+            finally:
+                with self._lock:
+                    self._agendados.discard(chave)
+
+
+# ---------- TAREFAS EM SEGUNDO PLANO ----------
+class TarefaAgendada:
+    """Uma tarefa do Agendador (periódica se tiver intervalo) e as suas métricas"""
+
+    def __init__(self, nome, funcao, intervalo=None, jitter=0.0, exclusiva=False, so_ocioso=False):
+        self.nome = nome
+        self.funcao = funcao
+        self.intervalo = intervalo
+        self.jitter = jitter
+        self.exclusiva = exclusiva
+        self.so_ocioso = so_ocioso
+        self.cancelada = False
+        self.proxima = None  # time.monotonic() da próxima execução
+        self.execucoes = 0
+        self.falhas = 0
+        self.adiamentos = 0
+        self.tempo_total = 0.0
+        self.tempo_maximo = 0.0
+        self.ultimo_erro = None
+
+    def cancelar(self):
+        self.cancelada = True
+
+
+class Agendador:
+    """Roda tarefas periódicas e avulsas numa única thread, guiada por um heap de horários.
+
+    Nenhuma tarefa começa durante um turno do usuário (quem atende envolve o turno em
+    turno()). Tarefas exclusivas mexem no estado do assistente, então um turno novo
+    espera a que estiver rodando terminar; tarefas so_ocioso (manutenção pesada) esperam
+    ainda ocioso_apos segundos sem interação. No servidor os turnos se sobrepõem e
+    podem nunca zerar: uma tarefa atrasada mais de max_atraso segundos segura os
+    turnos novos até os em andamento acabarem e ela começar.
+    """
+
+    def __init__(self, ocioso_apos=60, max_atraso=5.0):
+        self.ocioso_apos = ocioso_apos
+        self.max_atraso = max_atraso
+        self._heap = []  # (quando, sequência, tarefa); canceladas saem quando chegam ao topo
+        self._sequencia = 0
+        self._tarefas = {}  # nome -> tarefa ativa
+        self._cond = threading.Condition()
+        self._turnos = 0
+        self._ultimo_turno = time.monotonic()
+        self._exclusiva_rodando = False
+        self._segurando_turnos = False  # uma tarefa atrasada espera os turnos em andamento
+        self._parar = False
+        self._thread = None
+
+    def agendar(self, nome, funcao, intervalo=None, atraso=None, jitter=0.0, exclusiva=False, so_ocioso=False):
+        """Roda funcao() daqui a atraso segundos (padrão: um intervalo) e, havendo intervalo,
+        de novo a cada intervalo. jitter é a variação aleatória (fração, ±) de cada espera.
+        Agendar de novo um nome substitui a tarefa anterior."""
+        tarefa = TarefaAgendada(nome, funcao, intervalo, jitter, exclusiva, so_ocioso)
+        with self._cond:
+            anterior = self._tarefas.get(nome)
+            if anterior is not None:
+                anterior.cancelar()
+            self._tarefas[nome] = tarefa
+            self._inserir(tarefa, atraso if atraso is not None else (intervalo or 0))
+            self._cond.notify_all()
+        return tarefa
+
+    def cancelar(self, nome):
+        with self._cond:
+            tarefa = self._tarefas.pop(nome, None)
+        if tarefa is None:
+            return False
+        tarefa.cancelar()
+        return True
+
+    def _inserir(self, tarefa, espera):
+        if tarefa.jitter:
+            espera *= 1 + random.uniform(-tarefa.jitter, tarefa.jitter)
+        tarefa.proxima = time.monotonic() + max(espera, 0)
+        heapq.heappush(self._heap, (tarefa.proxima, self._sequencia, tarefa))
+        self._sequencia += 1
+
+    @contextlib.contextmanager
+    def turno(self):
+        """Marca um turno do usuário: nenhuma tarefa começa enquanto ele durar"""
+        with self._cond:
+            while self._exclusiva_rodando or self._segurando_turnos:
+                self._cond.wait()
+            self._turnos += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._turnos -= 1
+                self._ultimo_turno = time.monotonic()
+                self._cond.notify_all()
+
+    def iniciar(self):
+        with self._cond:
+            self._parar = False
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._laco, daemon=True)
+            self._thread.start()
+
+    def parar(self, timeout=5):
+        """Acorda a thread e espera a tarefa em andamento (se houver) terminar"""
+        with self._cond:
+            self._parar = True
+            self._segurando_turnos = False
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _proxima_tarefa(self):
+        """Espera a próxima tarefa que pode rodar agora; None ao parar"""
+        with self._cond:
+            while not self._parar:
+                while self._heap and self._heap[0][2].cancelada:
+                    heapq.heappop(self._heap)
+                agora = time.monotonic()
+                quando, _, tarefa = self._heap[0] if self._heap else (None, None, None)
+                segurar = (quando is not None and self._turnos > 0 and not tarefa.so_ocioso
+                           and agora - quando >= self.max_atraso)
+                if segurar != self._segurando_turnos:
+                    self._segurando_turnos = segurar
+                    self._cond.notify_all()
+                if quando is None:
+                    self._cond.wait()
+                    continue
+                if quando > agora:
+                    self._cond.wait(quando - agora)
+                    continue
+                if self._turnos:
+                    # O fim do turno acorda a thread; sem ele, acorda quando passar do max_atraso
+                    self._cond.wait(None if segurar or tarefa.so_ocioso
+                                    else quando + self.max_atraso - agora)
+                    continue
+                heapq.heappop(self._heap)
+                ocioso_em = self._ultimo_turno + self.ocioso_apos
+                if tarefa.so_ocioso and agora < ocioso_em:
+                    tarefa.adiamentos += 1
+                    self._inserir(tarefa, ocioso_em - agora)
+                    continue
+                self._exclusiva_rodando = tarefa.exclusiva
+                return tarefa
+            return None
+
+    def _laco(self):
+        while True:
+            tarefa = self._proxima_tarefa()
+            if tarefa is None:
+                return
+            inicio = time.perf_counter()
+            try:
+                tarefa.funcao()
+            except Exception as e:
+                tarefa.falhas += 1
+                tarefa.ultimo_erro = str(e) or e.__class__.__name__
+                print(f"⚠️ Tarefa '{tarefa.nome}' falhou: {tarefa.ultimo_erro}")
+            duracao = time.perf_counter() - inicio
+            tarefa.execucoes += 1
+            tarefa.tempo_total += duracao
+            tarefa.tempo_maximo = max(tarefa.tempo_maximo, duracao)
+            with self._cond:
+                self._exclusiva_rodando = False
+                if tarefa.intervalo and not tarefa.cancelada:
+                    self._inserir(tarefa, tarefa.intervalo)
+                elif self._tarefas.get(tarefa.nome) is tarefa:
+                    del self._tarefas[tarefa.nome]
+                self._cond.notify_all()
+
+    def metricas(self):
+        """{nome: {execucoes, falhas, adiamentos, media, maximo, proxima_em}} das tarefas ativas"""
+        agora = time.monotonic()
+        with self._cond:
+            tarefas = list(self._tarefas.values())
+        return {t.nome: {
+            'execucoes': t.execucoes,
+            'falhas': t.falhas,
+            'adiamentos': t.adiamentos,
+            'media': t.tempo_total / t.execucoes if t.execucoes else 0.0,
+            'maximo': t.tempo_maximo,
+            'proxima_em': max(t.proxima - agora, 0) if t.proxima is not None else None,
+        } for t in tarefas}
+
+    def relatorio(self):
+        linhas = [f"  {'tarefa':<14} {'execuções':>9} {'falhas':>6} {'média':>9} {'máximo':>9} {'próxima':>9}"]
+        for nome, m in sorted(self.metricas().items()):
+            proxima = f"{m['proxima_em']:7.0f} s" if m['proxima_em'] is not None else '        -'
+            linhas.append(f"  {nome:<14} {m['execucoes']:>9} {m['falhas']:>6} {m['media'] * 1000:7.1f}ms "
+                          f"{m['maximo'] * 1000:7.1f}ms {proxima}")
+        return "\n".join(linhas)
+
+
+# ---------- ROTEAMENTO DE COMANDOS ----------
+# Tipos de argumento aceitos nos padrões: {nome:tipo} ou {nome:tipo?} (opcional).
+# Um tipo com '|' é uma lista fechada de palavras, ex.: {modo:texto|voz|hibrido}
+TIPOS_ARGUMENTO = {
+    'id': (r'\d+', int),
+    'palavra': (r'\S+', str.lower),
+    'texto': (r'.+', lambda s: s.strip().lower()),
+    'bruto': (r'.+', str.strip),  # preserva maiúsculas (ex.: caminhos de arquivo)
+}
+
+_PLACEHOLDER = re.compile(r'^\{(\w+):([^}?]+)(\??)\}$')
+
+
+def comando(*padroes, uso=None):
+    """Registra o método decorado como handler dos padrões de comando dados"""
+    def decorar(funcao):
+        funcao._padroes = getattr(funcao, '_padroes', ()) + tuple((p, uso) for p in padroes)
+        return funcao
+    return decorar
+
+
+class Rota:
+    """Um padrão de comando compilado: palavras fixas de prefixo, regex e conversores"""
+
+    def __init__(self, padrao, handler, uso=None):
+        self.padrao = padrao
+        self.handler = handler
+        self.uso = uso
+        self.prefixo = []
+        self.conversores = {}
+        partes_regex = []
+        for i, token in enumerate(padrao.split()):
+            m = _PLACEHOLDER.match(token)
+            if not m:
+                if self.conversores:
+                    raise ValueError(f"palavra fixa depois de argumento em '{padrao}'")
+                self.prefixo.append(token.lower())
+                partes_regex.append((r'\s+' if i else '') + re.escape(token))
+                continue
+            nome, tipo, opcional = m.groups()
+            if '|' in tipo:
+                regex, conversor = '|'.join(re.escape(t) for t in tipo.split('|')), str.lower
+            else:
+                regex, conversor = TIPOS_ARGUMENTO[tipo]
+            self.conversores[nome] = conversor
+            grupo = rf'\s+(?P<{nome}>{regex})'
+            partes_regex.append(f'(?:{grupo})?' if opcional else grupo)
+        if not self.prefixo:
+            raise ValueError(f"padrão sem palavra fixa inicial: '{padrao}'")
+        self.regex = re.compile('^' + ''.join(partes_regex) + '$', re.IGNORECASE | re.DOTALL)
+
+    def extrair(self, texto):
+        """Retorna os argumentos convertidos, ou None se o texto não casar com o padrão"""
+        m = self.regex.match(texto)
+        if not m:
+            return None
+        return {nome: (self.conversores[nome](v) if v is not None else None)
+                for nome, v in m.groupdict().items()}
+
+
+class RoteadorComandos:
+    """Despacho de comandos compilado uma vez: comandos sem argumentos ficam num dict
+    (busca O(1)) e os com argumentos numa trie de palavras de prefixo. Só as rotas
+    do caminho percorrido na trie têm a regex testada, então texto livre para a IA
+    costuma sair já na primeira palavra, não importa quantos comandos existam."""
+
+    _ROTAS = '$rotas'
+
+    def __init__(self):
+        self.rotas = []
+        self._exatos = {}
+        self._trie = {}
+
+    @classmethod
+    def da_classe(cls, classe):
+        """Compila as rotas de todos os métodos decorados com @comando na classe"""
+        roteador = cls()
+        for nome in dir(classe):
+            for padrao, uso in getattr(getattr(classe, nome), '_padroes', ()):
+                roteador.registrar(padrao, nome, uso)
+        return roteador
+
+    def registrar(self, padrao, handler, uso=None):
+        rota = Rota(padrao, handler, uso)
+        self.rotas.append(rota)
+        if not rota.conversores:
+            self._exatos[' '.join(rota.prefixo)] = rota
+            return rota
+        no = self._trie
+        for palavra in rota.prefixo:
+            no = no.setdefault(palavra, {})
+        no.setdefault(self._ROTAS, []).append(rota)
+        return rota
+
+    def resolver(self, texto):
+        """Retorna (rota, argumentos). Se o prefixo casou mas os argumentos não,
+        retorna (rota, None) para o chamador mostrar o uso; sem rota, (None, None)."""
+        palavras = texto.lower().split()
+        rota = self._exatos.get(' '.join(palavras))
+        if rota is not None:
+            return rota, {}
+        candidatas = []
+        no = self._trie
+        for palavra in palavras:
+            no = no.get(palavra)
+            if no is None:
+                break
+            candidatas.extend(no.get(self._ROTAS, ()))
+        texto = texto.strip()
+        for rota in reversed(candidatas):  # prefixo mais longo primeiro
+            args = rota.extrair(texto)
+            if args is not None:
+                return rota, args
+        for rota in reversed(candidatas):
+            if rota.uso:
+                return rota, None
+        return None, None
+
+
+# ---------- CONTEXTO DA CONVERSA ----------
+def estimar_tokens(texto):
+    """Estimativa barata de tokens (~4 caracteres por token), sem tokenizador"""
+    return len(texto) // 4 + 1
+
+
+class GerenciadorContexto:
+    """Histórico da conversa limitado por um orçamento de tokens.
+
+    Quando o histórico passa do orçamento, os turnos mais antigos saem e viram
+    linhas curtas num resumo contínuo, enviado junto do prompt de sistema.
+    """
+
+    CUSTO_MENSAGEM = 4  # tokens de overhead por mensagem no formato de chat
+
+    def __init__(self, orcamento_tokens=3000, orcamento_resumo=400, max_tokens_mensagem=None):
+        self.orcamento_tokens = orcamento_tokens
+        self.orcamento_resumo = orcamento_resumo
+        # Uma mensagem sozinha (ex.: um sketch colado) não pode ocupar o orçamento inteiro
+        self.max_tokens_mensagem = max_tokens_mensagem or orcamento_tokens // 2
+        self.mensagens = deque()  # (mensagem, tokens)
+        self.resumo = deque()  # (linha, tokens)
+        self._tokens = 0
+        self._tokens_resumo = 0
+
+    @property
+    def tokens(self):
+        return self._tokens + self._tokens_resumo
+
+    def limpar(self):
+        self.mensagens.clear()
+        self.resumo.clear()
+        self._tokens = 0
+        self._tokens_resumo = 0
+
+    def adicionar(self, role, content):
+        content = self._truncar(content, self.max_tokens_mensagem)
+        tokens = estimar_tokens(content) + self.CUSTO_MENSAGEM
+        self.mensagens.append(({"role": role, "content": content}, tokens))
+        self._tokens += tokens
+        self._aparar()
+
+    def montar(self, prompt_sistema):
+        """Lista de mensagens para a API: sistema (+ resumo) seguido do histórico"""
+        if self.resumo:
+            linhas = "\n".join(linha for linha, _ in self.resumo)
+            prompt_sistema = f"{prompt_sistema}\nResumo do que já foi conversado:\n{linhas}\n"
+        return [{"role": "system", "content": prompt_sistema}] + [m for m, _ in self.mensagens]
+
+    def _aparar(self):
+        # Mantém sempre a última mensagem, mesmo que sozinha passe do orçamento
+        while self.tokens > self.orcamento_tokens and len(self.mensagens) > 1:
+            mensagem, tokens = self.mensagens.popleft()
+            self._tokens -= tokens
+            self._resumir(mensagem)
+
+    def _resumir(self, mensagem):
+        quem = "Usuário" if mensagem["role"] == "user" else "Assistente"
+        primeira = re.split(r'(?<=[.!?])\s|\n', mensagem["content"].strip(), maxsplit=1)[0]
+        if len(primeira) > 160:
+            primeira = primeira[:157].rstrip() + "..."
+        linha = f"- {quem}: {primeira}"
+        tokens = estimar_tokens(linha)
+        self.resumo.append((linha, tokens))
+        self._tokens_resumo += tokens
+        while self._tokens_resumo > self.orcamento_resumo and len(self.resumo) > 1:
+            self._tokens_resumo -= self.resumo.popleft()[1]
+
+    @staticmethod
+    def _truncar(texto, max_tokens):
+        """Mantém o começo e o fim de textos enormes, cortando o meio"""
+        limite = max_tokens * 4
+        if len(texto) <= limite:
+            return texto
+        metade = limite // 2 - 10
+        return f"{texto[:metade]}\n[... {len(texto) - 2 * metade} caracteres omitidos ...]\n{texto[-metade:]}"
+
+
+# ---------- LISTA DE MATERIAIS (BOM) ----------
+# Nomes de coluna aceitos no cabeçalho do CSV, já normalizados (minúsculas, sem acento)
+COLUNAS_BOM = {
+    'componente': {'componente', 'part', 'part number', 'partnumber', 'pn', 'peca', 'item', 'referencia'},
+    'quantidade': {'quantidade', 'qtd', 'qtde', 'qty', 'quantity'},
+    'observacao': {'observacao', 'obs', 'notes', 'nota', 'descricao', 'description'},
+}
+
+
+def _normalizar_coluna(nome):
+    nome = unicodedata.normalize('NFKD', nome.strip().lower())
+    return "".join(c for c in nome if not unicodedata.combining(c))
+
+
+# Maior valor que cabe numa coluna INTEGER do SQLite (64 bits com sinal)
+MAX_INTEIRO_SQLITE = 2 ** 63 - 1
+
+
+def ler_bom_csv(arquivo, ao_progresso=None, intervalo_progresso=500):
+    """Lê um CSV de BOM linha a linha, valida e junta part numbers repetidos somando
+    a quantidade. Retorna (itens, erros, linhas_lidas); itens é um dict ordenado
+    chave -> [componente, quantidade, observacao]."""
+    amostra = arquivo.read(4096)
+    arquivo.seek(0)
+    try:
+        dialeto = csv.Sniffer().sniff(amostra, delimiters=',;\t')
+    except csv.Error:
+        dialeto = csv.excel
+    leitor = csv.reader(arquivo, dialeto)
+    cabecalho = [_normalizar_coluna(c) for c in next(leitor, [])]
+    indices = {}
+    for campo, apelidos in COLUNAS_BOM.items():
+        for i, coluna in enumerate(cabecalho):
+            if coluna in apelidos:
+                indices[campo] = i
+                break
+    if 'componente' not in indices:
+        raise ValueError("o CSV precisa de uma coluna 'componente' (ou part/pn)")
+
+    itens = OrderedDict()
+    erros = []
+    linhas = 0
+    for numero, linha in enumerate(leitor, start=2):
+        if not any(c.strip() for c in linha):
+            continue
+        linhas += 1
+        if ao_progresso and linhas % intervalo_progresso == 0:
+            ao_progresso(linhas)
+
+        def campo(nome):
+            i = indices.get(nome)
+            return linha[i].strip() if i is not None and i < len(linha) else ""
+
+        componente = campo('componente')
+        if not componente:
+            erros.append((numero, "componente vazio"))
+            continue
+        bruto = campo('quantidade') or "1"
+        try:
+            quantidade = float(bruto.replace(',', '.'))
+        except ValueError:
+            erros.append((numero, f"quantidade inválida: {bruto!r}"))
+            continue
+        # nan e inf também são float(): sem o isfinite, int() levantaria fora do try
+        if not math.isfinite(quantidade) or quantidade <= 0 or quantidade != int(quantidade):
+            erros.append((numero, f"quantidade deve ser inteira e positiva: {bruto!r}"))
+            continue
+        chave = componente.casefold()
+        total = int(quantidade) + (itens[chave][1] if chave in itens else 0)
+        if total > MAX_INTEIRO_SQLITE:
+            erros.append((numero, f"quantidade grande demais: {bruto!r}"))
+            continue
+        obs = campo('observacao')
+        if chave in itens:
+            item = itens[chave]
+            item[1] = total
+            if obs and obs not in item[2].split("; "):
+                item[2] = f"{item[2]}; {obs}" if item[2] else obs
+        else:
+            itens[chave] = [componente, int(quantidade), obs]
+    return itens, erros, linhas
+
+
+# ---------- PERSISTÊNCIA DO ESTADO ----------
+def _para_json(valor):
+    """Estado -> forma JSON (cópia profunda); datas e deques ganham marcadores"""
+    if isinstance(valor, dict):
+        return {str(k): _para_json(v) for k, v in valor.items()}
+    if isinstance(valor, deque):
+        return {'$deque': [_para_json(v) for v in valor], 'maxlen': valor.maxlen}
+    if isinstance(valor, (list, tuple)):
+        return [_para_json(v) for v in valor]
+    if isinstance(valor, datetime.datetime):
+        return {'$data': valor.isoformat()}
+    return valor
+
+
+def _de_json(valor):
+    if isinstance(valor, dict):
+        if '$deque' in valor:
+            return deque((_de_json(v) for v in valor['$deque']), maxlen=valor['maxlen'])
+        if '$data' in valor:
+            return datetime.datetime.fromisoformat(valor['$data'])
+        return {k: _de_json(v) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [_de_json(v) for v in valor]
+    return valor
+
+
+def _itens_sequencia(valor):
+    """(itens, maxlen) se o valor JSON for uma lista ou deque, senão None"""
+    if isinstance(valor, list):
+        return valor, None
+    if isinstance(valor, dict) and '$deque' in valor:
+        return valor['$deque'], valor['maxlen']
+    return None
+
+
+def _anexados(antigo, novo, maxlen):
+    """Itens que, anexados a antigo (e cortados em maxlen), dão novo; None se não houver"""
+    for sobreposicao in range(min(len(antigo), len(novo)), -1, -1):
+        if antigo[len(antigo) - sobreposicao:] == novo[:sobreposicao]:
+            resultado = antigo + novo[sobreposicao:]
+            if maxlen is not None:
+                resultado = resultado[-maxlen:] if maxlen else []
+            if resultado == novo:
+                return novo[sobreposicao:]
+    return None
+
+
+def diferenca_estado(antigo, novo, caminho=()):
+    """Operações que levam o estado JSON antigo ao novo: ['definir', caminho, valor],
+    ['remover', caminho] e ['anexar', caminho, itens] para listas e deques que só cresceram"""
+    if antigo == novo:
+        return []
+    if isinstance(antigo, dict) and isinstance(novo, dict) \
+            and '$deque' not in antigo and '$deque' not in novo and '$data' not in novo:
+        ops = [['remover', list(caminho) + [k]] for k in antigo if k not in novo]
+        for k, v in novo.items():
+            if k in antigo:
+                ops.extend(diferenca_estado(antigo[k], v, caminho + (k,)))
+            else:
+                ops.append(['definir', list(caminho) + [k], v])
+        return ops
+    seq_antiga, seq_nova = _itens_sequencia(antigo), _itens_sequencia(novo)
+    if seq_antiga and seq_nova and seq_antiga[1] == seq_nova[1]:
+        itens = _anexados(seq_antiga[0], seq_nova[0], seq_nova[1])
+        if itens is not None:
+            return [['anexar', list(caminho), itens]]
+    return [['definir', list(caminho), novo]]
+
+
+def aplicar_operacoes(estado, ops):
+    for op in ops:
+        tipo, caminho = op[0], op[1]
+        if not caminho:
+            estado = op[2]
+            continue
+        alvo = estado
+        for chave in caminho[:-1]:
+            alvo = alvo[chave]
+        if tipo == 'definir':
+            alvo[caminho[-1]] = op[2]
+        elif tipo == 'remover':
+            alvo.pop(caminho[-1], None)
+        elif tipo == 'anexar':
+            sequencia = alvo[caminho[-1]]
+            if isinstance(sequencia, dict):
+                itens = sequencia['$deque'] + op[2]
+                maxlen = sequencia['maxlen']
+                sequencia['$deque'] = (itens[-maxlen:] if maxlen else []) if maxlen is not None else itens
+            else:
+                sequencia.extend(op[2])
+    return estado
+
+
+class DiarioEstado:
+    """Estado persistente (memória, personalidade, humor) num diário só de acréscimos.
+
+    O arquivo começa com um snapshot e segue com uma linha JSON por gravação, só com o
+    que mudou desde a anterior. Cada linha vai para o disco (fsync) antes de voltar;
+    uma linha cortada por queda de energia é descartada na leitura. Passando de
+    compactar_apos linhas, o diário é reescrito como um snapshot novo num arquivo
+    temporário e trocado por rename atômico.
+    """
+
+    def __init__(self, caminho='memoria_vis.jsonl', compactar_apos=1000):
+        self.caminho = caminho
+        self.compactar_apos = compactar_apos
+        self.linhas = 0
+        self._ultimo = None
+        self._lock = threading.Lock()
+
+    def existe(self):
+        return os.path.exists(self.caminho)
+
+    def carregar(self):
+        """Estado salvo, ou None se não houver diário. Para na primeira linha inválida
+        e corta o arquivo ali, para as próximas gravações não ficarem depois do lixo."""
+        if not self.existe():
+            return None
+        estado, validos, linhas = None, 0, 0
+        with open(self.caminho, 'rb') as f:
+            for bruto in f:
+                try:
+                    if not bruto.endswith(b'\n'):
+                        raise ValueError("linha incompleta")
+                    registro = json.loads(bruto)
+                    if 'snapshot' in registro:
+                        estado = registro['snapshot']
+                    elif estado is None:
+                        raise ValueError("diário sem snapshot")
+                    else:
+                        estado = aplicar_operacoes(estado, registro['ops'])
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    print(f"⚠️ Diário de memória danificado após {linhas} registros ({e}); "
+                          f"mantendo o que veio antes.")
+                    break
+                validos += len(bruto)
+                linhas += 1
+        if validos < os.path.getsize(self.caminho):
+            with open(self.caminho, 'r+b') as f:
+                f.truncate(validos)
+        self.linhas = linhas
+        self._ultimo = estado
+        return _de_json(estado) if estado is not None else None
+
+    def registrar(self, estado):
+        """Anexa ao diário o que mudou desde a última gravação; retorna o número de operações"""
+        with self._lock:
+            novo = _para_json(estado)
+            if self._ultimo is None:
+                self._checkpoint(novo)
+                return 1
+            ops = diferenca_estado(self._ultimo, novo)
+            if not ops:
+                return 0
+            linha = json.dumps({'t': round(time.time(), 3), 'ops': ops}, ensure_ascii=False)
+            with open(self.caminho, 'a', encoding='utf-8') as f:
+                f.write(linha + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._ultimo = novo
+            self.linhas += 1
+            if self.linhas > self.compactar_apos:
+                self._checkpoint(novo)
+            return len(ops)
+
+    def checkpoint(self, estado):
+        """Reescreve o diário como um único snapshot (troca atômica de arquivo)"""
+        with self._lock:
+            self._checkpoint(_para_json(estado))
+
+    def _checkpoint(self, estado_json):
+        pasta = os.path.dirname(os.path.abspath(self.caminho))
+        fd, temporario = tempfile.mkstemp(dir=pasta, prefix='.memoria-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'snapshot': estado_json}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporario, self.caminho)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temporario)
+            raise
+        if hasattr(os, 'O_DIRECTORY'):
+            # Garante que o rename em si chegou ao disco
+            fd = os.open(pasta, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._ultimo = estado_json
+        self.linhas = 1
+
 
 class AssistenteMultiperfil:
 
-    def __init__(self, nome="BENCH-VIS", modo_entrada="hibrido", perfil_inicial="bancada"):
+    PIADAS = [
+        "Por que os eletrônicos são tão calmos? Porque têm muitos capacitores!",
+        "O que um resistor disse para o outro? Vamos nos conectar!",
+        "Qual é o contrário de LED? DEL! ...Tá, foi ruim, eu sei.",
+        "Por que o transistor foi ao médico? Porque estava com emissor de corrente!"
+    ]
+
+    DESPEDIDAS = [
+        "Até mais! Não esqueça de desligar o ferro de solda!",
+        "Falou! Vou recarregar as baterias.",
+        "Tchau! Foi bom conversar!"
+    ]
+
+    AJUDA = """
+🔧 COMANDOS DO BENCH-VIS (perfil atual: {perfil_atual}):
+
+👤 PERFIS:
+  • "mudar perfil [nome]" - troca de perfil
+  • "perfis" - lista todos os perfis
+  Perfis disponíveis: {perfis}
+
+📁 PROJETOS:
+  • "projeto novo NOME" - criar projeto
+  • "listar projetos" - lista os projetos, 20 por vez
+  • "buscar TERMO" - busca em projetos, componentes, código e etapas
+  • "mais" - mostra a próxima página da última listagem ou busca
+  • "deletar projeto ID" - remove projeto (com confirmação)
+  • "componentes do projeto ID" - lista componentes do projeto
+  • "importar bom ID arquivo.csv" - importa a lista de materiais de um CSV
+  • "exportar bom ID [arquivo.csv]" - exporta os componentes do projeto em CSV
+
+💻 CÓDIGO:
+  • "gerar codigo [descrição]" - gera código (Arduino, Python...)
+  • "salvar codigo ID" - salva o último código gerado como nova versão do projeto
+  • "historico codigo ID" - lista as versões do código do projeto
+  • "ver codigo ID [versão]" - mostra uma versão (a última, se omitida)
+  • "diff codigo ID [de] [para]" - compara versões (as duas últimas, se omitidas)
+
+🖼️ IMAGENS:
+  • "gerar imagem [descrição]" - pede uma imagem; ela é gerada em segundo plano
+  • "status imagem [número]" - andamento do pedido (ou das imagens recentes)
+
+🎭 ENTRETENIMENTO:
+  • "fato" ou "curiosidade" - conta algo interessante
+  • "conselho" - dá um conselho
+  • "piada" - conta uma piada
+
+🤖 IA:
+  • "toggle ia" - liga/desliga o modo inteligente
+  • "cache stats" - estatísticas do cache de respostas e de áudio
+  • "latencia" - tempos de roteamento, IA, memória e voz nesta sessão
+  • "tarefas" - autosave e manutenção em segundo plano, com tempos de execução
+  • Com IA ligada, pode conversar sobre qualquer assunto
+
+🎤 MODOS:
+  • "modo texto", "modo voz", "modo hibrido"
+  • "sair" - encerra
+
+💡 DICA: A personalidade muda com o tempo e com o perfil!
+"""
+
+    # Frases fixas faladas com frequência, candidatas ao pré-aquecimento do cache de áudio
+    FRASES_FIXAS = PIADAS + DESPEDIDAS + [
+        "Comandos disponíveis no terminal.",
+        "Lista de perfis exibida no terminal.",
+        "Gerando código...",
+        "Código gerado! Confira no terminal. Quer salvar em algum projeto?",
+        "Não consegui gerar o código.",
+        "Descreva o que o código deve fazer.",
+        "Operação cancelada.",
+        "Modo IA desligado. Use 'toggle ia' para ativar.",
+        "Até mais!",
+    ]
+
+    # Dono das trocas gravadas no arquivo de conversas (None é o terminal)
+    sessao_conversas = None
+    # Último erro do LLM engolido por uma resposta de contingência; o modo lote zera
+    # antes de cada comando e o usa para marcar o comando como falho
+    falha_llm = None
+
+    def __init__(self, nome="BENCH-VIS", modo_entrada="hibrido", perfil_inicial="bancada",
+                 pre_aquecer_audio=True, llm=None, prefetch=True, orcamento_contexto=3000,
+                 perfil_inicio=None, caminho_db='benchvis.db', caminho_memoria='memoria_vis.jsonl',
+                 imagem=None, voz=None, audio=True):
         self.nome = nome
         self.apelido = "Vis"
         self.modo_entrada = modo_entrada
-        self.perfil_atual = perfil_inicial
+        # audio=False: sem microfone, voz, player nem cache de áudio (modo lote)
+        self.audio = audio
+        self.caminho_db = caminho_db
+        self.orcamento_contexto = orcamento_contexto
+        # Tudo o que é mostrado ao usuário passa por aqui (as sessões do servidor trocam)
+        self.saida = print
 
         # === DEFINIÇÃO DOS PERFIS ===
         self.perfis = {
@@ -93,113 +3187,138 @@ class AssistenteMultiperfil:
             }
         }
 
-        # Carrega a personalidade base do perfil inicial
-        self.personalidade = self.perfis[perfil_inicial]["personalidade_base"].copy()
+        # Perfil, personalidade e contexto da conversa (a memória salva pode sobrescrever)
+        self._iniciar_estado(perfil_inicial)
 
-        # Histórico de humor
-        self.humor_history = deque(maxlen=20)
-        self.humor_history.append(self.personalidade['humor'])
+        # Banco, memória e microfone sobem em paralelo; só banco e memória
+        # precisam estar prontos antes do prompt
+        self.perfil_inicio = perfil_inicio or PerfilInicializacao()
 
         # === BANCO DE DADOS ===
-        self.init_banco_dados()
+        banco = self.perfil_inicio.em_paralelo('banco de dados', self.init_banco_dados)
 
         # === MEMÓRIA ===
-        self.memoria = self.carregar_memoria()
+        self.diario = DiarioEstado(caminho_memoria)
+        memoria = self.perfil_inicio.em_paralelo('memória', self.carregar_memoria)
+
+        # === ÁUDIO ===
+        # A calibração do microfone continua em segundo plano; até terminar, a entrada é por texto
+        self.entrada = EntradaMultiplexada()
+        if self.audio and self.modo_entrada in ["voz", "hibrido"]:
+            self.perfil_inicio.em_paralelo('microfone', self.setup_microfone)
+        # Tempo de cada etapa do atendimento (comando 'latencia' e bench_latencia.py)
+        self.medidor = MedidorEtapas()
+        # Autosave, decaimento e manutenção, sempre fora dos turnos do usuário
+        self.agendador = Agendador()
+        if not self.audio:
+            self.cache_audio = self.voz = self.reprodutor = None
+            self.pipeline_fala = FalaDesligada()
+        else:
+            with self.perfil_inicio.fase('áudio'):
+                self.cache_audio = CacheAudio()
+                # Motores de voz em ordem de preferência; curtas e urgentes vão para o mais rápido
+                self.voz = SeletorVoz(voz or motores_voz_padrao(), self.cache_audio, self.medidor)
+                if self.modo_entrada != "texto":
+                    self.voz.aquecer()
+                self.reprodutor = ServicoReproducao()
+                self.pipeline_fala = PipelineFala(self._sintetizar_frase, self.reprodutor)
 
         # === IA ===
-        self.client = Pollinations()
-        self.modelo_padrao = "openai"
-        self.usar_ia = True
+        self.llm = llm or BackendHTTP()
+        # O reabastecimento mede à parte, para não misturar chamadas de fundo com a latência vista
+        self.prefetch = (PoolPrefetch(lambda chave: self._gerar_entretenimento(chave, etapa='llm_prefetch'))
+                         if prefetch else None)
 
-        # Contexto da conversa (será recriado ao mudar de perfil)
-        self.contexto_conversa = self.criar_contexto_inicial()
+        # === IMAGENS ===
+        # Geradas em segundo plano; o comando só enfileira e devolve o número do pedido
+        imagem = imagem or BackendImagemHTTP()
+        self.imagens = FilaImagens(imagem, CacheImagens(extensao=imagem.extensao))
 
-        # === ÁUDIO ===
-        if self.modo_entrada in ["voz", "hibrido"]:
-            self.setup_microfone()
+        banco.result()
+        self.memoria = memoria.result()
+        self._aquecer_prefetch()
+        if (pre_aquecer_audio and self.audio and self.modo_entrada != "texto"
+                and any(m.nome == 'gtts' for m in self.voz.motores)):
+            slow = self._emocao_atual() in ('triste', 'cansado')
+            self.cache_audio.aquecer(self.FRASES_FIXAS, 'pt', slow, sintetizar_gtts)
 
-        # === ESTADO ===
+    def _iniciar_estado(self, perfil):
+        """Estado de uma conversa: perfil, personalidade, contexto e continuações"""
+        self.perfil_atual = perfil
+        self.personalidade = self.perfis[perfil]["personalidade_base"].copy()
+        self.humor_history = deque(maxlen=20)
+        self.humor_history.append(self.personalidade['humor'])
+        self.usar_ia = True
+        self.streaming = True  # mostra e fala a resposta enquanto ela chega
+        self._emocao_fala = 'normal'
+        # Contexto da conversa (será limpo ao mudar de perfil)
+        self._cache_prompt = (None, None)
+        self.contexto = GerenciadorContexto(orcamento_tokens=self.orcamento_contexto)
         self.ultimo_codigo_gerado = None
+        self._pagina_seguinte = None  # continuação da última listagem paginada ('mais')
         self.linguagem_padrao = "arduino"
 
-        print(f"""
+    def apresentar(self):
+        """Banner e saudação, mostrados quando a sessão do terminal começa"""
+        self.saida(f"""
 ╔══════════════════════════════════════╗
 ║     🔧 {self.nome} - Multiperfil      ║
 ║   Modo: {self.modo_entrada.upper()}                ║
-║   Voz: gTTS + players de terminal    ║
+║   Voz: {' > '.join(m.nome for m in self.voz.motores) if self.audio else 'desligada'}        ║
 ║   Perfil atual: {self.perfil_atual.upper()}        ║
 ╚══════════════════════════════════════╝
         """)
-
         self.saudacao_inicial()
+
     def setup_microfone(self):
-        """Configura o microfone para reconhecimento de voz"""
-        try:
-            self.recognizer = sr.Recognizer()
-            self.microphone = sr.Microphone()
-            with self.microphone as source:
-                print("🎤 Ajustando microfone...")
-                self.recognizer.adjust_for_ambient_noise(source, duration=1)
-            print("✅ Microfone configurado!")
+        """Calibra o microfone uma vez e deixa a escuta contínua rodando"""
+        try:
+            recognizer = sr.Recognizer()
+            microphone = sr.Microphone()
+            with microphone as source:
+                self.saida("🎤 Ajustando microfone...")
+                recognizer.adjust_for_ambient_noise(source, duration=1)
+            nome_motor, reconhecer = escolher_reconhecedor(recognizer)
+            # A calibração deixa o limiar em ruído * dynamic_energy_ratio; o piso é o ruído
+            self.ouvinte = OuvinteContinuo(
+                microphone, reconhecer,
+                piso_inicial=recognizer.energy_threshold / recognizer.dynamic_energy_ratio,
+                silenciar=self._falando)
+            if self.modo_entrada == "texto":
+                self.ouvinte.pausar()
+            self.ouvinte.iniciar()
+            self.entrada.adicionar_fonte('voz', self.ouvinte.textos)
+            # Só publica depois de calibrado: quem checa hasattr(self, 'microphone') espera isso
+            self.recognizer = recognizer
+            self.microphone = microphone
+            self.saida(f"✅ Microfone configurado! Escuta contínua ativa (reconhecimento: {nome_motor})")
         except Exception as e:
-            print(f"⚠️ Microfone não disponível: {e}")
+            self.saida(f"⚠️ Microfone não disponível: {e}")
             self.modo_entrada = "texto"
-    # ---------- INICIALIZAÇÃO ----------
-    def init_banco_dados(self):
-        self.conn = sqlite3.connect('benchvis.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
-
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS projetos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT NOT NULL,
-                descricao TEXT,
-                data_criacao TIMESTAMP,
-                status TEXT,
-                linguagem TEXT DEFAULT 'arduino'
-            )
-        ''')
 
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS componentes_projeto (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                projeto_id INTEGER,
-                componente TEXT,
-                quantidade INTEGER,
-                observacao TEXT,
-                FOREIGN KEY (projeto_id) REFERENCES projetos(id) ON DELETE CASCADE
-            )
-        ''')
-
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS codigo_fonte (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                projeto_id INTEGER,
-                versao INTEGER,
-                codigo TEXT,
-                data_criacao TIMESTAMP,
-                linguagem TEXT,
-                FOREIGN KEY (projeto_id) REFERENCES projetos(id) ON DELETE CASCADE
-            )
-        ''')
-
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS etapas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                projeto_id INTEGER,
-                ordem INTEGER,
-                descricao TEXT,
-                concluida BOOLEAN DEFAULT 0,
-                FOREIGN KEY (projeto_id) REFERENCES projetos(id) ON DELETE CASCADE
-            )
-        ''')
+    def _falando(self):
+        pipeline = getattr(self, 'pipeline_fala', None)
+        return pipeline is not None and pipeline.ocupado()
 
-        self.conn.commit()
+    # ---------- INICIALIZAÇÃO ----------
+    def init_banco_dados(self):
+        self.db = PoolBanco(self.caminho_db)
+        self.cache_respostas = CacheRespostas(self.db)
+        self.codigos = RepositorioCodigo(self.db)
+        self.conversas = MemoriaConversas(self.db)
 
     def criar_contexto_inicial(self):
         """Cria o prompt de sistema baseado no perfil atual e na personalidade"""
+        return [{"role": "system", "content": self._prompt_sistema()}]
+
+    def _prompt_sistema(self):
+        """Renderiza o prompt de sistema; fica em cache até o perfil ou algum valor
+        (arredondado) da personalidade mudar de fato"""
         perfil = self.perfis[self.perfil_atual]
-        p = self.personalidade
+        p = {k: round(v) for k, v in self.personalidade.items()}
+        chave = (self.nome, self.perfil_atual, tuple(sorted(p.items())))
+        if self._cache_prompt[0] == chave:
+            return self._cache_prompt[1]
 
         prompt = f"""Você é {self.nome}, um assistente com múltiplos perfis.
 Perfil atual: {self.perfil_atual.upper()} - {perfil['descricao']}
@@ -225,83 +3344,61 @@ Além disso, você tem as seguintes capacidades técnicas:
 
 Mantenha a personalidade consistente com o perfil atual.
 """
-        return [{"role": "system", "content": prompt}]
-
-    def _falar_gtts(self, texto, emocao='normal'):
-        """Versão sem pygame, usando players de terminal"""
-        import tempfile
-        import subprocess
-        import os
-        import shutil
-        from gtts import gTTS
-        
+        self._cache_prompt = (chave, prompt)
+        return prompt
+
+    def _falar_em_voz(self, texto, emocao='normal', urgente=False):
+        """Fala pelo serviço de reprodução, com o cache de áudio e o seletor de motores.
+
+        O texto é dividido em frases e passa pelo pipeline de fala, que retorna na hora:
+        a síntese e a reprodução continuam em segundo plano. Falas curtas ou urgentes
+        vão inteiras para o motor mais rápido, para não trocar de voz no meio.
+        """
         # Se for modo texto, não faz nada
         if self.modo_entrada == "texto":
             return True
         
-        print(f"🔊 {texto}")  # Mostra no terminal enquanto processa
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as tmp:
-            temp_file = tmp.name
+        self.saida(f"🔊 {texto}")  # Mostra no terminal enquanto processa
         
-        try:
-            # Gerar áudio com gTTS
-            slow = (emocao == 'triste' or emocao == 'cansado')
-            tts = gTTS(text=texto, lang='pt', slow=slow)
-            tts.save(temp_file)
-            
-            # Lista de players em ordem de preferência
-            players = [
-                ('ffplay', ['ffplay', '-nodisp', '-autoexit', '-loglevel', 'quiet', temp_file]),
-                ('mpg123', ['mpg123', '-q', temp_file]),
-                ('mpv', ['mpv', '--no-video', '--quiet', temp_file]),
-                ('aplay', ['aplay', temp_file]),  # para sistemas sem mp3
-            ]
-            
-            # Tentar cada player
-            for player_name, cmd in players:
-                if shutil.which(player_name):
-                    try:
-                        subprocess.run(cmd, check=True, timeout=30, 
-                                    stdout=subprocess.DEVNULL, 
-                                    stderr=subprocess.DEVNULL)
-                        return True
-                    except:
-                        continue
-            
-            # Se não tiver player, pelo menos mostrou no terminal
-            return False
-            
-        except Exception as e:
-            print(f"⚠️ Erro no áudio: {e}")
-            return False
-        finally:
-            try:
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-            except:
-                pass
+        self._emocao_fala = emocao
+        urgente = urgente or self.voz.curta(texto)
+        # Se não tiver player, pelo menos mostrou no terminal
+        return self.pipeline_fala.falar(dividir_frases(texto), urgente=urgente)
+
+    def _sintetizar_frase(self, frase, urgente=False):
+        """Áudio da frase pelo seletor de motores (que consulta o cache) em bytes"""
+        slow = (self._emocao_fala == 'triste' or self._emocao_fala == 'cansado')
+        with self.medidor.etapa('tts'):
+            return self.voz.sintetizar(frase, 'pt', slow, urgente)
+
+    def interromper_fala(self):
+        """Corta a fala em andamento e descarta as frases que ainda não tocaram"""
+        self.pipeline_fala.interromper()
+
+    def _emocao_atual(self):
+        """Determina a emoção da fala a partir da personalidade"""
+        if self.personalidade['humor'] > 70:
+            return 'feliz'
+        elif self.personalidade['humor'] < 30:
+            return 'triste'
+        elif self.personalidade['energia'] < 40:
+            return 'cansado'
+        return 'normal'
     
-    def falar(self, texto):
-        """Método principal de fala"""
-        print(f"🤖 {self.nome} [{self.perfil_atual}]: {texto}")
+    def falar(self, texto, urgente=False):
+        """Método principal de fala; urgente=True para perguntas que esperam resposta"""
+        self.saida(f"🤖 {self.nome} [{self.perfil_atual}]: {texto}")
         
-        if self.modo_entrada == "texto":
+        if self.modo_entrada == "texto" or not self.audio:
             return
         
         # Determinar emoção
-        emocao = 'normal'
-        if self.personalidade['humor'] > 70:
-            emocao = 'feliz'
-        elif self.personalidade['humor'] < 30:
-            emocao = 'triste'
-        elif self.personalidade['energia'] < 40:
-            emocao = 'cansado'
+        emocao = self._emocao_atual()
         
-        # Tentar gTTS
-        if not self._falar_gtts(texto, emocao):
+        if not self._falar_em_voz(texto, emocao, urgente):
             # Fallback: só mostrou no terminal mesmo
             pass
+
     def saudacao_inicial(self):
         hora = datetime.datetime.now().hour
         if 5 <= hora < 12:
@@ -343,22 +3440,7 @@ Mantenha a personalidade consistente com o perfil atual.
                 if dias > 7:
                     saudacao += " Quanto tempo! Senti sua falta!"
 
-        self.falar(saudacao)
-
-    def falar(self, texto):
-        print(f"🤖 {self.nome} [{self.perfil_atual}]: {texto}")
-        if self.modo_entrada != "texto" and hasattr(self, 'engine'):
-            taxa = 180
-            if self.personalidade['energia'] > 70:
-                taxa = 200
-            elif self.personalidade['energia'] < 30:
-                taxa = 150
-            self.engine.setProperty('rate', taxa)
-            try:
-                self.engine.say(texto)
-                self.engine.runAndWait()
-            except:
-                pass
+        self.falar(saudacao)
 
     # ---------- GERENCIAMENTO DE PERFIS ----------
     def mudar_perfil(self, novo_perfil):
@@ -370,9 +3452,10 @@ Mantenha a personalidade consistente com o perfil atual.
         # Carrega a personalidade base do perfil
         self.personalidade = self.perfis[novo_perfil]["personalidade_base"].copy()
         # Reinicia o contexto da conversa (mantém apenas o histórico se quiser, mas resetamos)
-        self.contexto_conversa = self.criar_contexto_inicial()
+        self.contexto.limpar()
         # Atualiza o humor history
         self.humor_history.append(self.personalidade['humor'])
+        self._aquecer_prefetch()
         return True
 
     def listar_perfis(self):
@@ -382,69 +3465,171 @@ Mantenha a personalidade consistente com o perfil atual.
     # ---------- CRUD DE PROJETOS ----------
     def criar_projeto(self, nome, descricao="", linguagem="arduino"):
         try:
-            self.cursor.execute('''
+            pid, _ = self.db.executar('''
                 INSERT INTO projetos (nome, descricao, data_criacao, status, linguagem)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (nome, descricao, datetime.datetime.now(), "em andamento", linguagem))
-            self.conn.commit()
-            return self.cursor.lastrowid
+            ''', (nome, descricao, datetime.datetime.now(), "em andamento", linguagem)).result()
+            return pid
         except Exception as e:
-            print(f"Erro ao criar projeto: {e}")
+            self.saida(f"Erro ao criar projeto: {e}")
             return None
 
-    def listar_projetos(self):
-        self.cursor.execute('SELECT id, nome, descricao, status FROM projetos ORDER BY data_criacao DESC')
-        return self.cursor.fetchall()
+    def listar_projetos(self, limite=20, apos=None):
+        """Uma página de projetos, dos mais recentes para os mais antigos.
+        apos é o cursor (data_criacao, id) do último item da página anterior."""
+        if apos is None:
+            return self.db.ler('''
+                SELECT id, nome, descricao, status, data_criacao FROM projetos
+                ORDER BY data_criacao DESC, id DESC LIMIT ?
+            ''', (limite,))
+        return self.db.ler('''
+            SELECT id, nome, descricao, status, data_criacao FROM projetos
+            WHERE (data_criacao, id) < (?, ?)
+            ORDER BY data_criacao DESC, id DESC LIMIT ?
+        ''', (*apos, limite))
+
+    def contar_projetos(self):
+        return self.db.ler_um('SELECT COUNT(*) FROM projetos')[0]
+
+    def buscar(self, termo, limite=10, apos=None):
+        """Busca em projetos, componentes, código e etapas, ordenada por relevância (bm25,
+        com o título valendo mais). apos é o cursor (relevancia, rowid) do último item."""
+        consulta = consulta_fts(termo)
+        if not consulta:
+            return []
+        depois = "" if apos is None else "WHERE (r.relevancia, r.rowid) > (?, ?)"
+        return self.db.ler(f'''
+            SELECT r.relevancia, r.rowid, r.tipo, r.projeto_id, p.nome, r.titulo, r.trecho
+            FROM (
+                SELECT rowid, tipo, projeto_id, titulo,
+                       bm25(busca, 0, 0, 0, 10.0, 1.0) AS relevancia,
+                       snippet(busca, 4, '[', ']', '…', 10) AS trecho
+                FROM busca WHERE busca MATCH ?
+            ) AS r
+            LEFT JOIN projetos p ON p.id = r.projeto_id
+            {depois}
+            ORDER BY r.relevancia, r.rowid
+            LIMIT ?
+        ''', (consulta, *(apos or ()), limite))
 
     def deletar_projeto(self, projeto_id):
         try:
-            self.cursor.execute('DELETE FROM projetos WHERE id = ?', (projeto_id,))
-            self.conn.commit()
-            return self.cursor.rowcount > 0
+            _, apagados = self.db.executar('DELETE FROM projetos WHERE id = ?', (projeto_id,)).result()
+            if apagados:
+                self.codigos.coletar_lixo()
+            return apagados > 0
         except Exception as e:
-            print(f"Erro ao deletar projeto: {e}")
+            self.saida(f"Erro ao deletar projeto: {e}")
             return False
 
     def listar_componentes(self, projeto_id):
-        self.cursor.execute('''
+        return self.db.ler('''
             SELECT componente, quantidade, observacao 
             FROM componentes_projeto 
             WHERE projeto_id = ?
         ''', (projeto_id,))
-        return self.cursor.fetchall()
 
     def adicionar_componente(self, projeto_id, componente, quantidade, obs=""):
-        self.cursor.execute('''
+        """Enfileira a inserção e devolve um Future com (id, linhas); várias chamadas
+        seguidas são gravadas juntas numa só transação"""
+        return self.db.executar('''
             INSERT INTO componentes_projeto (projeto_id, componente, quantidade, observacao)
             VALUES (?, ?, ?, ?)
         ''', (projeto_id, componente, quantidade, obs))
-        self.conn.commit()
+
+    def importar_bom(self, projeto_id, caminho, ao_progresso=None):
+        """Importa um CSV de BOM numa única transação: itens que já existem no projeto
+        têm a quantidade somada, os novos entram via executemany.
+        Retorna (novos, atualizados, erros, linhas_lidas)."""
+        with open(caminho, newline='', encoding='utf-8-sig') as f:
+            itens, erros, linhas = ler_bom_csv(f, ao_progresso)
+
+        def gravar(conn):
+            existentes = {}
+            for cid, componente in conn.execute(
+                    'SELECT id, componente FROM componentes_projeto WHERE projeto_id = ?', (projeto_id,)):
+                existentes.setdefault(componente.casefold(), cid)
+            atualizar = [(qtd, existentes[chave]) for chave, (_, qtd, _) in itens.items() if chave in existentes]
+            novos = [(projeto_id, comp, qtd, obs) for chave, (comp, qtd, obs) in itens.items()
+                     if chave not in existentes]
+            conn.executemany('UPDATE componentes_projeto SET quantidade = quantidade + ? WHERE id = ?', atualizar)
+            conn.executemany('''
+                INSERT INTO componentes_projeto (projeto_id, componente, quantidade, observacao)
+                VALUES (?, ?, ?, ?)
+            ''', novos)
+            return len(novos), len(atualizar)
+
+        novos, atualizados = self.db.escrever(gravar).result()
+        return novos, atualizados, erros, linhas
+
+    def exportar_bom(self, projeto_id, caminho):
+        """Escreve os componentes do projeto em CSV, em lotes; retorna quantas linhas"""
+        total = 0
+        with open(caminho, 'w', newline='', encoding='utf-8') as f:
+            escritor = csv.writer(f)
+            escritor.writerow(['componente', 'quantidade', 'observacao'])
+            for linha in self.db.iterar('''
+                SELECT componente, quantidade, observacao
+                FROM componentes_projeto
+                WHERE projeto_id = ?
+                ORDER BY id
+            ''', (projeto_id,)):
+                escritor.writerow(linha)
+                total += 1
+        return total
+
+    def projeto_existe(self, projeto_id):
+        return self.db.ler_um('SELECT 1 FROM projetos WHERE id = ?', (projeto_id,)) is not None
 
     # ---------- ENTRETENIMENTO ----------
+    PROMPTS_ENTRETENIMENTO = {
+        'fato': ("Conte um fato curioso e interessante sobre qualquer assunto, de preferência algo que pouca gente sabe.", 0.9),
+        'conselho': ("Dê um conselho criativo e útil para um amigo que mexe com eletrônica, com uma pitada de humor.", 0.8),
+    }
+
+    def _gerar_entretenimento(self, chave, etapa='llm'):
+        """Gera um fato ou conselho para o perfil, no tom dele (usado pelo prefetch)"""
+        tipo, perfil = chave
+        prompt, temperatura = self.PROMPTS_ENTRETENIMENTO[tipo]
+        prompt += f" Responda num tom {self.perfis[perfil]['tom']}."
+        return self._completar([{"role": "user", "content": prompt}], temperatura, prazo=15, etapa=etapa)
+
+    def _aquecer_prefetch(self):
+        if self.prefetch is None or not self.usar_ia:
+            return
+        self.prefetch.aquecer(('fato', self.perfil_atual))
+        if self.personalidade['criatividade'] > 80:
+            self.prefetch.aquecer(('conselho', self.perfil_atual))
+
+    def _entretenimento(self, tipo):
+        """Pega um item pré-gerado; se a fila estiver vazia, gera na hora"""
+        chave = (tipo, self.perfil_atual)
+        if self.prefetch is not None:
+            item = self.prefetch.obter(chave)
+            if item:
+                return item
+        item = self._gerar_entretenimento(chave)
+        if self.prefetch is not None:
+            for _ in range(2):
+                if not self.prefetch.ja_servido(item):
+                    break
+                item = self._gerar_entretenimento(chave)
+            self.prefetch.marcar_servido(item)
+        return item
+
     def fato_aleatorio(self):
-        prompt = "Conte um fato curioso e interessante sobre qualquer assunto, de preferência algo que pouca gente sabe."
         try:
-            resposta = self.client.chat.completions.create(
-                messages=[{"role": "user", "content": prompt}],
-                model=self.modelo_padrao,
-                temperature=0.9
-            )
-            return resposta.choices[0].message.content
-        except:
+            return self._entretenimento('fato')
+        except Exception as e:
+            self.falha_llm = f"{type(e).__name__}: {e}"
             return "Sabia que polvos têm três corações? Esse é um fato, mas tive problemas pra buscar agora."
 
     def conselho_aleatorio(self):
         if self.personalidade['criatividade'] > 80:
             try:
-                prompt = "Dê um conselho criativo e útil para um amigo que mexe com eletrônica, com uma pitada de humor."
-                resposta = self.client.chat.completions.create(
-                    messages=[{"role": "user", "content": prompt}],
-                    model=self.modelo_padrao,
-                    temperature=0.8
-                )
-                return resposta.choices[0].message.content
-            except:
-                pass
+                return self._entretenimento('conselho')
+            except Exception as e:
+                self.falha_llm = f"{type(e).__name__}: {e}"
         conselhos = [
             "Nunca solde com o ferro desligado. Parece óbvio, mas já vi acontecer.",
             "Se algo não funciona, verifique se está plugado. 90% das vezes é isso.",
@@ -456,242 +3641,528 @@ Mantenha a personalidade consistente com o perfil atual.
 
     # ---------- PROCESSAMENTO DE COMANDOS ----------
     def processar_comando(self, comando):
-        comando = comando.lower().strip()
+        # Tarefas de fundo (autosave, decaimento, manutenção) não rodam durante o turno
+        with self.agendador.turno():
+            self._atender(comando)
 
-        # Comandos de sistema
-        if comando in ['sair', 'tchau', 'encerrar']:
-            self.falar(random.choice([
-                "Até mais! Não esqueça de desligar o ferro de solda!",
-                "Falou! Vou recarregar as baterias.",
-                "Tchau! Foi bom conversar!"
-            ]))
-            self.salvar_memoria()
-            self.conn.close()
-            self.ativo = False
+    def _atender(self, comando):
+        with self.medidor.etapa('roteamento'):
+            rota, args = self.roteador.resolver(comando)
+        if rota is not None:
+            if args is None:
+                self.falar(rota.uso)
+            else:
+                getattr(self, rota.handler)(**args)
             return
 
-        elif comando == 'ajuda':
-            self.mostrar_ajuda()
-            return
+        # Se não for comando especial, usa IA (se ativa)
+        comando = comando.lower().strip()
+        if self.usar_ia:
+            if self.streaming:
+                self.responder_em_stream(comando)
+            else:
+                resposta = self.processar_comando_ia(comando)
+                self.falar(resposta)
+        else:
+            self.falar("Modo IA desligado. Use 'toggle ia' para ativar.")
 
-        # Comandos de perfil
-        elif comando.startswith('mudar perfil') or comando.startswith('perfil'):
-            # Ex: "mudar perfil bancada", "perfil madrugada"
-            partes = comando.split()
-            if len(partes) >= 2:
-                nome_perfil = partes[-1]  # pega a última palavra
-                if nome_perfil in self.perfis:
-                    if self.mudar_perfil(nome_perfil):
-                        self.falar(f"Perfil alterado para {nome_perfil}. {self.perfis[nome_perfil]['descricao']}")
-                    else:
-                        self.falar("Falha ao mudar de perfil.")
+    # Comandos de sistema
+    @comando('sair', 'tchau', 'encerrar')
+    def _cmd_sair(self):
+        self.agendador.parar()
+        self.falar(random.choice(self.DESPEDIDAS))
+        self.pipeline_fala.esperar(timeout=10)
+        self.imagens.fechar()
+        self.salvar_memoria()
+        self.db.fechar()
+        if hasattr(self, 'microphone'):
+            self.ouvinte.parar()
+        self.ativo = False
+
+    @comando('ajuda')
+    def _cmd_ajuda(self):
+        self.mostrar_ajuda()
+
+    # Comandos de perfil
+    @comando('mudar perfil {nome:texto?}', 'perfil {nome:texto?}')
+    def _cmd_mudar_perfil(self, nome=None):
+        # Ex: "mudar perfil bancada", "perfil madrugada"
+        if nome:
+            nome_perfil = nome.split()[-1]  # pega a última palavra
+            if nome_perfil in self.perfis:
+                if self.mudar_perfil(nome_perfil):
+                    self.falar(f"Perfil alterado para {nome_perfil}. {self.perfis[nome_perfil]['descricao']}")
                 else:
-                    self.falar(f"Perfil '{nome_perfil}' não existe. Digite 'perfis' para ver os disponíveis.")
+                    self.falar("Falha ao mudar de perfil.")
             else:
-                self.falar("Especifique o nome do perfil. Ex: 'mudar perfil bancada'")
-            return
+                self.falar(f"Perfil '{nome_perfil}' não existe. Digite 'perfis' para ver os disponíveis.")
+        else:
+            self.falar("Especifique o nome do perfil. Ex: 'mudar perfil bancada'")
 
-        elif comando == 'perfis':
-            lista = self.listar_perfis()
-            msg = "Perfis disponíveis:\n"
-            for nome, desc in lista:
-                msg += f"• {nome}: {desc}\n"
-            print(msg)
-            self.falar("Lista de perfis exibida no terminal.")
-            return
+    @comando('perfis')
+    def _cmd_perfis(self):
+        lista = self.listar_perfis()
+        msg = "Perfis disponíveis:\n"
+        for nome, desc in lista:
+            msg += f"• {nome}: {desc}\n"
+        self.saida(msg)
+        self.falar("Lista de perfis exibida no terminal.")
 
-        # Alternar IA
-        elif comando == 'toggle ia':
-            self.usar_ia = not self.usar_ia
-            self.falar(f"IA {'ativada' if self.usar_ia else 'desativada'}.")
-            return
+    # Alternar IA
+    @comando('toggle ia')
+    def _cmd_toggle_ia(self):
+        self.usar_ia = not self.usar_ia
+        self.falar(f"IA {'ativada' if self.usar_ia else 'desativada'}.")
 
-        # Modos
-        elif comando in ['modo texto', 'modo voz', 'modo hibrido']:
-            novo_modo = comando.split()[1]
-            if novo_modo == 'voz' and not hasattr(self, 'microphone'):
-                self.falar("Microfone não disponível.")
-            else:
-                self.modo_entrada = novo_modo
-                self.falar(f"Modo {novo_modo} ativado.")
+    @comando('cache stats')
+    def _cmd_cache_stats(self):
+        st = self.cache_respostas.estatisticas()
+        self.saida(f'''
+📦 CACHE DE RESPOSTAS (IA):
+  Itens: {st['itens']} | Tamanho: {st['bytes'] / 1024:.1f} KB
+  Nesta sessão: {st['acertos']} acertos, {st['falhas']} falhas ({st['taxa_acerto']:.0%} de acerto)
+  Acertos acumulados: {st['acertos_total']}''')
+        if self.audio:
+            audio = self.cache_audio.estatisticas()
+            self.saida(f"🔊 CACHE DE ÁUDIO:\n  Itens: {audio['itens']} | Tamanho: {audio['bytes'] / 1024:.1f} KB\n")
+        self.falar(f"Taxa de acerto do cache: {st['taxa_acerto']:.0%}. Detalhes no terminal.")
+
+    @comando('tarefas')
+    def _cmd_tarefas(self):
+        self.saida(f"\n🗓️ TAREFAS EM SEGUNDO PLANO:\n{self.agendador.relatorio()}\n")
+        self.falar("Tarefas em segundo plano no terminal.")
+
+    @comando('latencia')
+    def _cmd_latencia(self):
+        if not self.medidor.amostras:
+            self.falar("Ainda não há medições nesta sessão.")
             return
+        self.saida(f"\n⏱️ LATÊNCIA POR ETAPA (nesta sessão):\n{self.medidor.relatorio()}\n")
+        if self.audio:
+            self.saida(f"🔊 MOTORES DE VOZ:\n{self.voz.relatorio()}\n")
+        self.falar("Latências no terminal.")
 
-        # ---------- PROJETOS ----------
-        elif comando.startswith('projeto novo'):
-            nome = comando.replace('projeto novo', '').strip()
-            if nome:
-                pid = self.criar_projeto(nome)
-                if pid:
-                    self.falar(f"Projeto '{nome}' criado com ID {pid}!")
+    # Modos
+    @comando('modo {novo_modo:texto|voz|hibrido}')
+    def _cmd_modo(self, novo_modo):
+        if novo_modo == 'voz' and not hasattr(self, 'microphone'):
+            self.falar("Microfone não disponível.")
+        else:
+            self.modo_entrada = novo_modo
+            if hasattr(self, 'microphone'):
+                if novo_modo == 'texto':
+                    self.ouvinte.pausar()
                 else:
-                    self.falar("Erro ao criar projeto.")
+                    self.ouvinte.retomar()
+            self.falar(f"Modo {novo_modo} ativado.")
+
+    # ---------- PROJETOS ----------
+    @comando('projeto novo {nome:texto?}')
+    def _cmd_projeto_novo(self, nome=None):
+        if nome:
+            pid = self.criar_projeto(nome)
+            if pid:
+                self.falar(f"Projeto '{nome}' criado com ID {pid}!")
             else:
-                self.falar("Digite o nome do projeto. Ex: 'projeto novo Fonte 5V'")
+                self.falar("Erro ao criar projeto.")
+        else:
+            self.falar("Digite o nome do projeto. Ex: 'projeto novo Fonte 5V'")
+
+    def _paginar(self, carregar, mostrar, tamanho, apos=None):
+        """Mostra uma página e guarda em self._pagina_seguinte como pedir a próxima.
+        carregar(limite, apos) -> linhas; cursor(linha) vem de mostrar(linhas) -> função"""
+        linhas = carregar(tamanho + 1, apos)
+        tem_mais = len(linhas) > tamanho
+        linhas = linhas[:tamanho]
+        cursor = mostrar(linhas)
+        if tem_mais and linhas:
+            proximo = cursor(linhas[-1])
+            self._pagina_seguinte = lambda: self._paginar(carregar, mostrar, tamanho, proximo)
+        else:
+            self._pagina_seguinte = None
+        return linhas, tem_mais
+
+    @comando('listar projetos {resto:texto?}')
+    def _cmd_listar_projetos(self, resto=None):
+        total = self.contar_projetos()
+        if not total:
+            self.falar("Nenhum projeto cadastrado.")
             return
 
-        elif comando.startswith('listar projetos'):
-            projetos = self.listar_projetos()
-            if projetos:
-                resp = "Projetos:\n"
-                for pid, nome, desc, status in projetos:
-                    resp += f"ID {pid}: {nome} - {status}\n"
-                print(resp)
-                self.falar(f"Encontrei {len(projetos)} projetos. Veja no terminal.")
-            else:
-                self.falar("Nenhum projeto cadastrado.")
+        def mostrar(projetos):
+            resp = "Projetos:\n"
+            for pid, nome, desc, status, _ in projetos:
+                resp += f"ID {pid}: {nome} - {status}\n"
+            self.saida(resp)
+            return lambda ultimo: (ultimo[4], ultimo[0])
+
+        _, tem_mais = self._paginar(lambda limite, apos: self.listar_projetos(limite, apos), mostrar, 20)
+        if tem_mais:
+            self.falar(f"Encontrei {total} projetos. Mostrei os 20 mais recentes; diga 'mais' para continuar.")
+        else:
+            self.falar(f"Encontrei {total} projetos. Veja no terminal.")
+
+    @comando('buscar {termo:texto?}')
+    def _cmd_buscar(self, termo=None):
+        if not termo or not consulta_fts(termo):
+            self.falar("O que devo buscar? Ex: 'buscar regulador'")
             return
+        icones = {'projeto': '📁', 'componente': '🔩', 'codigo': '💻', 'etapa': '📋'}
 
-        elif comando.startswith('deletar projeto'):
-            partes = comando.split()
-            if len(partes) >= 3 and partes[2].isdigit():
-                pid = int(partes[2])
-                self.falar(f"Tem certeza que deseja deletar o projeto ID {pid}? (sim/não)")
-                confirmacao = self.aguardar_resposta_sim_nao()
-                if confirmacao == 'sim':
-                    if self.deletar_projeto(pid):
-                        self.falar("Projeto deletado com sucesso.")
-                    else:
-                        self.falar("Falha ao deletar projeto. Verifique o ID.")
-                else:
-                    self.falar("Operação cancelada.")
-            else:
-                self.falar("Formato: deletar projeto [ID]")
+        def mostrar(resultados):
+            if not resultados:
+                return None
+            resp = f"Resultados para '{termo}':\n"
+            for _, _, tipo, pid, nome_projeto, titulo, trecho in resultados:
+                rotulo = titulo if tipo in ('projeto', 'componente') else tipo
+                resp += f"{icones[tipo]} [projeto {pid}: {nome_projeto}] {rotulo}"
+                resp += f" — {' '.join(trecho.split())}\n" if trecho else "\n"
+            self.saida(resp)
+            return lambda ultimo: (ultimo[0], ultimo[1])
+
+        resultados, tem_mais = self._paginar(lambda limite, apos: self.buscar(termo, limite, apos), mostrar, 10)
+        if not resultados:
+            self.falar(f"Nada encontrado para '{termo}'.")
+        elif tem_mais:
+            self.falar("Mostrei os 10 resultados mais relevantes; diga 'mais' para continuar.")
+        else:
+            self.falar(f"Encontrei {len(resultados)} resultados. Veja no terminal.")
+
+    @comando('mais')
+    def _cmd_mais(self):
+        if self._pagina_seguinte is None:
+            self.falar("Não há mais resultados.")
             return
+        _, tem_mais = self._pagina_seguinte()
+        if not tem_mais:
+            self.falar("Esses foram os últimos.")
 
-        elif comando.startswith('componentes do projeto') or comando.startswith('lista componentes'):
-            numeros = re.findall(r'\d+', comando)
-            if numeros:
-                pid = int(numeros[0])
-                comps = self.listar_componentes(pid)
-                if comps:
-                    resp = f"Componentes do projeto ID {pid}:\n"
-                    for comp, qtd, obs in comps:
-                        resp += f"- {comp}: {qtd} un. {obs}\n"
-                    print(resp)
-                    self.falar(f"Encontrei {len(comps)} componentes. Veja no terminal.")
-                else:
-                    self.falar("Nenhum componente cadastrado para este projeto.")
+    @comando('deletar projeto {pid:id}', uso="Formato: deletar projeto [ID]")
+    def _cmd_deletar_projeto(self, pid):
+        self.falar(f"Tem certeza que deseja deletar o projeto ID {pid}? (sim/não)", urgente=True)
+        confirmacao = self.aguardar_resposta_sim_nao()
+        if confirmacao == 'sim':
+            if self.deletar_projeto(pid):
+                self.falar("Projeto deletado com sucesso.")
             else:
-                self.falar("Forneça o ID do projeto. Ex: 'componentes do projeto 5'")
+                self.falar("Falha ao deletar projeto. Verifique o ID.")
+        else:
+            self.falar("Operação cancelada.")
+
+    @comando('componentes do projeto {pid:id}', 'lista componentes {pid:id}',
+             uso="Forneça o ID do projeto. Ex: 'componentes do projeto 5'")
+    def _cmd_componentes(self, pid):
+        comps = self.listar_componentes(pid)
+        if comps:
+            resp = f"Componentes do projeto ID {pid}:\n"
+            for comp, qtd, obs in comps:
+                resp += f"- {comp}: {qtd} un. {obs}\n"
+            self.saida(resp)
+            self.falar(f"Encontrei {len(comps)} componentes. Veja no terminal.")
+        else:
+            self.falar("Nenhum componente cadastrado para este projeto.")
+
+    @comando('importar bom {pid:id} {arquivo:bruto}', uso="Formato: importar bom [ID] [arquivo.csv]")
+    def _cmd_importar_bom(self, pid, arquivo):
+        if not self.projeto_existe(pid):
+            self.falar(f"Projeto ID {pid} não encontrado.")
+            return
+        if not os.path.isfile(arquivo):
+            self.falar(f"Arquivo '{arquivo}' não encontrado.")
+            return
+        try:
+            novos, atualizados, erros, linhas = self.importar_bom(
+                pid, arquivo, ao_progresso=lambda n: self.saida(f"\r📥 {n} linhas lidas...", end="", flush=True))
+        except (ValueError, csv.Error, UnicodeDecodeError) as e:
+            self.saida()
+            self.falar(f"Não consegui ler o BOM: {e}")
             return
+        self.saida(f"\r📥 {linhas} linhas lidas.      ")
+        for numero, motivo in erros[:10]:
+            self.saida(f"  ⚠️ linha {numero}: {motivo}")
+        if len(erros) > 10:
+            self.saida(f"  ... e mais {len(erros) - 10} linhas com erro")
+        self.falar(f"BOM importado no projeto {pid}: {novos} componentes novos, "
+                   f"{atualizados} somados a existentes, {len(erros)} linhas ignoradas.")
 
-        # ---------- IMAGENS ----------
-        elif comando.startswith('gerar imagem'):
-            desc = comando.replace('gerar imagem', '').strip()
-            if desc:
-                self.falar(f"Gerando imagem de: {desc}. Isso pode levar alguns segundos...")
-                # Animação simples
-                print("🔄 Processando", end="")
-                for i in range(5):
-                    time.sleep(0.5)
-                    print(".", end="", flush=True)
-                print()
-        # ---------- ENTRETENIMENTO ----------
-        elif comando in ['fato', 'curiosidade']:
-            fato = self.fato_aleatorio()
-            self.falar(fato)
+    @comando('exportar bom {pid:id} {arquivo:bruto?}', uso="Formato: exportar bom [ID] [arquivo.csv]")
+    def _cmd_exportar_bom(self, pid, arquivo=None):
+        if not self.projeto_existe(pid):
+            self.falar(f"Projeto ID {pid} não encontrado.")
             return
+        arquivo = arquivo or f"bom_projeto_{pid}.csv"
+        total = self.exportar_bom(pid, arquivo)
+        self.falar(f"Exportei {total} componentes do projeto {pid} para {arquivo}.")
 
-        elif comando == 'conselho':
-            conselho = self.conselho_aleatorio()
-            self.falar(conselho)
+    # ---------- IMAGENS ----------
+    @comando('gerar imagem {desc:texto?}')
+    def _cmd_gerar_imagem(self, desc=None):
+        if not desc:
+            self.falar("Descreva a imagem. Exemplo: gerar imagem placa de circuito com leds azuis.")
             return
+        try:
+            trabalho, situacao = self.imagens.submeter(desc, ao_concluir=self._imagem_concluida)
+        except FilaImagensCheia:
+            self.falar("Já há muitas imagens na fila. Tente de novo em instantes.")
+            return
+        if situacao == 'cache':
+            self.saida(f"🖼️ {trabalho.caminho}")
+            self.falar(f"Essa imagem já estava pronta. Pedido {trabalho.id}.")
+        elif situacao == 'agrupado':
+            self.falar(f"Essa imagem já está sendo gerada no pedido {trabalho.id}.")
+        else:
+            self.falar(f"Pedido de imagem {trabalho.id} na fila. "
+                       f"Use status imagem {trabalho.id} para acompanhar.")
 
-        elif comando == 'piada':
-            piadas = [
-                "Por que os eletrônicos são tão calmos? Porque têm muitos capacitores!",
-                "O que um resistor disse para o outro? Vamos nos conectar!",
-                "Qual é o contrário de LED? DEL! ...Tá, foi ruim, eu sei.",
-                "Por que o transistor foi ao médico? Porque estava com emissor de corrente!"
-            ]
-            self.falar(random.choice(piadas))
+    @comando('status imagem {tid:id?}', 'status imagens')
+    def _cmd_status_imagem(self, tid=None):
+        if tid is None:
+            trabalhos = self.imagens.recentes()
+            if not trabalhos:
+                self.falar("Nenhuma imagem pedida nesta sessão.")
+                return
+            self.saida("\n🖼️ IMAGENS RECENTES:")
+            for t in trabalhos:
+                self.saida(f"  {self._resumo_imagem(t)}")
+            self.saida()
+            self.falar(f"{self.imagens.pendentes()} imagens em andamento. Detalhes no terminal.")
             return
+        trabalho = self.imagens.obter(tid)
+        if trabalho is None:
+            self.falar(f"Pedido de imagem {tid} não encontrado.")
+            return
+        self.saida(f"🖼️ {self._resumo_imagem(trabalho)}")
+        if trabalho.estado == 'pronta':
+            self.falar(f"Imagem {tid} pronta.")
+        elif trabalho.estado == 'erro':
+            self.falar(f"A imagem {tid} falhou: {trabalho.erro}")
+        elif trabalho.estado == 'gerando':
+            self.falar(f"Imagem {tid} em {trabalho.progresso:.0%}.")
+        else:
+            self.falar(f"Imagem {tid} na fila, {self.imagens.posicao(trabalho)} na frente.")
+
+    def _resumo_imagem(self, t):
+        if t.estado == 'pronta':
+            detalhe = f"pronta em {t.duracao():.1f}s -> {t.caminho}"
+        elif t.estado == 'erro':
+            detalhe = f"erro: {t.erro}"
+        elif t.estado == 'gerando':
+            detalhe = f"gerando {t.progresso:.0%} ({t.duracao():.1f}s)"
+        else:
+            detalhe = f"na fila ({self.imagens.posicao(t)} na frente)"
+        agrupados = f" [{t.pedidos} pedidos]" if t.pedidos > 1 else ""
+        return f"#{t.id} \"{t.prompt[:40]}\": {detalhe}{agrupados}"
+
+    def _imagem_concluida(self, trabalho):
+        """Avisa na saída desta sessão quando uma imagem pedida nela termina (roda na
+        thread do gerador)"""
+        self.saida(f"\n🖼️ Imagem {self._resumo_imagem(trabalho)}")
+
+    # ---------- ENTRETENIMENTO ----------
+    @comando('fato', 'curiosidade')
+    def _cmd_fato(self):
+        fato = self.fato_aleatorio()
+        self.falar(fato)
+
+    @comando('conselho')
+    def _cmd_conselho(self):
+        conselho = self.conselho_aleatorio()
+        self.falar(conselho)
 
-        # ---------- CÓDIGO ----------
-        elif comando.startswith('gerar codigo'):
-            desc = comando.replace('gerar codigo', '').strip()
-            if desc:
-                self.falar("Gerando código...")
+    @comando('piada')
+    def _cmd_piada(self):
+        self.falar(random.choice(self.PIADAS))
+
+    # ---------- CÓDIGO ----------
+    @comando('gerar codigo {desc:texto?}')
+    def _cmd_gerar_codigo(self, desc=None):
+        if desc:
+            self.falar("Gerando código...")
+            if self.streaming:
+                self.saida("\n--- CÓDIGO GERADO ---")
+                codigo = self.gerar_codigo(desc, self.linguagem_padrao,
+                                           ao_receber=lambda t: self.saida(t, end="", flush=True))
+                self.saida("\n----------------------\n")
+            else:
                 codigo = self.gerar_codigo(desc, self.linguagem_padrao)
                 if codigo:
-                    print(f"\n--- CÓDIGO GERADO ---\n{codigo}\n----------------------\n")
-                    self.ultimo_codigo_gerado = codigo
-                    self.falar("Código gerado! Confira no terminal. Quer salvar em algum projeto?")
-                else:
-                    self.falar("Não consegui gerar o código.")
+                    self.saida(f"\n--- CÓDIGO GERADO ---\n{codigo}\n----------------------\n")
+            if codigo:
+                self.ultimo_codigo_gerado = codigo
+                self.falar("Código gerado! Confira no terminal. Para guardar, diga 'salvar codigo' e o ID do projeto.")
             else:
-                self.falar("Descreva o que o código deve fazer.")
+                self.falar("Não consegui gerar o código.")
+        else:
+            self.falar("Descreva o que o código deve fazer.")
+
+    @comando('salvar codigo {pid:id}', uso="Diga o ID do projeto. Ex: 'salvar codigo 5'")
+    def _cmd_salvar_codigo(self, pid):
+        if not self.ultimo_codigo_gerado:
+            self.falar("Ainda não gerei nenhum código nesta sessão.")
+            return
+        if not self.projeto_existe(pid):
+            self.falar(f"Projeto {pid} não encontrado.")
             return
+        versao, nova = self.codigos.salvar(pid, self.ultimo_codigo_gerado, self.linguagem_padrao).result()
+        if nova:
+            self.falar(f"Código salvo como versão {versao} do projeto {pid}.")
+        else:
+            self.falar(f"Esse código já é a versão {versao} do projeto {pid}.")
 
-        # Se não for comando especial, usa IA (se ativa)
-        if self.usar_ia:
-            resposta = self.processar_comando_ia(comando)
-            self.falar(resposta)
+    @comando('historico codigo {pid:id}', uso="Diga o ID do projeto. Ex: 'historico codigo 5'")
+    def _cmd_historico_codigo(self, pid):
+        historico = self.codigos.historico(pid)
+        if not historico:
+            self.falar(f"O projeto {pid} não tem código salvo.")
+            return
+        resp = f"Versões do código do projeto {pid}:\n"
+        total, gravados = 0, 0
+        for versao, data, linguagem, tamanho, bytes_gravados, tipo in historico:
+            if tamanho is None:
+                resp += f"v{versao}: {str(data)[:16]} ({linguagem}) - {tipo}\n"
+                continue
+            total += tamanho
+            gravados += bytes_gravados
+            resp += f"v{versao}: {str(data)[:16]} ({linguagem}) - {tamanho} bytes, {tipo}"
+            resp += f" ({bytes_gravados} gravados)\n" if bytes_gravados else "\n"
+        if total:
+            resp += f"Total: {total} bytes de código em {gravados} bytes no banco\n"
+        self.saida(resp)
+        self.falar(f"O projeto {pid} tem {len(historico)} versões de código. Veja no terminal.")
+
+    @comando('ver codigo {pid:id} {versao:id?}', uso="Ex: 'ver codigo 5' ou 'ver codigo 5 2'")
+    def _cmd_ver_codigo(self, pid, versao=None):
+        codigo = self.codigos.obter(pid, versao)
+        if codigo is None:
+            self.falar("Versão não encontrada.")
+            return
+        self.saida(f"\n--- PROJETO {pid}{f' v{versao}' if versao else ''} ---\n{codigo}\n----------------------\n")
+        self.falar("Código no terminal.")
+
+    @comando('diff codigo {pid:id} {de:id?} {para:id?}',
+             uso="Ex: 'diff codigo 5' (duas últimas versões) ou 'diff codigo 5 1 3'")
+    def _cmd_diff_codigo(self, pid, de=None, para=None):
+        if de is None or para is None:
+            versoes = [v[0] for v in self.codigos.historico(pid)]
+            if de is not None:
+                para = versoes[-1] if versoes else None
+            elif len(versoes) >= 2:
+                de, para = versoes[-2], versoes[-1]
+        diff = self.codigos.diff(pid, de, para) if de and para else None
+        if diff is None:
+            self.falar("Preciso de duas versões existentes para comparar.")
+        elif not diff:
+            self.falar(f"As versões {de} e {para} são iguais.")
         else:
-            self.falar("Modo IA desligado. Use 'toggle ia' para ativar.")
+            self.saida(f"\n{diff}")
+            self.falar(f"Diferenças entre as versões {de} e {para} no terminal.")
 
     def aguardar_resposta_sim_nao(self, timeout=10):
-        inicio = time.time()
-        while time.time() - inicio < timeout:
-            if self.modo_entrada == "texto" or self.modo_entrada == "hibrido":
-                try:
-                    r = input("📝 Você: ").strip().lower()
-                    if r in ['sim', 's', 'yes', 'y']:
-                        return 'sim'
-                    elif r in ['não', 'nao', 'n', 'no']:
-                        return 'nao'
-                except:
-                    pass
-            if self.modo_entrada in ["voz", "hibrido"] and hasattr(self, 'microphone'):
-                try:
-                    with self.microphone as source:
-                        audio = self.recognizer.listen(source, timeout=2, phrase_time_limit=3)
-                        texto = self.recognizer.recognize_google(audio, language='pt-BR').lower()
-                        if 'sim' in texto or 'pode' in texto:
-                            return 'sim'
-                        elif 'não' in texto or 'nao' in texto:
-                            return 'nao'
-                except:
-                    pass
-            time.sleep(0.5)
-        return 'nao'
+        """'sim' ou 'nao', digitado ou falado; sem resposta no prazo, conta como 'nao'"""
+        limite = time.monotonic() + timeout
+        while True:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return 'nao'
+            origem, resposta = self.ler_comando(timeout=restante)
+            if origem is None:
+                return 'nao'
+            if origem == EntradaMultiplexada.FIM:
+                if not self._voz_disponivel():
+                    return 'nao'
+                continue
+            palavras = set(re.findall(r'\w+', (resposta or '').lower()))
+            if palavras & {'não', 'nao', 'n', 'no'}:
+                return 'nao'
+            if palavras & {'sim', 's', 'yes', 'y', 'pode'}:
+                return 'sim'
+            self.falar("Responda sim ou não.", urgente=True)
 
     # ---------- IA ----------
-    def processar_comando_ia(self, mensagem_usuario):
-        try:
-            # Atualiza o prompt de sistema conforme personalidade atual
-            self.contexto_conversa[0] = {"role": "system", "content": self.criar_contexto_inicial()[0]['content']}
-            self.contexto_conversa.append({"role": "user", "content": mensagem_usuario})
-
-            print("Processando...")
-            resposta = self.client.chat.completions.create(
-                messages=self.contexto_conversa,
-                model=self.modelo_padrao,
-                temperature=0.9
-            )
+    def _completar(self, messages, temperature, ao_receber=None, prazo=None, cache=False, etapa='llm'):
+        """Chamada ao modelo; com ao_receber, usa streaming e repassa cada token.
+        Com cache=True, consulta e alimenta o cache de respostas. O tempo vai para a
+        etapa dada do medidor."""
+        chave = None
+        if cache:
+            chave = CacheRespostas.chave(getattr(self.llm, 'modelo', ''), temperature, messages)
+            texto = self.cache_respostas.obter(chave)
+            if texto is not None:
+                if ao_receber is not None:
+                    ao_receber(texto)
+                return texto
+        with self.medidor.etapa(etapa):
+            if ao_receber is None:
+                texto = self.llm.completar(messages, temperature, prazo=prazo)
+            else:
+                inicio = time.perf_counter()
+                partes = []
+                for token in self.llm.stream(messages, temperature, prazo=prazo):
+                    if not partes:
+                        self.medidor.registrar('llm_primeiro_token', time.perf_counter() - inicio)
+                    partes.append(token)
+                    ao_receber(token)
+                texto = "".join(partes)
+        if chave is not None and texto:
+            self.cache_respostas.guardar(chave, texto)
+        return texto
 
-            texto_resposta = resposta.choices[0].message.content
-            self.contexto_conversa.append({"role": "assistant", "content": texto_resposta})
+    def processar_comando_ia(self, mensagem_usuario, ao_receber=None):
+        try:
+            # O prompt de sistema acompanha a personalidade atual (renderizado só quando ela muda)
+            self.contexto.adicionar("user", mensagem_usuario)
+            # Do histórico antigo vão só os trechos parecidos com a pergunta, não tudo
+            no_contexto = (len(self.contexto.mensagens) - 1) // 2
+            with self.medidor.etapa('memoria'):
+                lembrancas = self.conversas.trechos(mensagem_usuario, ignorar_ultimas=no_contexto,
+                                                    sessao=self.sessao_conversas)
+            mensagens = self.contexto.montar(self._prompt_sistema() + lembrancas)
 
-            if len(self.contexto_conversa) > 21:
-                self.contexto_conversa = [self.contexto_conversa[0]] + self.contexto_conversa[-20:]
+            if ao_receber is None:
+                self.saida("Processando...")
+            texto_resposta = self._completar(mensagens, 0.9, ao_receber, prazo=45)
+            self.contexto.adicionar("assistant", texto_resposta)
 
             self.atualizar_personalidade(mensagem_usuario, texto_resposta)
+            self.registrar_interacao(mensagem_usuario, texto_resposta)
             return texto_resposta
         except Exception as e:
-            print(f"Erro na API: {e}")
+            self.falha_llm = f"{type(e).__name__}: {e}"
+            self.saida(f"Erro na API: {e}")
             return "Desculpe, tive um problema. Vamos tentar de novo?"
 
-    def gerar_codigo(self, descricao, linguagem):
+    def responder_em_stream(self, mensagem_usuario):
+        """Mostra os tokens no terminal conforme chegam e fala cada frase assim que fecha"""
+        recebeu = []
+        fala = None
+        if self.modo_entrada != "texto" and self.audio:
+            self._emocao_fala = self._emocao_atual()
+            fala = FalaIncremental(self.pipeline_fala.falar)
+
+        def ao_receber(token):
+            if not recebeu:
+                self.saida(f"🤖 {self.nome} [{self.perfil_atual}]: ", end="")
+            recebeu.append(token)
+            self.saida(token, end="", flush=True)
+            if fala:
+                fala.alimentar(token)
+
+        resposta = self.processar_comando_ia(mensagem_usuario, ao_receber=ao_receber)
+        if recebeu:
+            self.saida()
+            if fala:
+                fala.finalizar()
+        else:
+            self.falar(resposta)
+        return resposta
+
+    def gerar_codigo(self, descricao, linguagem, ao_receber=None):
         prompt = f"Gere código em {linguagem} para: {descricao}. Forneça apenas o código, sem explicações."
         try:
-            resposta = self.client.chat.completions.create(
-                messages=[{"role": "user", "content": prompt}],
-                model=self.modelo_padrao,
-                temperature=0.5
-            )
-            return resposta.choices[0].message.content
-        except:
+            return self._completar([{"role": "user", "content": prompt}], 0.5, ao_receber, prazo=90,
+                                   cache=True)
+        except Exception as e:
+            self.falha_llm = f"{type(e).__name__}: {e}"
             return None
 
     def atualizar_personalidade(self, pergunta, resposta):
@@ -704,139 +4175,792 @@ Mantenha a personalidade consistente com o perfil atual.
         self.humor_history.append(self.personalidade['humor'])
 
     # ---------- ENTRADA ----------
-    def ouvir_voz(self):
-        if not hasattr(self, 'microphone'):
-            return None
-        try:
-            with self.microphone as source:
-                print("\n🎤 Ouvindo...")
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.2)
-                audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
-            comando = self.recognizer.recognize_google(audio, language='pt-BR')
-            print(f"📝 Você disse: {comando}")
-            return comando.lower()
-        except Exception:
-            return None
+    def _voz_disponivel(self):
+        return hasattr(self, 'microphone') and self.modo_entrada != "texto"
 
-    def ler_texto(self):
-        try:
-            comando = input("📝 Você: ").strip()
-            return comando.lower() if comando else None
-        except KeyboardInterrupt:
-            return "sair"
+    def ler_comando(self, timeout=None):
+        """(origem, texto) do primeiro que chegar, teclado ou voz; (None, None) se o prazo acabar"""
+        prompt = self.modo_entrada != "voz" and not self.entrada.fechada
+        if prompt:
+            self.saida("📝 Você: ", end="", flush=True)
+        origem, texto = self.entrada.obter(timeout)
+        if origem == 'voz':
+            if prompt:
+                self.saida()
+            self.saida(f"📝 Você disse: {texto}")
+        elif origem is None and prompt:
+            self.saida()
+        # Sem lower(): o roteador ignora maiúsculas nas palavras fixas e os argumentos
+        # 'bruto' (caminhos de arquivo) chegam como foram digitados
+        return origem, texto
 
     # ---------- MEMÓRIA ----------
+    MEMORIA_PICKLE_ANTIGA = 'memoria_vis.pkl'
+
+    @staticmethod
+    def _memoria_vazia():
+        return {
+            'interacoes': 0,
+            'ultima_interacao': None,
+            'preferencias': {},
+            'conversas': deque(maxlen=50)
+        }
+
+    def _estado_persistente(self):
+        return {
+            'memoria': self.memoria,
+            'personalidade': self.personalidade,
+            'humor_history': self.humor_history,
+            'perfil_atual': self.perfil_atual
+        }
+
+    def registrar_interacao(self, pergunta, resposta):
+        agora = datetime.datetime.now()
+        self.memoria['interacoes'] += 1
+        self.memoria['ultima_interacao'] = agora
+        self.memoria['conversas'].append({
+            'data': agora,
+            'perfil': self.perfil_atual,
+            'usuario': pergunta,
+            'resposta': resposta
+        })
+        self.conversas.registrar(agora, self.perfil_atual, pergunta, resposta, self.sessao_conversas)
+
     def salvar_memoria(self):
-        with open('memoria_vis.pkl', 'wb') as f:
-            pickle.dump({
-                'memoria': self.memoria,
-                'personalidade': self.personalidade,
-                'humor_history': list(self.humor_history),
-                'perfil_atual': self.perfil_atual
-            }, f)
-        print("💾 Memória salva!")
+        """Grava no diário só o que mudou desde a última gravação"""
+        try:
+            self.diario.registrar(self._estado_persistente())
+            self.saida("💾 Memória salva!")
+        except (OSError, RuntimeError) as e:
+            self.saida(f"⚠️ Não consegui salvar a memória: {e}")
 
     def carregar_memoria(self):
+        dados = None
+        try:
+            dados = self.diario.carregar()
+        except OSError as e:
+            self.saida(f"⚠️ Não consegui ler o diário de memória: {e}")
+        if dados is None and os.path.exists(self.MEMORIA_PICKLE_ANTIGA):
+            dados = self._migrar_pickle()
+
+        memoria = self._memoria_vazia()
+        if dados:
+            self.personalidade.update(dados.get('personalidade', {}))
+            self.humor_history = deque(dados.get('humor_history', [50]), maxlen=20)
+            # Carrega o último perfil usado, se existir
+            if dados.get('perfil_atual') in self.perfis:
+                self.perfil_atual = dados['perfil_atual']
+            memoria.update(dados.get('memoria', {}))
+            memoria['conversas'] = deque(memoria['conversas'], maxlen=50)
+        return memoria
+
+    def _migrar_pickle(self):
+        """Converte a memória do formato antigo (pickle inteiro) para o diário"""
         try:
-            with open('memoria_vis.pkl', 'rb') as f:
+            with open(self.MEMORIA_PICKLE_ANTIGA, 'rb') as f:
                 dados = pickle.load(f)
-                self.personalidade.update(dados.get('personalidade', {}))
-                self.humor_history = deque(dados.get('humor_history', [50]), maxlen=20)
-                # Carrega o último perfil usado, se existir
-                if 'perfil_atual' in dados and dados['perfil_atual'] in self.perfis:
-                    self.perfil_atual = dados['perfil_atual']
-                return dados.get('memoria', {})
-        except:
-            return {
-                'interacoes': 0,
-                'ultima_interacao': None,
-                'preferencias': {},
-                'conversas': deque(maxlen=50)
-            }
+        except Exception as e:
+            self.saida(f"⚠️ Memória antiga ilegível ({e}); começando do zero.")
+            return None
+        self.diario.checkpoint(dados)
+        os.replace(self.MEMORIA_PICKLE_ANTIGA, self.MEMORIA_PICKLE_ANTIGA + '.migrado')
+        self.saida("💾 Memória antiga migrada para o diário.")
+        return dados
 
     def mostrar_ajuda(self):
-        ajuda = f"""
-🔧 COMANDOS DO BENCH-VIS (perfil atual: {self.perfil_atual}):
+        ajuda = self.AJUDA.format(perfil_atual=self.perfil_atual, perfis=', '.join(self.perfis.keys()))
+        self.saida(ajuda)
+        self.falar("Comandos disponíveis no terminal.")
 
-👤 PERFIS:
-  • "mudar perfil [nome]" - troca de perfil
-  • "perfis" - lista todos os perfis
-  Perfis disponíveis: {', '.join(self.perfis.keys())}
+    def _agendar_manutencao(self, estado_local=True):
+        """estado_local=False no servidor: lá cada sessão tem o seu estado e não há diário"""
+        if estado_local:
+            # Sem esperar a saída: uma queda perde no máximo os últimos 30 s
+            self.agendador.agendar('autosave', self._autosave, intervalo=30, jitter=0.1, exclusiva=True)
+            self.agendador.agendar('decaimento', self._decair_personalidade, intervalo=300, jitter=0.1,
+                                   exclusiva=True)
+        self.agendador.agendar('cache', lambda: self.cache_respostas.despejar().result(timeout=60),
+                               intervalo=1800, jitter=0.2, so_ocioso=True)
+        self.agendador.agendar('banco', lambda: self.db.manutencao().result(timeout=300),
+                               intervalo=6 * 3600, atraso=600, jitter=0.2, so_ocioso=True)
+        self.agendador.iniciar()
 
-📁 PROJETOS:
-  • "projeto novo NOME" - criar projeto
-  • "listar projetos" - lista todos
-  • "deletar projeto ID" - remove projeto (com confirmação)
-  • "componentes do projeto ID" - lista componentes do projeto
+    def _autosave(self):
+        try:
+            self.diario.registrar(self._estado_persistente())
+        except OSError as e:
+            self.saida(f"⚠️ Falha no autosave da memória: {e}")
 
-💻 CÓDIGO:
-  • "gerar codigo [descrição]" - gera código (Arduino, Python...)
+    def _decair_personalidade(self):
+        self.personalidade['energia'] = max(0, self.personalidade['energia'] - 5)
+        self.personalidade['humor'] = max(0, self.personalidade['humor'] - 1)
 
-🎭 ENTRETENIMENTO:
-  • "fato" ou "curiosidade" - conta algo interessante
-  • "conselho" - dá um conselho
-  • "piada" - conta uma piada
+    def executar(self):
+        self.apresentar()
+        self.saida("\n🔧 Assistente multiperfil pronto! Use 'ajuda' para comandos.\n")
 
-🤖 IA:
-  • "toggle ia" - liga/desliga o modo inteligente
-  • Com IA ligada, pode conversar sobre qualquer assunto
+        self.ativo = True
+        self._agendar_manutencao()
 
-🎤 MODOS:
-  • "modo texto", "modo voz", "modo hibrido"
-  • "sair" - encerra
+        while self.ativo:
+            origem, comando = self.ler_comando()
+            if origem == EntradaMultiplexada.FIM:
+                if self._voz_disponivel():
+                    continue  # sem teclado, segue só por voz
+                comando = "sair"
+            elif origem == 'voz' and self.modo_entrada == "texto":
+                continue  # falado antes de trocar para o modo texto
+            if comando:
+                self.processar_comando(comando)
 
-💡 DICA: A personalidade muda com o tempo e com o perfil!
-        """
-        print(ajuda)
-        self.falar("Comandos disponíveis no terminal.")
+        self.entrada.fechar()
+        self.agendador.parar()
+        self.saida("\n👋 Até mais!")
+
+
+AssistenteMultiperfil.roteador = RoteadorComandos.da_classe(AssistenteMultiperfil)
 
-    def executar(self):
-        print("\n🔧 Assistente multiperfil pronto! Use 'ajuda' para comandos.\n")
 
-        def decaimento():
-            while self.ativo:
-                time.sleep(300)  # 5 minutos
-                self.personalidade['energia'] = max(0, self.personalidade['energia'] - 5)
-                self.personalidade['humor'] = max(0, self.personalidade['humor'] - 1)
+# ---------- SERVIDOR MULTISSESSÃO ----------
+class SessaoRemota(AssistenteMultiperfil):
+    """Uma conversa atendida pelo servidor: perfil, personalidade, contexto e memória
+    próprios; banco, LLM, caches, agendador e fila de imagens são os do assistente base.
 
+    As mensagens do usuário chegam por entregar(); a saída vai para a função saida.
+    Só há modo texto e o diário de memória do terminal não é tocado.
+    """
+
+    COMPARTILHADOS = ('nome', 'apelido', 'audio', 'perfis', 'caminho_db', 'orcamento_contexto', 'db',
+                      'cache_respostas', 'codigos', 'conversas', 'medidor', 'agendador',
+                      'cache_audio', 'voz', 'reprodutor', 'pipeline_fala', 'llm',
+                      'prefetch', 'imagens')
+
+    def __init__(self, base, saida, perfil=None, espera_resposta=10, ao_consumir=None):
+        for nome in self.COMPARTILHADOS:
+            setattr(self, nome, getattr(base, nome))
+        # O arquivo de conversas é o do banco comum, mas cada sessão só lê as suas
+        self.sessao_conversas = os.urandom(8).hex()
+        self.saida = saida
+        self.modo_entrada = "texto"
+        self.espera_resposta = espera_resposta  # prazo das confirmações, em segundos
+        self.ao_consumir = ao_consumir  # chamado a cada mensagem retirada da fila
+        self.fila_entrada = queue.Queue()
+        self.memoria = self._memoria_vazia()
         self.ativo = True
-        threading.Thread(target=decaimento, daemon=True).start()
+        self._iniciar_estado(perfil if perfil in self.perfis else base.perfil_atual)
 
-        while self.ativo:
-            comando = None
-            if self.modo_entrada == "voz":
-                comando = self.ouvir_voz()
-            elif self.modo_entrada == "texto":
-                comando = self.ler_texto()
-            else:  # hibrido
-                comando = self.ouvir_voz()
-                if comando is None:
-                    comando = self.ler_texto()
+    def entregar(self, texto):
+        self.fila_entrada.put(texto)
 
-            if comando:
-                self.processar_comando(comando)
+    def ler_comando(self, timeout=None):
+        try:
+            texto = self.fila_entrada.get(block=timeout != 0, timeout=timeout)
+        except queue.Empty:
+            return None, None
+        if self.ao_consumir:
+            self.ao_consumir()
+        if texto is None:
+            return EntradaMultiplexada.FIM, None
+        return 'texto', texto
 
-            time.sleep(0.1)
+    def aguardar_resposta_sim_nao(self, timeout=None):
+        return super().aguardar_resposta_sim_nao(self.espera_resposta if timeout is None else timeout)
 
-        print("\n👋 Até mais!")
+    def proximo_turno(self):
+        """Atende a próxima mensagem da fila, se ainda houver (uma confirmação pode tê-la
+        consumido); retorna se atendeu"""
+        origem, texto = self.ler_comando(timeout=0)
+        if origem == 'texto' and texto.strip():
+            self.processar_comando(texto)
+            return True
+        return False
 
+    def _cmd_sair(self):
+        self.falar(random.choice(self.DESPEDIDAS))
+        self.ativo = False
 
-if __name__ == "__main__":
-    print("🚀 Inicializando BENCH-VIS Multiperfil...")
-    # Teste rápido da API
+    def _cmd_modo(self, novo_modo):
+        self.falar("Nas sessões remotas só há o modo texto.")
+
+    def salvar_memoria(self):
+        pass  # a memória da sessão vive só enquanto ela durar
+
+
+def quadro_ws(dados, opcode=0x1, mascarar=False):
+    """Monta um quadro WebSocket (RFC 6455) com FIN; clientes mandam mascarado"""
+    if isinstance(dados, str):
+        dados = dados.encode('utf-8')
+    n = len(dados)
+    bit_mascara = 0x80 if mascarar else 0
+    if n < 126:
+        cabecalho = struct.pack('!BB', 0x80 | opcode, bit_mascara | n)
+    elif n < 1 << 16:
+        cabecalho = struct.pack('!BBH', 0x80 | opcode, bit_mascara | 126, n)
+    else:
+        cabecalho = struct.pack('!BBQ', 0x80 | opcode, bit_mascara | 127, n)
+    if not mascarar:
+        return cabecalho + dados
+    mascara = os.urandom(4)
+    return cabecalho + mascara + _aplicar_mascara(dados, mascara)
+
+
+def _aplicar_mascara(dados, mascara):
+    chave = int.from_bytes((mascara * (len(dados) // 4 + 1))[:len(dados)], 'big')
+    return (int.from_bytes(dados, 'big') ^ chave).to_bytes(len(dados), 'big')
+
+
+async def ler_quadro_ws(reader, limite=1 << 20):
+    """(opcode, dados) da próxima mensagem, juntando fragmentos; None se a conexão caiu"""
+    opcode_mensagem, partes = None, []
+    while True:
+        try:
+            b1, b2 = await reader.readexactly(2)
+            n = b2 & 0x7f
+            if n == 126:
+                n = struct.unpack('!H', await reader.readexactly(2))[0]
+            elif n == 127:
+                n = struct.unpack('!Q', await reader.readexactly(8))[0]
+            if n > limite:
+                raise ValueError(f"quadro de {n} bytes passa do limite")
+            mascara = await reader.readexactly(4) if b2 & 0x80 else None
+            dados = await reader.readexactly(n)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        if mascara:
+            dados = _aplicar_mascara(dados, mascara)
+        opcode = b1 & 0x0f
+        if opcode >= 0x8:  # controle (close, ping, pong): nunca fragmentado
+            return opcode, dados
+        if opcode:
+            opcode_mensagem = opcode
+        partes.append(dados)
+        if sum(map(len, partes)) > limite:
+            raise ValueError("mensagem passa do limite")
+        if b1 & 0x80:
+            return opcode_mensagem, b"".join(partes)
+
+
+class _Conexao:
+    """Uma sessão do servidor e a sua fila de saída com crédito limitado: se o cliente
+    não lê, a thread que atende a sessão para de produzir (e só ela)"""
+
+    def __init__(self, servidor, max_pendentes, max_saida):
+        self.id = servidor._novo_id()
+        self.loop = servidor._loop
+        self.saidas = asyncio.Queue()
+        self.coletadas = None  # lista, nas chamadas HTTP sem WebSocket
+        self.espaco = asyncio.Semaphore(max_pendentes)  # mensagens aceitas e ainda não atendidas
+        self.chegadas = asyncio.Semaphore(0)
+        self.max_saida = max_saida
+        self._credito = threading.Semaphore(max_saida)
+        self.fechada = False
+        self.ultimo_uso = time.monotonic()
+        self.turnos = 0
+        self.saidas_enviadas = 0
+        self.lock = asyncio.Lock()
+        self.assistente = SessaoRemota(servidor.base, self.saida, ao_consumir=self._consumiu)
+
+    def _consumiu(self):
+        with contextlib.suppress(RuntimeError):  # laço já encerrado
+            self.loop.call_soon_threadsafe(self.espaco.release)
+
+    def saida(self, *partes, sep=' ', end='\n', flush=False):
+        self.enviar({'tipo': 'saida', 'texto': sep.join(str(p) for p in partes) + end})
+
+    def enviar(self, mensagem):
+        """Chamado da thread do atendimento; bloqueia enquanto o cliente estiver atrasado"""
+        if self.coletadas is not None:
+            self.coletadas.append(mensagem)
+            return
+        if self.fechada:
+            return
+        if not self._credito.acquire(timeout=60):
+            self.fechada = True  # cliente parado há um minuto: desiste da sessão
+            return
+        self.saidas_enviadas += 1
+        self.loop.call_soon_threadsafe(self.saidas.put_nowait, mensagem)
+
+    def devolver_credito(self):
+        self._credito.release()
+
+    def fechar(self):
+        self.fechada = True
+        self.assistente.entregar(None)
+        self.saidas.put_nowait(None)
+        for _ in range(self.max_saida):  # solta quem estiver esperando crédito
+            self._credito.release()
+
+
+class ServidorSessoes:
+    """Expõe o assistente numa API local para vários usuários ao mesmo tempo.
+
+    - GET /ws: WebSocket, uma sessão por conexão; mensagens de texto (ou JSON com
+      "texto") entram, e saem JSON {"tipo": "saida"|"fim", ...} com a resposta em streaming
+    - POST /comando: JSON {"texto", "sessao"?, "respostas"?} -> saída completa do turno
+    - GET /saude: sessões, turnos e filas
+
+    Os turnos rodam num pool limitado de threads; cada sessão aceita no máximo
+    max_pendentes mensagens à frente (depois disso o servidor para de ler o socket)
+    e max_saida mensagens sem o cliente ler. O buffer de envio do kernel também é
+    limitado (buffer_envio), senão um cliente parado segura megabytes por conexão.
+    """
+
+    def __init__(self, base, host='127.0.0.1', porta=8765, trabalhadores=32, max_sessoes=1000,
+                 max_pendentes=4, max_saida=256, buffer_envio=256 * 1024, expirar_apos=1800):
+        self.base = base
+        self.host = host
+        self.porta = porta
+        self.max_sessoes = max_sessoes
+        self.max_pendentes = max_pendentes
+        self.max_saida = max_saida
+        self.buffer_envio = buffer_envio
+        self.expirar_apos = expirar_apos
+        self.trabalhadores = trabalhadores
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=trabalhadores, thread_name_prefix='sessao')
+        self._sessoes = {}  # id -> _Conexao
+        self._proximo_id = 1
+        self.turnos = 0
+        self.em_andamento = 0
+        self.pronto = threading.Event()
+        self._loop = None
+        self._servidor = None
+
+    def _novo_id(self):
+        sid = self._proximo_id
+        self._proximo_id += 1
+        return sid
+
+    def rodar(self):
+        """Bloqueia servindo até parar() (ou Ctrl+C)"""
+        try:
+            asyncio.run(self._principal())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def parar(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._servidor.close)
+
+    async def _principal(self):
+        self._loop = asyncio.get_running_loop()
+        self._servidor = await asyncio.start_server(self._atender_conexao, self.host, self.porta,
+                                                    limit=1 << 16, backlog=1024)
+        self.porta = self._servidor.sockets[0].getsockname()[1]
+        expirar = asyncio.create_task(self._expirar_sessoes())
+        print(f"🌐 Servidor em http://{self.host}:{self.porta} (WebSocket em /ws, "
+              f"{self.trabalhadores} turnos simultâneos)")
+        self.pronto.set()
+        try:
+            await self._servidor.serve_forever()
+        finally:
+            expirar.cancel()
+            for conexao in list(self._sessoes.values()):
+                conexao.fechar()
+
+    async def _expirar_sessoes(self):
+        while True:
+            await asyncio.sleep(60)
+            limite = time.monotonic() - self.expirar_apos
+            for sid, conexao in list(self._sessoes.items()):
+                if conexao.coletadas is not None and conexao.ultimo_uso < limite and not conexao.lock.locked():
+                    del self._sessoes[sid]
+                    conexao.fechar()
+
+    async def _turno(self, conexao, funcao):
+        self.em_andamento += 1
+        try:
+            return await self._loop.run_in_executor(self._executor, funcao)
+        finally:
+            self.em_andamento -= 1
+            conexao.ultimo_uso = time.monotonic()
+
+    def _nova_sessao(self):
+        if len(self._sessoes) >= self.max_sessoes:
+            return None
+        conexao = _Conexao(self, self.max_pendentes, self.max_saida)
+        self._sessoes[conexao.id] = conexao
+        return conexao
+
+    # ----- HTTP -----
+    async def _atender_conexao(self, reader, writer):
+        try:
+            metodo, caminho, cabecalhos = await asyncio.wait_for(self._ler_pedido(reader), 10)
+            if caminho == '/ws' and cabecalhos.get('upgrade', '').lower() == 'websocket':
+                await self._websocket(reader, writer, cabecalhos)
+            elif caminho == '/comando' and metodo == 'POST':
+                tamanho = int(cabecalhos.get('content-length', 0))
+                if tamanho > 1 << 16:
+                    self._responder(writer, 413, {'erro': 'corpo grande demais'})
+                else:
+                    await self._comando_http(writer, await reader.readexactly(tamanho))
+            elif caminho == '/saude' and metodo == 'GET':
+                self._responder(writer, 200, self.saude())
+            else:
+                self._responder(writer, 404, {'erro': 'caminho desconhecido'})
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # servidor encerrando com a conexão aberta
+        finally:
+            writer.close()
+
+    async def _ler_pedido(self, reader):
+        linha = (await reader.readline()).decode('latin-1').split()
+        if len(linha) < 2:
+            raise ValueError("pedido HTTP inválido")
+        cabecalhos = {}
+        while True:
+            bruto = (await reader.readline()).decode('latin-1')
+            if bruto in ('\r\n', '\n', ''):
+                break
+            nome, _, valor = bruto.partition(':')
+            cabecalhos[nome.strip().lower()] = valor.strip()
+        return linha[0].upper(), urllib.parse.urlsplit(linha[1]).path, cabecalhos
+
+    def _responder(self, writer, status, corpo):
+        dados = json.dumps(corpo, ensure_ascii=False).encode('utf-8')
+        motivo = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                  503: 'Service Unavailable'}[status]
+        writer.write(f"HTTP/1.1 {status} {motivo}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(dados)}\r\nConnection: close\r\n\r\n".encode('latin-1') + dados)
+
+    def saude(self):
+        return {'sessoes': len(self._sessoes), 'turnos': self.turnos, 'em_andamento': self.em_andamento,
+                'na_fila': sum(c.assistente.fila_entrada.qsize() for c in self._sessoes.values())}
+
+    async def _comando_http(self, writer, corpo):
+        try:
+            pedido = json.loads(corpo)
+            texto = str(pedido['texto'])
+        except (ValueError, KeyError, TypeError):
+            self._responder(writer, 400, {'erro': 'esperado JSON com "texto"'})
+            return
+        conexao = self._sessoes.get(pedido.get('sessao'))
+        if conexao is None or conexao.coletadas is None:  # desconhecida ou de um WebSocket
+            conexao = self._nova_sessao()
+            if conexao is None:
+                self._responder(writer, 503, {'erro': 'sessões demais'})
+                return
+            conexao.coletadas = []
+            # Sem ida e volta: confirmações só valem se vieram em "respostas" no pedido
+            conexao.assistente.espera_resposta = 0.05
+        async with conexao.lock:
+            conexao.assistente.entregar(texto)
+            for resposta in pedido.get('respostas', []):
+                conexao.assistente.entregar(str(resposta))
+            inicio = time.perf_counter()
+            await self._turno(conexao, conexao.assistente.proximo_turno)
+            while not conexao.assistente.fila_entrada.empty():  # respostas que sobraram
+                conexao.assistente.fila_entrada.get_nowait()
+            saida, conexao.coletadas = conexao.coletadas, []
+            self.turnos += 1
+        if not conexao.assistente.ativo:
+            self._sessoes.pop(conexao.id, None)
+        self._responder(writer, 200, {'sessao': conexao.id, 'ativa': conexao.assistente.ativo,
+                                      'saida': "".join(m['texto'] for m in saida),
+                                      'ms': round((time.perf_counter() - inicio) * 1000, 1)})
+
+    # ----- WebSocket -----
+    async def _websocket(self, reader, writer, cabecalhos):
+        conexao = self._nova_sessao()
+        if conexao is None:
+            self._responder(writer, 503, {'erro': 'sessões demais'})
+            return
+        aceite = base64.b64encode(hashlib.sha1(
+            (cabecalhos.get('sec-websocket-key', '') + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest())
+        sock = writer.get_extra_info('socket')
+        if sock is not None and self.buffer_envio:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.buffer_envio)
+        # drain() só retorna com o buffer do asyncio vazio: o que não foi lido fica contado
+        # no crédito (max_saida), não escondido nos 64 KB padrão do transporte
+        writer.transport.set_write_buffer_limits(high=0)
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + aceite + b"\r\n\r\n")
+        envio = asyncio.create_task(self._enviar_ws(conexao, writer))
+        atendimento = asyncio.create_task(self._atender_ws(conexao, writer))
+        try:
+            while conexao.assistente.ativo and not conexao.fechada:
+                # Backpressure: com max_pendentes mensagens na fila, para de ler o socket
+                await conexao.espaco.acquire()
+                quadro = await ler_quadro_ws(reader)
+                if quadro is None or quadro[0] == 0x8:
+                    break
+                opcode, dados = quadro
+                if opcode != 0x1:
+                    conexao.espaco.release()
+                    if opcode == 0x9:
+                        conexao.saidas.put_nowait(('pong', dados))
+                    continue
+                texto = dados.decode('utf-8', 'replace')
+                if texto.startswith('{'):
+                    try:
+                        texto = str(json.loads(texto).get('texto', ''))
+                    except (ValueError, AttributeError):
+                        pass
+                # O espaço volta quando o atendimento tirar a mensagem da fila
+                conexao.assistente.entregar(texto)
+                conexao.chegadas.release()
+        except ValueError:
+            pass  # quadro grande demais: encerra a sessão
+        finally:
+            self._sessoes.pop(conexao.id, None)
+            atendimento.cancel()
+            conexao.fechar()
+            await envio
+
+    async def _atender_ws(self, conexao, writer):
+        await self._turno(conexao, conexao.assistente.saudacao_inicial)
+        conexao.saidas.put_nowait({'tipo': 'fim', 'sessao': conexao.id})
+        while conexao.assistente.ativo:
+            await conexao.chegadas.acquire()
+            inicio = time.perf_counter()
+            if await self._turno(conexao, conexao.assistente.proximo_turno):
+                self.turnos += 1
+                conexao.turnos += 1
+                conexao.saidas.put_nowait({'tipo': 'fim', 'ms': round((time.perf_counter() - inicio) * 1000, 1)})
+        conexao.saidas.put_nowait(('close', struct.pack('!H', 1000)))
+
+    async def _enviar_ws(self, conexao, writer):
+        while True:
+            mensagem = await conexao.saidas.get()
+            if mensagem is None:
+                return
+            try:
+                if isinstance(mensagem, tuple):  # controle: ('pong'|'close', dados)
+                    writer.write(quadro_ws(mensagem[1], 0xA if mensagem[0] == 'pong' else 0x8))
+                    if mensagem[0] == 'close':
+                        await writer.drain()
+                        writer.close()
+                        return
+                else:
+                    writer.write(quadro_ws(json.dumps(mensagem, ensure_ascii=False)))
+                await writer.drain()
+                # O crédito só volta quando o quadro saiu do buffer do asyncio
+                if isinstance(mensagem, dict) and mensagem['tipo'] == 'saida':
+                    conexao.devolver_credito()
+            except ConnectionError:
+                conexao.fechada = True
+                return
+
+
+# ---------- MODO LOTE ----------
+# Linhas do roteiro que são a resposta da confirmação do comando anterior
+RESPOSTAS_LOTE = {'sim', 's', 'yes', 'y', 'pode', 'não', 'nao', 'n', 'no'}
+
+
+def ler_roteiro(linhas):
+    """[(número da linha, comando, respostas)]; ignora linhas vazias e comentários (#).
+    Um 'sim'/'não' sozinho na linha responde à confirmação do comando de cima."""
+    roteiro = []
+    for numero, linha in enumerate(linhas, 1):
+        linha = linha.strip()
+        if not linha or linha.startswith('#'):
+            continue
+        if roteiro and linha.lower() in RESPOSTAS_LOTE:
+            roteiro[-1][2].append(linha)
+        else:
+            roteiro.append((numero, linha, []))
+    return roteiro
+
+
+class ExecutorLote:
+    """Roda um roteiro de comandos sem terminal, microfone nem voz e grava um resultado
+    JSONL por comando, na ordem do roteiro.
+
+    Comandos que só dependem do LLM (perguntas livres, 'gerar codigo', 'fato',
+    'conselho') rodam em paralelo até o limite de trabalhadores, cada um numa sessão
+    própria com o perfil da principal. Os demais são barreiras: esperam tudo o que veio
+    antes e rodam um por vez na sessão principal, então as mutações do banco seguem a
+    ordem do roteiro e enxergam o que veio antes (ex.: 'salvar codigo' depois de
+    'gerar codigo').
+    """
+
+    PARALELOS = ('_cmd_gerar_codigo', '_cmd_fato', '_cmd_conselho')
+
+    def __init__(self, base, trabalhadores=4):
+        self.base = base
+        self.trabalhadores = trabalhadores
+        self.principal = SessaoRemota(base, print, espera_resposta=0.05)
+        self.principal.streaming = False
+        self.t0 = time.perf_counter()
+
+    def paralelo(self, comando):
+        """True se o comando só depende do LLM e pode rodar junto com os vizinhos"""
+        rota, args = self.base.roteador.resolver(comando)
+        if rota is None:
+            return self.principal.usar_ia
+        return args is not None and rota.handler in self.PARALELOS
+
+    def _sessao_paralela(self):
+        sessao = SessaoRemota(self.base, print, perfil=self.principal.perfil_atual, espera_resposta=0.05)
+        sessao.personalidade = dict(self.principal.personalidade)
+        sessao.usar_ia = self.principal.usar_ia
+        sessao.streaming = False
+        sessao.linguagem_padrao = self.principal.linguagem_padrao
+        return sessao
+
+    def _rodar(self, sessao, numero, comando, respostas, modo, enfileirado):
+        """Atende um comando na sessão e devolve o registro do resultado"""
+        saida = []
+
+        def capturar(*partes, sep=' ', end='\n', flush=False):
+            saida.append(sep.join(str(p) for p in partes) + end)
+
+        sessao.saida = capturar
+        inicio = time.perf_counter()
+        resultado = {'linha': numero, 'comando': comando, 'modo': modo}
+        if respostas:
+            resultado['respostas'] = respostas
+        sessao.entregar(comando)
+        for resposta in respostas:
+            sessao.entregar(resposta)
+        sessao.falha_llm = None
+        try:
+            sessao.proximo_turno()
+            # A resposta de contingência não é sucesso: o LLM falhou por baixo dela
+            resultado['ok'] = sessao.falha_llm is None
+            if sessao.falha_llm:
+                resultado['erro'] = sessao.falha_llm
+        except Exception as e:
+            resultado['ok'] = False
+            resultado['erro'] = f"{type(e).__name__}: {e}"
+        while not sessao.fila_entrada.empty():  # respostas que sobraram
+            sessao.fila_entrada.get_nowait()
+        fim = time.perf_counter()
+        resultado.update({'saida': "".join(saida).strip(),
+                          'inicio_ms': round((inicio - self.t0) * 1000, 1),
+                          'espera_ms': round((inicio - enfileirado) * 1000, 1),
+                          'ms': round((fim - inicio) * 1000, 1)})
+        return resultado, sessao
+
+    def executar(self, roteiro, escrever):
+        """Roda o roteiro chamando escrever(resultado) na ordem das linhas; retorna os resultados"""
+        resultados, pendentes = [], []
+
+        def descarregar():
+            # Os paralelos terminam em qualquer ordem, mas saem na ordem do roteiro
+            for futuro in pendentes:
+                resultado, sessao = futuro.result()
+                if sessao.ultimo_codigo_gerado:
+                    self.principal.ultimo_codigo_gerado = sessao.ultimo_codigo_gerado
+                resultados.append(resultado)
+                escrever(resultado)
+            pendentes.clear()
+
+        with concurrent.futures.ThreadPoolExecutor(self.trabalhadores, thread_name_prefix='lote') as executor:
+            for numero, comando, respostas in roteiro:
+                if not self.principal.ativo:
+                    break
+                enfileirado = time.perf_counter()
+                if self.paralelo(comando):
+                    pendentes.append(executor.submit(self._rodar, self._sessao_paralela(), numero, comando,
+                                                     respostas, 'paralelo', enfileirado))
+                    continue
+                descarregar()
+                resultado, _ = self._rodar(self.principal, numero, comando, respostas, 'em ordem', enfileirado)
+                resultados.append(resultado)
+                escrever(resultado)
+            descarregar()
+        return resultados
+
+
+def testar_api(llm):
+    """Teste rápido da API, rodado em segundo plano durante a inicialização"""
     try:
-        test = Pollinations()
-        test.chat.completions.create(messages=[{"role":"user","content":"teste"}], model="openai", max_tokens=5)
-        print("✅ API Pollinations conectada!")
+        llm.completar([{"role": "user", "content": "teste"}], max_tokens=5, prazo=10)
+        print(f"✅ API de IA conectada! ({llm.url})")
     except Exception as e:
-        print(f"⚠️ API Pollinations indisponível: {e}")
+        print(f"⚠️ API de IA indisponível: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BENCH-VIS - assistente de bancada multiperfil")
+    parser.add_argument("--modo", choices=["texto", "voz", "hibrido"], default="hibrido")
+    parser.add_argument("--perfil", default="bancada", help="perfil inicial")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="mostra o tempo de cada fase da inicialização")
+    parser.add_argument("--servidor", metavar="[HOST:]PORTA",
+                        help="atende várias sessões por HTTP/WebSocket em vez do terminal")
+    parser.add_argument("--lote", "--batch", metavar="ARQUIVO|-",
+                        help="roda os comandos do arquivo (ou da entrada padrão) e grava resultados JSONL")
+    parser.add_argument("--resultado", metavar="ARQUIVO",
+                        help="JSONL do modo lote (padrão: saída padrão; as mensagens vão para stderr)")
+    parser.add_argument("--trabalhadores", type=int,
+                        help="turnos atendidos ao mesmo tempo (servidor: 32, lote: 4)")
+    args = parser.parse_args()
+    trabalhadores = args.trabalhadores or (4 if args.lote else 32)
 
-    # Pode escolher o perfil inicial aqui
-    assistente = AssistenteMultiperfil(modo_entrada="hibrido", perfil_inicial="bancada")
+    saida_resultados = sys.stdout
+    if args.lote:
+        sys.stdout = sys.stderr  # a saída padrão fica só com o JSONL
+
+    perfil_inicio = PerfilInicializacao()
+    print("🚀 Inicializando BENCH-VIS Multiperfil...")
+    # O mesmo backend é testado em segundo plano e reaproveitado pelo assistente
+    llm = BackendHTTP(tamanho_pool=trabalhadores if args.servidor or args.lote else 8)
+    perfil_inicio.em_paralelo('teste da API', testar_api, llm)
+
+    if args.lote:
+        # Sem microfone, voz nem pré-geração: só o que o roteiro pedir
+        assistente = AssistenteMultiperfil(modo_entrada="texto", perfil_inicial=args.perfil, llm=llm,
+                                           perfil_inicio=perfil_inicio, prefetch=False, audio=False)
+    else:
+        assistente = AssistenteMultiperfil(modo_entrada="texto" if args.servidor else args.modo,
+                                           perfil_inicial=args.perfil, llm=llm, perfil_inicio=perfil_inicio)
+    perfil_inicio.marcar('prompt pronto')
+    if args.startup_profile:
+        print(perfil_inicio.relatorio())
+    if args.lote:
+        if args.lote == '-':
+            roteiro = ler_roteiro(sys.stdin.readlines())
+        else:
+            with open(args.lote, encoding='utf-8') as f:
+                roteiro = ler_roteiro(f)
+        destino = open(args.resultado, 'w', encoding='utf-8') if args.resultado else saida_resultados
+
+        def escrever(resultado):
+            destino.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+            destino.flush()
+
+        inicio = time.perf_counter()
+        resultados = ExecutorLote(assistente, trabalhadores).executar(roteiro, escrever)
+        falhas = sum(not r['ok'] for r in resultados)
+        paralelos = sum(r['modo'] == 'paralelo' for r in resultados)
+        print(f"📦 {len(resultados)} comandos em {time.perf_counter() - inicio:.1f} s "
+              f"({paralelos} em paralelo, {trabalhadores} trabalhadores), {falhas} falhas")
+        if assistente.imagens.pendentes():
+            print(f"🖼️ Esperando {assistente.imagens.pendentes()} imagens...")
+            while assistente.imagens.pendentes():
+                time.sleep(0.2)
+        assistente.imagens.fechar()
+        assistente.db.fechar()
+        if destino is not saida_resultados:
+            destino.close()
+        sys.exit(1 if falhas else 0)
+    if args.servidor:
+        host, _, porta = args.servidor.rpartition(':')
+        servidor = ServidorSessoes(assistente, host or '127.0.0.1', int(porta),
+                                   trabalhadores=trabalhadores)
+        assistente._agendar_manutencao(estado_local=False)
+        try:
+            servidor.rodar()
+        except KeyboardInterrupt:
+            print("\n\nEncerrando...")
+        assistente.agendador.parar()
+        assistente.imagens.fechar()
+        assistente.db.fechar()
+        sys.exit(0)
     try:
         assistente.executar()
     except KeyboardInterrupt:
         print("\n\nEncerrando...")
+        assistente.agendador.parar()
+        assistente.interromper_fala()
         assistente.falar("Até mais!")
+        assistente.pipeline_fala.esperar(timeout=5)
         assistente.salvar_memoria()
-        assistente.conn.close()
\ No newline at end of file
+        assistente.db.fechar()
\ No newline at end of file
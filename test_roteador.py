@@ -0,0 +1,81 @@
+# test_roteador.py - Todo comando listado em mostrar_ajuda deve chegar ao handler certo
+# Uso: python -m pytest test_roteador.py
+import queue
+
+from bench_roteador import comandos_da_ajuda, EXEMPLOS, preencher, TEXTO_LIVRE
+from benchvis import AssistenteMultiperfil, SessaoRemota
+
+# Handler esperado para cada comando listado em mostrar_ajuda
+ESPERADO = {
+    'mudar perfil [nome]': '_cmd_mudar_perfil',
+    'perfis': '_cmd_perfis',
+    'projeto novo NOME': '_cmd_projeto_novo',
+    'listar projetos': '_cmd_listar_projetos',
+    'buscar TERMO': '_cmd_buscar',
+    'mais': '_cmd_mais',
+    'deletar projeto ID': '_cmd_deletar_projeto',
+    'componentes do projeto ID': '_cmd_componentes',
+    'importar bom ID arquivo.csv': '_cmd_importar_bom',
+    'exportar bom ID [arquivo.csv]': '_cmd_exportar_bom',
+    'gerar codigo [descrição]': '_cmd_gerar_codigo',
+    'salvar codigo ID': '_cmd_salvar_codigo',
+    'historico codigo ID': '_cmd_historico_codigo',
+    'ver codigo ID [versão]': '_cmd_ver_codigo',
+    'diff codigo ID [de] [para]': '_cmd_diff_codigo',
+    'gerar imagem [descrição]': '_cmd_gerar_imagem',
+    'status imagem [número]': '_cmd_status_imagem',
+    'fato': '_cmd_fato',
+    'curiosidade': '_cmd_fato',
+    'conselho': '_cmd_conselho',
+    'piada': '_cmd_piada',
+    'toggle ia': '_cmd_toggle_ia',
+    'cache stats': '_cmd_cache_stats',
+    'latencia': '_cmd_latencia',
+    'tarefas': '_cmd_tarefas',
+    'modo texto': '_cmd_modo',
+    'modo voz': '_cmd_modo',
+    'modo hibrido': '_cmd_modo',
+    'sair': '_cmd_sair',
+}
+
+def test_ajuda_lista_comandos():
+    assert comandos_da_ajuda()
+
+
+def test_todo_comando_da_ajuda_tem_handler_esperado():
+    for comando in comandos_da_ajuda():
+        assert comando in ESPERADO, f"'{comando}' está na ajuda mas não tem handler esperado neste teste"
+
+
+def test_comandos_da_ajuda_roteiam_para_o_handler():
+    roteador = AssistenteMultiperfil.roteador
+    for comando in comandos_da_ajuda():
+        rota, args = roteador.resolver(preencher(comando))
+        assert rota is not None, f"'{comando}' foi para a IA, esperado {ESPERADO[comando]}"
+        assert args is not None, f"'{comando}' caiu no uso de {rota.handler}"
+        assert rota.handler == ESPERADO[comando], f"'{comando}' roteou para {rota.handler}"
+        if 'ID' in comando:
+            assert args.get('pid') == int(EXEMPLOS['ID']), f"'{comando}' extraiu {args}"
+
+
+def test_texto_livre_vai_para_a_ia():
+    roteador = AssistenteMultiperfil.roteador
+    for frase in TEXTO_LIVRE:
+        rota, _ = roteador.resolver(frase)
+        assert rota is None, f"texto livre '{frase}' roteou para {rota.handler}"
+
+
+def test_argumento_bruto_preserva_maiusculas():
+    rota, args = AssistenteMultiperfil.roteador.resolver("Importar BOM 5 /tmp/Placas/MinhaBOM.csv")
+    assert rota.handler == '_cmd_importar_bom'
+    assert args == {'pid': 5, 'arquivo': '/tmp/Placas/MinhaBOM.csv'}
+    rota, args = AssistenteMultiperfil.roteador.resolver("Exportar BOM 5 Saida/BOM_Final.CSV")
+    assert args == {'pid': 5, 'arquivo': 'Saida/BOM_Final.CSV'}
+
+
+def test_sessao_entrega_o_texto_sem_baixar_maiusculas():
+    sessao = SessaoRemota.__new__(SessaoRemota)  # só a fila de entrada, sem banco nem LLM
+    sessao.fila_entrada = queue.Queue()
+    sessao.ao_consumir = None
+    sessao.entregar("importar bom 1 /tmp/x/MinhaBOM.csv")
+    assert sessao.ler_comando(timeout=0) == ('texto', "importar bom 1 /tmp/x/MinhaBOM.csv")